@@ -2,24 +2,30 @@
 # 基于aria2c实现多线程下载ComfyUI模型
 
 import os
-import sys
-import subprocess
-import platform
-import folder_paths
-import shutil
-import threading
-import time
 import json
-from pathlib import Path
+import asyncio
 
-from .model_downloader import ModelDownloader
+from .model_downloader import ModelDownloader, download_queue
+from .model_index import model_dir_index
+from .progress import progress_reporter
+from .prefetch import ModelPrefetcher, prefetch_manager, start_prompt_downloads
+from .mirrors import host_stats, load_mirror_groups
+from .bandwidth import bandwidth_budget
+from .hf_repo import parse_repo_url
+from .metrics import metrics
+from .catalog import model_catalog
+from .freshness import ModelUpdateChecker, result_to_dict, update_changed
 
 NODE_CLASS_MAPPINGS = {
-    "ModelDownloaderNode": ModelDownloader
+    "ModelDownloaderNode": ModelDownloader,
+    "ModelPrefetchNode": ModelPrefetcher,
+    "ModelUpdateCheckNode": ModelUpdateChecker,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
-    "ModelDownloaderNode": "Model Downloader"
+    "ModelDownloaderNode": "Model Downloader",
+    "ModelPrefetchNode": "Workflow Model Prefetch",
+    "ModelUpdateCheckNode": "Update Changed Models",
 }
 
 # 获取当前文件所在目录
@@ -32,6 +38,9 @@ def get_web_directories():
 # API路由处理
 from server import PromptServer
 
+# 提交队列时立即开始工作流中所有 Model Downloader 节点的下载
+PromptServer.instance.add_on_prompt_handler(start_prompt_downloads)
+
 @PromptServer.instance.routes.post("/model_downloader/download")
 async def api_download_model(request):
     try:
@@ -41,80 +50,288 @@ async def api_download_model(request):
         custom_path = json_data.get("custom_path", "")
         subfolder = json_data.get("subfolder", "")
         use_mirror = json_data.get("use_mirror", "no")
-        threads = json_data.get("threads", 16)
+        threads = json_data.get("threads", 0)
+        priority = int(json_data.get("priority", 0))
         
         if not url:
             return PromptServer.instance.create_response(status=400, content_type="application/json", 
                                                       content=json.dumps({"error": "URL不能为空"}))
         
-        # 创建下载器实例
-        downloader = ModelDownloader()
-        
-        # 获取模型目录信息
-        model_dirs = {}
-        base_path = folder_paths.models_dir
-        
-        # 遍历models目录下的所有文件夹
-        for item in os.listdir(base_path):
-            item_path = os.path.join(base_path, item)
-            if os.path.isdir(item_path):
-                model_dirs[item] = item_path
+        if parse_repo_url(url):
+            # 仓库地址：列出仓库文件，每个文件一个任务，共享下载队列的并发数；
+            # 列出文件要请求Hub API（可能分页、逐个镜像重试），放到线程池中执行，不阻塞服务器
+            jobs, error = await asyncio.get_running_loop().run_in_executor(
+                None, ModelDownloader.create_repo_jobs, url, model_dir, custom_path, subfolder, use_mirror, threads,
+                priority, json_data.get("revision", ""), json_data.get("include", ""), json_data.get("exclude", ""))
+            if error:
+                return PromptServer.instance.create_response(status=400, content_type="application/json", 
+                                                          content=json.dumps({"error": error}))
+            jobs = [ModelDownloader.submit_unique(job) for job in jobs]
+            return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                      content=json.dumps({"status": "仓库下载已加入队列",
+                                                                          "job_ids": [job.job_id for job in jobs],
+                                                                          "paths": [job.save_path for job in jobs]}))
         
-        # 添加自定义节点中的模型目录
-        custom_nodes_path = os.path.join(os.path.dirname(base_path), "custom_nodes")
-        if os.path.exists(custom_nodes_path):
-            for node_dir in os.listdir(custom_nodes_path):
-                node_path = os.path.join(custom_nodes_path, node_dir)
-                if os.path.isdir(node_path):
-                    node_models_path = os.path.join(node_path, "models")
-                    if os.path.exists(node_models_path) and os.path.isdir(node_models_path):
-                        model_dirs[f"custom_nodes/{node_dir}/models"] = node_models_path
+        job, error = ModelDownloader.create_job(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                                priority=priority, convert=json_data.get("convert", "none"),
+                                                extract=bool(json_data.get("extract", False)))
+        if error:
+            return PromptServer.instance.create_response(status=400, content_type="application/json", 
+                                                      content=json.dumps({"error": error}))
         
-        # 在新线程中启动下载，避免阻塞API响应
-        download_thread = threading.Thread(
-            target=downloader.download_model,
-            args=(url, model_dir, custom_path, subfolder, use_mirror, threads, json.dumps(model_dirs))
-        )
-        download_thread.daemon = True
-        download_thread.start()
+        # 加入下载队列，由工作线程池异步下载，避免阻塞API响应；同一目标已在下载时返回已有任务
+        job = ModelDownloader.submit_unique(job)
         
         return PromptServer.instance.create_response(status=200, content_type="application/json", 
-                                                  content=json.dumps({"status": "下载已开始"}))
+                                                  content=json.dumps({"status": "下载已加入队列", "job_id": job.job_id}))
     except Exception as e:
         return PromptServer.instance.create_response(status=500, content_type="application/json", 
                                                   content=json.dumps({"error": str(e)}))
 
+# 长轮询的最长等待时间（秒）
+STATUS_MAX_WAIT = 60
+
+
 @PromptServer.instance.routes.get("/model_downloader/status")
 async def api_get_download_status(request):
     try:
-        status = ModelDownloader.get_download_status()
+        job_id = request.query.get("job_id", "")
+        compact = request.query.get("compact", "") in ("1", "true", "yes")
+        if "since" in request.query:
+            return await _status_changes(request, job_id, compact)
+        status = ModelDownloader.get_download_status(job_id, compact)
+        if status is None:
+            return PromptServer.instance.create_response(status=404, content_type="application/json", 
+                                                      content=json.dumps({"error": f"未找到下载任务 '{job_id}'"}))
         return PromptServer.instance.create_response(status=200, content_type="application/json", 
                                                   content=json.dumps(status))
     except Exception as e:
         return PromptServer.instance.create_response(status=500, content_type="application/json", 
                                                   content=json.dumps({"error": str(e)}))
 
+async def _status_changes(request, job_id, compact):
+    """?since=<版本号> 只返回该版本之后变化的任务；没有变化时最多等待 wait 秒（默认30），仍无变化返回304"""
+    try:
+        since = int(request.query["since"])
+        wait = min(max(float(request.query.get("wait", 30)), 0), STATUS_MAX_WAIT)
+    except ValueError as e:
+        return PromptServer.instance.create_response(status=400, content_type="application/json", 
+                                                  content=json.dumps({"error": f"参数无效: {str(e)}"}))
+    job_ids = {value for value in job_id.split(",") if value} or None
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    checked = -1
+    while True:
+        # 队列版本号未变化时不需要重新比较任务
+        if download_queue.version != checked:
+            checked = download_queue.version
+            changes = download_queue.changes(since, job_ids, compact)
+            if changes["jobs"] or changes["removed"] or changes["full"]:
+                return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                          content=json.dumps(changes))
+        if loop.time() >= deadline:
+            return PromptServer.instance.create_response(status=304, content_type="application/json", content="")
+        await asyncio.sleep(0.25)
+
+@PromptServer.instance.routes.post("/model_downloader/cancel")
+async def api_cancel_download(request):
+    try:
+        json_data = await request.json()
+        job_id = json_data.get("job_id", "")
+        if not download_queue.cancel(job_id):
+            return PromptServer.instance.create_response(status=404, content_type="application/json", 
+                                                      content=json.dumps({"error": f"任务 '{job_id}' 不存在或已结束"}))
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps({"status": "已取消", "job_id": job_id}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.post("/model_downloader/prefetch")
+async def api_prefetch(request):
+    try:
+        json_data = await request.json()
+        workflow = json_data.get("workflow")
+        manifest = json_data.get("manifest")
+        if json_data.get("dry_run"):
+            missing, present, unresolved = prefetch_manager.plan(workflow, manifest)
+            return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                      content=json.dumps({"missing": [name for name, _ in missing],
+                                                                          "present": present,
+                                                                          "unresolved": unresolved}))
+        group = prefetch_manager.start(workflow, manifest,
+                                       use_mirror=json_data.get("use_mirror", "no"),
+                                       threads=json_data.get("threads", 0),
+                                       priority=int(json_data.get("priority", 0)))
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps(group.summary()))
+    except ValueError as e:
+        return PromptServer.instance.create_response(status=400, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.get("/model_downloader/prefetch")
+async def api_get_prefetch(request):
+    group = prefetch_manager.get(request.query.get("group_id", ""))
+    if group is None:
+        return PromptServer.instance.create_response(status=404, content_type="application/json", 
+                                                  content=json.dumps({"error": "未找到预取任务组"}))
+    return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                              content=json.dumps(group.summary()))
+
+@PromptServer.instance.routes.post("/model_downloader/pause")
+async def api_pause_download(request):
+    try:
+        json_data = await request.json()
+        job_id = json_data.get("job_id", "")
+        if not download_queue.pause(job_id):
+            return PromptServer.instance.create_response(status=409, content_type="application/json", 
+                                                      content=json.dumps({"error": f"任务 '{job_id}' 无法暂停"}))
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps({"status": "已暂停", "job_id": job_id}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.post("/model_downloader/resume")
+async def api_resume_download(request):
+    try:
+        json_data = await request.json()
+        job_id = json_data.get("job_id", "")
+        if not download_queue.resume(job_id):
+            return PromptServer.instance.create_response(status=409, content_type="application/json", 
+                                                      content=json.dumps({"error": f"任务 '{job_id}' 无法恢复"}))
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps({"status": "已恢复", "job_id": job_id}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+def _current_settings():
+    settings = {
+        "max_concurrent": download_queue.max_workers,
+        "progress_interval": progress_reporter.interval,
+        "console_echo": progress_reporter.echo,
+    }
+    settings.update(bandwidth_budget.settings())
+    return settings
+
+@PromptServer.instance.routes.get("/model_downloader/settings")
+async def api_get_settings(request):
+    return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                              content=json.dumps(_current_settings()))
+
+@PromptServer.instance.routes.post("/model_downloader/settings")
+async def api_update_settings(request):
+    try:
+        json_data = await request.json()
+        if "max_concurrent" in json_data:
+            download_queue.set_max_workers(int(json_data["max_concurrent"]))
+        if "progress_interval" in json_data:
+            progress_reporter.interval = max(0.05, float(json_data["progress_interval"]))
+        if "console_echo" in json_data:
+            progress_reporter.echo = bool(json_data["console_echo"])
+        # 限速单位为字节/秒，0 表示不限制，正在下载的任务立即生效
+        bandwidth_budget.set_limits(download_limit=json_data.get("download_limit"),
+                                    disk_write_limit=json_data.get("disk_write_limit"),
+                                    inference_limit=json_data.get("inference_limit"))
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps(_current_settings()))
+    except (TypeError, ValueError) as e:
+        return PromptServer.instance.create_response(status=400, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.get("/model_downloader/mirrors")
+async def api_get_mirrors(request):
+    try:
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps({"groups": load_mirror_groups(),
+                                                                      "hosts": host_stats.snapshot()}))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.get("/model_downloader/metrics")
+async def api_get_metrics(request):
+    try:
+        # 收集时可能要查询aria2c RPC，放到线程池中执行
+        text = await asyncio.get_running_loop().run_in_executor(None, metrics.render)
+        return PromptServer.instance.create_response(status=200, content_type="text/plain", content=text)
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+@PromptServer.instance.routes.get("/model_downloader/capabilities")
+async def api_get_capabilities(request):
+    try:
+        refresh = request.query.get("refresh", "") in ("1", "true", "yes")
+        # 第一次检测要运行 aria2c --version，放到线程池中执行
+        capabilities = await asyncio.get_running_loop().run_in_executor(None, ModelDownloader.capabilities, refresh)
+        return PromptServer.instance.create_response(status=200, content_type="application/json", 
+                                                  content=json.dumps(capabilities))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+def _catalog_response(query):
+    if query.get("path"):
+        entry = model_catalog.get(query["path"])
+        return (200, entry) if entry else (404, {"error": "模型目录中没有该文件"})
+    scan = model_catalog.refresh(model_dir_index.get(), force=query.get("refresh", "") in ("1", "true", "yes"))
+    models = model_catalog.entries(model_dir=query.get("model_dir") or None,
+                                   details=query.get("details", "") in ("1", "true", "yes"))
+    return 200, {"count": len(models), "scan": scan, "models": models}
+
+@PromptServer.instance.routes.get("/model_downloader/catalog")
+async def api_get_catalog(request):
+    try:
+        # 扫描目录和读取头部在线程池中执行
+        status, data = await asyncio.get_running_loop().run_in_executor(None, _catalog_response,
+                                                                         dict(request.query))
+        return PromptServer.instance.create_response(status=status, content_type="application/json", 
+                                                  content=json.dumps(data))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
+def _freshness_response(json_data):
+    prefix = json_data.get("path") or None
+    model_dir = json_data.get("model_dir")
+    if model_dir and model_dir != "all":
+        prefix = model_dir_index.resolve(model_dir)
+        if not prefix:
+            return 400, {"error": f"无法找到模型目录 '{model_dir}'"}
+    max_connections = json_data.get("max_connections")
+    results, jobs = update_changed(prefix, update=not json_data.get("dry_run"),
+                                   max_connections=int(max_connections) if max_connections else None,
+                                   priority=int(json_data.get("priority", 0)))
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return 200, {"checked": len(results), "counts": counts, "job_ids": [job.job_id for job in jobs],
+                 "files": [result_to_dict(result) for result in results]}
+
+@PromptServer.instance.routes.post("/model_downloader/freshness")
+async def api_check_freshness(request):
+    try:
+        json_data = await request.json()
+        # 并发的HEAD请求在线程池中执行
+        status, data = await asyncio.get_running_loop().run_in_executor(None, _freshness_response, json_data)
+        return PromptServer.instance.create_response(status=status, content_type="application/json", 
+                                                  content=json.dumps(data))
+    except Exception as e:
+        return PromptServer.instance.create_response(status=500, content_type="application/json", 
+                                                  content=json.dumps({"error": str(e)}))
+
 @PromptServer.instance.routes.get("/model_downloader/get_model_dirs")
 async def api_get_model_dirs(request):
     try:
-        model_dirs = []
-        base_path = folder_paths.models_dir
-        
-        # 遍历models目录下的所有文件夹
-        for item in os.listdir(base_path):
-            item_path = os.path.join(base_path, item)
-            if os.path.isdir(item_path):
-                model_dirs.append(item)
-        
-        # 添加自定义节点中的模型目录
-        custom_nodes_path = os.path.join(os.path.dirname(base_path), "custom_nodes")
-        if os.path.exists(custom_nodes_path):
-            for node_dir in os.listdir(custom_nodes_path):
-                node_path = os.path.join(custom_nodes_path, node_dir)
-                if os.path.isdir(node_path):
-                    node_models_path = os.path.join(node_path, "models")
-                    if os.path.exists(node_models_path) and os.path.isdir(node_models_path):
-                        model_dirs.append(f"custom_nodes/{node_dir}/models")
+        model_dirs = model_dir_index.names()
         
         return PromptServer.instance.create_response(status=200, content_type="application/json", 
                                                   content=json.dumps({"model_dirs": model_dirs}))
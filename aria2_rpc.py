@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import socket
+import secrets
+import subprocess
+import threading
+import time
+import itertools
+import urllib.request
+import urllib.error
+
+
+class Aria2RpcError(Exception):
+    """aria2 JSON-RPC调用失败"""
+
+
+class Aria2Rpc:
+    """aria2 JSON-RPC客户端"""
+
+    def __init__(self, port, secret, host="127.0.0.1", timeout=10):
+        self.endpoint = f"http://{host}:{port}/jsonrpc"
+        self._token = f"token:{secret}"
+        self._timeout = timeout
+        self._ids = itertools.count(1)
+
+    def call(self, method, *params):
+        payload = json.dumps({
+            "jsonrpc": "2.0",
+            "id": str(next(self._ids)),
+            "method": method,
+            "params": [self._token, *params],
+        }).encode("utf-8")
+        request = urllib.request.Request(self.endpoint, data=payload,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                data = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            # aria2 对出错的调用返回 HTTP 400 及 JSON 错误体
+            try:
+                data = json.loads(e.read().decode("utf-8"))
+            except Exception:
+                raise Aria2RpcError(f"{method} 调用失败: HTTP {e.code}")
+        except (urllib.error.URLError, OSError) as e:
+            raise Aria2RpcError(f"无法连接aria2 RPC: {str(e)}")
+        if "error" in data:
+            raise Aria2RpcError(f"{method} 调用失败: {data['error'].get('message', data['error'])}")
+        return data.get("result")
+
+    def add_uri(self, uris, options=None):
+        """添加下载，uris 为同一文件的一个或多个地址，返回gid"""
+        return self.call("aria2.addUri", list(uris), options or {})
+
+    def tell_status(self, gid, keys=None):
+        if keys:
+            return self.call("aria2.tellStatus", gid, list(keys))
+        return self.call("aria2.tellStatus", gid)
+
+    def tell_active(self, keys=None):
+        if keys:
+            return self.call("aria2.tellActive", list(keys))
+        return self.call("aria2.tellActive")
+
+    def pause(self, gid):
+        return self.call("aria2.pause", gid)
+
+    def unpause(self, gid):
+        return self.call("aria2.unpause", gid)
+
+    def remove(self, gid):
+        return self.call("aria2.remove", gid)
+
+    def remove_download_result(self, gid):
+        return self.call("aria2.removeDownloadResult", gid)
+
+    def get_servers(self, gid):
+        """返回各分段正在使用的服务器及其下载速度"""
+        return self.call("aria2.getServers", gid)
+
+    def change_option(self, gid, options):
+        return self.call("aria2.changeOption", gid, options)
+
+    def change_global_option(self, options):
+        return self.call("aria2.changeGlobalOption", options)
+
+    def get_version(self):
+        return self.call("aria2.getVersion")
+
+
+class Aria2Daemon:
+    """常驻的 aria2c --enable-rpc 进程，所有下载共享同一个进程和连接池"""
+
+    def __init__(self, aria2c_path, max_concurrent_downloads=16, server_stat_path=None):
+        self.aria2c_path = aria2c_path
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.server_stat_path = server_stat_path
+        self.process = None
+        self.client = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ensure_running(self, timeout=10):
+        """确保aria2c RPC进程在运行（进程退出后会自动重启），返回RPC客户端"""
+        with self._lock:
+            if self.is_running:
+                return self.client
+            self._start(timeout)
+            return self.client
+
+    def _start(self, timeout):
+        port = _find_free_port()
+        secret = secrets.token_hex(16)
+        cmd = [
+            self.aria2c_path,
+            "--enable-rpc=true",
+            "--rpc-listen-all=false",
+            f"--rpc-listen-port={port}",
+            f"--rpc-secret={secret}",
+            f"--max-concurrent-downloads={self.max_concurrent_downloads}",
+            "--continue=true",
+            "--auto-file-renaming=false",
+            "--console-log-level=warn",
+            "--summary-interval=0",
+            "--quiet=true",
+        ]
+        if self.server_stat_path:
+            # 持久化各服务器的速度统计，--uri-selector=adaptive 据此在镜像之间选择
+            cmd.append(f"--server-stat-of={self.server_stat_path}")
+            if os.path.exists(self.server_stat_path):
+                cmd.append(f"--server-stat-if={self.server_stat_path}")
+        if os.name != "nt":
+            # ComfyUI退出时aria2c一并退出
+            cmd.append(f"--stop-with-process={os.getpid()}")
+
+        creationflags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                        creationflags=creationflags)
+        self.client = Aria2Rpc(port, secret)
+
+        # 等待RPC端口就绪
+        deadline = time.time() + timeout
+        while True:
+            try:
+                version = self.client.get_version()
+                print(f"aria2c RPC服务已启动 (版本 {version.get('version')}, 端口 {port})")
+                return
+            except Aria2RpcError:
+                if self.process.poll() is not None:
+                    raise Aria2RpcError(f"aria2c RPC进程启动失败，返回码: {self.process.returncode}")
+                if time.time() > deadline:
+                    self.stop()
+                    raise Aria2RpcError("等待aria2c RPC服务启动超时")
+                time.sleep(0.1)
+
+    def stop(self):
+        with self._lock:
+            if self.is_running:
+                try:
+                    self.client.call("aria2.shutdown")
+                    self.process.wait(timeout=5)
+                except Exception:
+                    self.process.terminate()
+            self.process = None
+            self.client = None
+
+
+def _find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def contiguous_length(status):
+    """根据tellStatus返回的bitfield计算从文件开头起已连续下载完成的字节数"""
+    bitfield = status.get("bitfield")
+    piece_length = int(status.get("pieceLength") or 0)
+    total = int(status.get("totalLength") or 0)
+    if not bitfield or not piece_length:
+        return 0
+    pieces = 0
+    for digit in bitfield:
+        value = int(digit, 16)
+        if value == 0xF:
+            pieces += 4
+            continue
+        # 数出该十六进制位中从高位起连续为1的位数
+        mask = 0x8
+        while value & mask:
+            pieces += 1
+            mask >>= 1
+        break
+    return min(total, pieces * piece_length)
+
+
+# aria2c的文件预分配方式；Linux上用fallocate一次性分配，既减少碎片，磁盘空间不足时也能在开始下载时
+# 就失败，而aria2c默认的prealloc要先把整个文件写一遍零。其他平台保持aria2c的默认值
+FILE_ALLOCATION = os.environ.get("MODEL_DOWNLOADER_FILE_ALLOCATION",
+                                 "falloc" if sys.platform.startswith("linux") else "")
+
+# aria2c退出码/errorCode 9: 磁盘空间不足
+ARIA2_DISK_FULL = "9"
+
+
+def error_cause(code):
+    """把aria2c的错误码归类为统计用的原因"""
+    return "disk_space" if str(code) == ARIA2_DISK_FULL else f"aria2_{code}"
+
+
+def download_options(save_dir, out, connections, segment_size=None):
+    """RPC和子进程两种方式共用的单个下载参数（aria2c选项名 -> 值）"""
+    options = {
+        "dir": save_dir,
+        "out": out,
+        "split": str(connections),
+        "max-connection-per-server": str(connections),
+        "min-split-size": f"{(segment_size or 1024 * 1024) // (1024 * 1024)}M",
+        # 保留.aria2控制文件，中断后从已有字节继续
+        "continue": "true",
+        # 多个镜像时按服务器速度统计选择地址
+        "uri-selector": "adaptive",
+    }
+    if FILE_ALLOCATION:
+        options["file-allocation"] = FILE_ALLOCATION
+    return options
+
+
+def command_line(aria2c_path, uris, options):
+    """把下载参数转换为aria2c子进程的命令行"""
+    return [
+        aria2c_path,
+        *[f"--{name}={value}" for name, value in options.items()],
+        "--auto-file-renaming=false",
+        "--summary-interval=0",  # 只输出单行进度，不输出多行汇总
+        *uris,
+    ]
+
+
+# aria2c 服务器速度统计文件，保存在插件目录下
+ARIA2_SERVER_STAT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aria2_server_stats.txt")
+
+_daemon = None
+_daemon_lock = threading.Lock()
+
+
+def running_client():
+    """aria2c RPC进程正在运行时返回其客户端，否则返回None"""
+    with _daemon_lock:
+        daemon = _daemon
+    if daemon is not None and daemon.is_running:
+        return daemon.client
+    return None
+
+
+def stop_daemon():
+    """停止全局的aria2c RPC进程（例如命令行下载结束时）"""
+    with _daemon_lock:
+        daemon = _daemon
+    if daemon is not None:
+        daemon.stop()
+
+
+def get_daemon(aria2c_path):
+    """获取全局共享的aria2c RPC进程"""
+    global _daemon
+    with _daemon_lock:
+        if _daemon is None or _daemon.aria2c_path != aria2c_path:
+            _daemon = Aria2Daemon(aria2c_path, server_stat_path=ARIA2_SERVER_STAT_PATH)
+        return _daemon
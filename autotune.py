@@ -0,0 +1,176 @@
+import os
+import json
+import threading
+import time
+
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 自动模式下没有历史记录时的初始连接数
+DEFAULT_CONNECTIONS = 8
+MIN_SEGMENT_SIZE = 1024 * 1024
+# aria2c 的 --min-split-size 上限为1024M
+MAX_SEGMENT_SIZE = 1024 * 1024 * 1024
+
+# 按文件大小分类记录最佳设置，小文件和大文件的最佳连接数通常不同
+SIZE_CLASSES = (
+    ("small", 100 * 1024 ** 2),
+    ("medium", 1024 ** 3),
+    ("large", 8 * 1024 ** 3),
+)
+
+
+def size_class(total_size):
+    if not total_size:
+        return "unknown"
+    for name, limit in SIZE_CLASSES:
+        if total_size < limit:
+            return name
+    return "huge"
+
+
+def segment_size_for(total_size, connections):
+    """每个连接约4个分段，限制在 [1M, 1024M] 之间"""
+    if not total_size:
+        return MIN_SEGMENT_SIZE
+    size = -(-total_size // (max(1, connections) * 4))
+    return max(MIN_SEGMENT_SIZE, min(MAX_SEGMENT_SIZE, size))
+
+
+class TuningStore:
+    """持久化每个 (主机, 文件大小分类) 测得的最佳连接数和分段大小"""
+
+    def __init__(self, path):
+        self.path = path
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # 调用方需持有 self._lock
+        if self._settings is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._settings = json.load(f)
+            except (OSError, ValueError):
+                self._settings = {}
+        return self._settings
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._settings, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"保存下载调优记录失败: {str(e)}")
+
+    def lookup(self, host, total_size):
+        with self._lock:
+            entry = self._load().get(f"{host}|{size_class(total_size)}")
+        return dict(entry) if entry else None
+
+    def initial(self, host, total_size, max_connections):
+        """返回 (连接数, 分段大小)：有历史记录时使用记录的最佳值，否则使用默认值"""
+        entry = self.lookup(host, total_size)
+        if entry:
+            connections = max(1, min(max_connections, int(entry["connections"])))
+            return connections, segment_size_for(total_size, connections)
+        connections = min(DEFAULT_CONNECTIONS, max_connections)
+        return connections, segment_size_for(total_size, connections)
+
+    def record(self, host, total_size, connections, throughput):
+        """记录一次下载测得的最佳设置；比已有记录慢很多时只降低已有记录的吞吐量"""
+        if throughput <= 0:
+            return
+        key = f"{host}|{size_class(total_size)}"
+        with self._lock:
+            settings = self._load()
+            entry = settings.get(key)
+            if entry and entry["connections"] == connections:
+                entry["throughput"] = entry["throughput"] * 0.7 + throughput * 0.3
+            elif entry is None or throughput >= entry["throughput"] * 0.9:
+                entry = settings[key] = {"connections": connections, "throughput": throughput}
+            else:
+                # 网络状况可能已变化，逐渐降低旧记录的权重
+                entry["throughput"] *= 0.9
+            entry["segment_size"] = segment_size_for(total_size, entry["connections"])
+            entry["updated_at"] = time.time()
+            self._save()
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._load()))
+
+
+class ConnectionTuner:
+    """下载开始后的爬山调优：每个测量窗口比较吞吐量，增加连接数有效时继续增加，否则回退
+
+    observe() 返回需要切换到的新连接数，不需要调整时返回None。
+    """
+
+    # 吞吐量至少提高这么多才算调整有效
+    MIN_GAIN = 1.1
+
+    def __init__(self, connections, max_connections, window=3.0, max_steps=4):
+        self.connections = connections
+        self.max_connections = max_connections
+        self.window = window
+        self.max_steps = max_steps
+        self.best_connections = connections
+        self.best_throughput = 0.0
+        self.done = False
+        self._steps = 0
+        self._direction = 1 if connections < max_connections else -1
+        self._window_start = None
+        self._window_bytes = 0
+
+    def observe(self, completed_bytes, now=None):
+        now = time.monotonic() if now is None else now
+        if self.done:
+            return None
+        if self._window_start is None:
+            self._window_start, self._window_bytes = now, completed_bytes
+            return None
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return None
+        throughput = (completed_bytes - self._window_bytes) / elapsed
+        self._window_start, self._window_bytes = now, completed_bytes
+        return self._step(throughput)
+
+    def _step(self, throughput):
+        if throughput > self.best_throughput * self.MIN_GAIN:
+            self.best_connections, self.best_throughput = self.connections, throughput
+            return self._move(self._direction)
+        if self._direction == 1 and self._steps == 1:
+            # 第一次增加连接数没有效果，改为尝试减少
+            self._direction = -1
+            return self._move(-1)
+        return self._finish()
+
+    def _move(self, direction):
+        if self._steps >= self.max_steps:
+            return self._finish()
+        if direction > 0:
+            # 连接数少时加倍，多时增加一半
+            grown = self.best_connections * 2 if self.best_connections < 8 else self.best_connections * 3 // 2
+            target = min(self.max_connections, grown)
+        else:
+            target = max(1, self.best_connections * 2 // 3)
+        if target == self.best_connections:
+            return self._finish()
+        self._steps += 1
+        self._direction = direction
+        self.connections = target
+        return target
+
+    def _finish(self):
+        self.done = True
+        if self.connections != self.best_connections:
+            self.connections = self.best_connections
+            return self.best_connections
+        return None
+
+
+# 全局调优记录，保存在插件目录下
+tuning_store = TuningStore(os.path.join(PLUGIN_DIR, "tuning.json"))
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+
+class TokenBucket:
+    """线程安全的令牌桶，rate 为每秒字节数，0 表示不限制
+
+    reserve() 立即扣除令牌并返回调用方需要等待的秒数，多个连接同时预约时
+    依次排队，总速度不超过 rate。
+    """
+
+    def __init__(self, rate=0, burst_seconds=0.5):
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = max(0, int(rate or 0))
+            # 修改速率时清空积累的令牌和欠账，新速率立即生效
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+    def reserve(self, num_bytes):
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            burst = self.rate * self.burst_seconds
+            self._tokens = min(burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= num_bytes
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+def _tasks_remaining():
+    # 延迟导入，命令行等没有ComfyUI服务器的环境下视为空闲
+    try:
+        from server import PromptServer
+        return PromptServer.instance.prompt_queue.get_tasks_remaining()
+    except Exception:
+        return 0
+
+
+class BandwidthBudget:
+    """所有下载共享的带宽和磁盘写入预算
+
+    download_limit 限制网络下载总速度，disk_write_limit 限制写盘速度，
+    inference_limit 在ComfyUI执行队列非空（正在推理）时生效，队列空闲后恢复。
+    单位均为字节/秒，0 表示不限制。
+    """
+
+    def __init__(self, download_limit=0, disk_write_limit=0, inference_limit=0, poll_interval=1.0):
+        self.download_limit = download_limit
+        self.disk_write_limit = disk_write_limit
+        self.inference_limit = inference_limit
+        self.poll_interval = poll_interval
+        self.inference_active = False
+        self.network = TokenBucket()
+        self.disk = TokenBucket()
+        self._listeners = []
+        self._monitor = None
+        self._lock = threading.Lock()
+        self._apply()
+
+    def add_listener(self, listener):
+        """注册限速变化回调 listener(budget)，例如把限速同步给aria2c"""
+        self._listeners.append(listener)
+
+    def effective_download_limit(self):
+        limits = [self.download_limit]
+        if self.inference_active:
+            limits.append(self.inference_limit)
+        limits = [limit for limit in limits if limit > 0]
+        return min(limits) if limits else 0
+
+    def effective_overall_limit(self):
+        """同时考虑网络和写盘限制的总速度，用于无法单独限制写盘的aria2c"""
+        limits = [limit for limit in (self.effective_download_limit(), self.disk_write_limit) if limit > 0]
+        return min(limits) if limits else 0
+
+    def set_limits(self, download_limit=None, disk_write_limit=None, inference_limit=None):
+        """运行中修改限速，正在下载的任务立即生效"""
+        with self._lock:
+            if download_limit is not None:
+                self.download_limit = max(0, int(download_limit))
+            if disk_write_limit is not None:
+                self.disk_write_limit = max(0, int(disk_write_limit))
+            if inference_limit is not None:
+                self.inference_limit = max(0, int(inference_limit))
+        self._apply()
+
+    def settings(self):
+        return {
+            "download_limit": self.download_limit,
+            "disk_write_limit": self.disk_write_limit,
+            "inference_limit": self.inference_limit,
+            "inference_active": self.inference_active,
+            "effective_download_limit": self.effective_download_limit(),
+        }
+
+    def _apply(self):
+        self.network.set_rate(self.effective_download_limit())
+        self.disk.set_rate(self.disk_write_limit)
+        if self.inference_limit > 0:
+            self._ensure_monitor()
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                print(f"应用下载限速失败: {str(e)}")
+
+    def _ensure_monitor(self):
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._monitor_loop, name="model-downloader-bandwidth")
+                self._monitor.daemon = True
+                self._monitor.start()
+
+    def _monitor_loop(self):
+        """轮询ComfyUI执行队列，推理开始时降低下载预算，空闲时恢复"""
+        while True:
+            time.sleep(self.poll_interval)
+            active = self.inference_limit > 0 and _tasks_remaining() > 0
+            if active != self.inference_active:
+                self.inference_active = active
+                print("检测到正在推理，降低下载速度" if active else "推理队列空闲，恢复下载速度")
+                self._apply()
+
+
+# 全局下载预算，可通过环境变量或设置接口调整
+bandwidth_budget = BandwidthBudget(
+    download_limit=int(os.environ.get("MODEL_DOWNLOADER_DOWNLOAD_LIMIT", "0")),
+    disk_write_limit=int(os.environ.get("MODEL_DOWNLOADER_DISK_LIMIT", "0")),
+    inference_limit=int(os.environ.get("MODEL_DOWNLOADER_INFERENCE_LIMIT", "0")),
+)
@@ -0,0 +1,22 @@
+import os
+import sys
+import importlib
+import importlib.util
+
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 注册插件包时使用的包名，插件模块之间使用相对导入
+PACKAGE = "model_downloader_plugin"
+
+
+def load(name):
+    """在没有ComfyUI的环境中导入插件模块（如 "http_engine"）
+
+    只注册插件包本身而不执行插件的 __init__.py（它依赖ComfyUI服务器），
+    之后按普通子模块导入，模块内的相对导入照常工作。
+    """
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE, os.path.join(PLUGIN_DIR, "__init__.py"), submodule_search_locations=[PLUGIN_DIR])
+        sys.modules[PACKAGE] = importlib.util.module_from_spec(spec)
+    return importlib.import_module(f"{PACKAGE}.{name}")
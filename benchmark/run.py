@@ -0,0 +1,304 @@
+"""下载吞吐量基准测试：启动本地合成文件服务器，按矩阵运行各下载引擎并记录结果
+
+每次试验在独立的子进程中运行，CPU时间和峰值内存只包含该次下载（及其aria2c子进程）。
+结果保存为JSON，可用 --compare 与之前的结果对比，吞吐量下降超过阈值时返回码为1。
+
+    python benchmark/run.py --sizes 64M,256M --connections 1,4,8,16 --output new.json
+    python benchmark/run.py --compare baseline.json new.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import itertools
+import subprocess
+import tempfile
+import urllib.request
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不记录CPU时间和峰值内存
+    resource = None
+
+from plugin_modules import PLUGIN_DIR, load
+from server import SyntheticContent, parse_size
+
+ENGINES = ("python", "aria2c", "aria2-rpc")
+# aria2c 单服务器连接数上限
+ARIA2_MAX_CONNECTIONS = 16
+# 比较结果时用于匹配同一组试验的字段
+MATRIX_KEYS = ("engine", "file_size", "connections", "segment_size")
+
+
+def find_aria2c():
+    """优先使用插件自带的aria2c（Windows），否则在PATH中查找"""
+    bundled = os.path.join(PLUGIN_DIR, "aria2-1.37.0-win-64bit", "aria2c.exe")
+    if os.name == "nt" and os.path.exists(bundled):
+        return bundled
+    return shutil.which("aria2c")
+
+
+def _usage():
+    if resource is None:
+        return None
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    # Linux 上 ru_maxrss 单位为KiB，macOS 上为字节
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {
+        "user": sum(u.ru_utime for u in usage),
+        "system": sum(u.ru_stime for u in usage),
+        "peak_rss_kb": max(u.ru_maxrss for u in usage) // scale,
+    }
+
+
+def _run_python(trial, path):
+    http_engine = load("http_engine")
+    downloader = http_engine.SegmentedDownloader(trial["url"], path, connections=trial["connections"],
+                                                 segment_size=trial["segment_size"], resume=False)
+    downloader.download()
+
+
+def _run_aria2c(trial, path):
+    aria2_rpc = load("aria2_rpc")
+    options = aria2_rpc.download_options(os.path.dirname(path), os.path.basename(path),
+                                         trial["connections"], trial["segment_size"])
+    cmd = aria2_rpc.command_line(trial["aria2c"], [trial["url"]], options)
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"aria2c 返回码 {result.returncode}: {result.stderr.strip()[-500:]}")
+
+
+def _run_aria2_rpc(trial, path, client):
+    aria2_rpc = load("aria2_rpc")
+    options = aria2_rpc.download_options(os.path.dirname(path), os.path.basename(path),
+                                         trial["connections"], trial["segment_size"])
+    gid = client.add_uri([trial["url"]], options)
+    while True:
+        status = client.tell_status(gid, ["status", "errorMessage"])
+        if status["status"] == "complete":
+            return
+        if status["status"] in ("error", "removed"):
+            raise RuntimeError(f"aria2c RPC下载失败: {status.get('errorMessage')}")
+        time.sleep(0.05)
+
+
+def run_trial(trial):
+    """在当前（独立的）进程中执行一次下载并返回测量结果"""
+    workdir = tempfile.mkdtemp(prefix="md-bench-", dir=trial.get("workdir"))
+    path = os.path.join(workdir, "file.bin")
+    daemon = None
+    result = {"ok": False, "error": None}
+    try:
+        # 先导入下载引擎模块，导入时间不计入测量
+        load("http_engine")
+        load("aria2_rpc")
+        if trial["engine"] == "aria2-rpc":
+            # RPC进程在计时之前启动，只测量下载本身
+            daemon = load("aria2_rpc").Aria2Daemon(trial["aria2c"])
+            client = daemon.ensure_running()
+        before = _usage()
+        wall_start = time.time()
+        started = time.perf_counter()
+        if trial["engine"] == "python":
+            _run_python(trial, path)
+        elif trial["engine"] == "aria2c":
+            _run_aria2c(trial, path)
+        else:
+            _run_aria2_rpc(trial, path, client)
+        elapsed = time.perf_counter() - started
+        if daemon is not None:
+            daemon.stop()
+            daemon = None
+        after = _usage()
+
+        size = os.path.getsize(path)
+        if size != trial["file_size"]:
+            raise RuntimeError(f"文件大小不一致: 预期 {trial['file_size']}，实际 {size}")
+        if trial.get("verify"):
+            digest = load("integrity").PrefixHasher(path).finish(size)
+            if digest != SyntheticContent(trial["seed"]).sha256(size):
+                raise RuntimeError("文件内容校验失败")
+
+        with urllib.request.urlopen(f"{trial['server']}/stats/{trial['trial_id']}", timeout=10) as response:
+            stats = json.loads(response.read().decode("utf-8"))
+        result.update({
+            "ok": True,
+            "elapsed": elapsed,
+            "throughput": size / elapsed if elapsed > 0 else 0,
+            "ttfb": stats["first_byte_at"] - wall_start if stats["first_byte_at"] else None,
+            "requests": stats["requests"],
+            "bytes_sent": stats["bytes_sent"],
+            "dropped": stats["dropped"],
+        })
+        if before and after:
+            result.update({
+                "cpu_user": after["user"] - before["user"],
+                "cpu_system": after["system"] - before["system"],
+                "peak_rss_kb": after["peak_rss_kb"],
+            })
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+    finally:
+        if daemon is not None:
+            daemon.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def _start_server(args):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+           "--bandwidth", str(parse_size(args.bandwidth)),
+           "--per-connection", str(parse_size(args.per_connection)),
+           "--latency", str(args.latency), "--fail-rate", str(args.fail_rate), "--seed", str(args.seed)]
+    if args.no_ranges:
+        cmd.append("--no-ranges")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    address = process.stdout.readline().strip()
+    if not address:
+        process.kill()
+        raise RuntimeError("合成文件服务器启动失败")
+    return process, address
+
+
+def _spawn_trial(trial):
+    cmd = [sys.executable, os.path.abspath(__file__), "--trial", json.dumps(trial)]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return {"ok": False, "error": f"试验进程异常退出，返回码 {result.returncode}"}
+
+
+def _matrix(args, aria2c):
+    engines = [engine.strip() for engine in args.engines.split(",") if engine.strip()]
+    for engine in engines:
+        if engine not in ENGINES:
+            raise SystemExit(f"未知的下载引擎: {engine}（可选 {', '.join(ENGINES)}）")
+        if engine != "python" and not aria2c:
+            print(f"未找到aria2c，跳过 {engine}", file=sys.stderr)
+    engines = [engine for engine in engines if engine == "python" or aria2c]
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    connections = [int(count) for count in args.connections.split(",")]
+    segment_sizes = [parse_size(size) for size in args.segment_sizes.split(",")]
+    for size, engine, count, segment_size in itertools.product(sizes, engines, connections, segment_sizes):
+        if engine != "python" and count > ARIA2_MAX_CONNECTIONS:
+            continue
+        yield {"engine": engine, "file_size": size, "connections": count, "segment_size": segment_size}
+
+
+def run_matrix(args):
+    aria2c = find_aria2c()
+    server, address = _start_server(args)
+    results = []
+    try:
+        for index, entry in enumerate(itertools.chain.from_iterable(
+                itertools.repeat(entry, args.repeat) for entry in _matrix(args, aria2c))):
+            trial_id = f"{index}-{entry['engine']}-{entry['connections']}"
+            trial = dict(entry, trial_id=trial_id, server=address, aria2c=aria2c, seed=args.seed,
+                         verify=args.verify, workdir=args.workdir,
+                         url=f"{address}/t/{trial_id}/{entry['file_size']}.bin")
+            result = dict(entry, **_spawn_trial(trial))
+            results.append(result)
+            _print_result(result)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "created_at": time.time(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(),
+                 "cpu_count": os.cpu_count(), "aria2c": aria2c},
+        "server": {"bandwidth": parse_size(args.bandwidth), "per_connection": parse_size(args.per_connection),
+                   "latency": args.latency, "ranges": not args.no_ranges, "fail_rate": args.fail_rate,
+                   "seed": args.seed},
+        "results": results,
+    }
+
+
+def _mib(value):
+    return f"{value / 1024 ** 2:.1f}"
+
+
+def _print_result(result):
+    label = (f"{result['engine']:<10} 大小 {_mib(result['file_size']):>8}M  连接 {result['connections']:>3}  "
+             f"分段 {_mib(result['segment_size']):>6}M")
+    if not result["ok"]:
+        print(f"{label}  失败: {result['error']}", flush=True)
+        return
+    ttfb = f"{result['ttfb'] * 1000:.0f}ms" if result.get("ttfb") is not None else "-"
+    cpu = f"{result['cpu_user'] + result['cpu_system']:.2f}s" if "cpu_user" in result else "-"
+    rss = f"{result['peak_rss_kb'] / 1024:.0f}M" if "peak_rss_kb" in result else "-"
+    print(f"{label}  {_mib(result['throughput']):>8} MiB/s  首字节 {ttfb:>6}  CPU {cpu:>6}  内存 {rss:>5}",
+          flush=True)
+
+
+def _summarize(report):
+    """按矩阵位置汇总多次重复的结果，吞吐量取中位数"""
+    groups = {}
+    for result in report["results"]:
+        if result.get("ok"):
+            groups.setdefault(tuple(result[key] for key in MATRIX_KEYS), []).append(result["throughput"])
+    return {key: sorted(values)[len(values) // 2] for key, values in groups.items()}
+
+
+def compare(baseline_path, current_path, threshold):
+    """对比两次结果，返回吞吐量下降超过阈值的条目数"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = _summarize(json.load(f))
+    with open(current_path, "r", encoding="utf-8") as f:
+        current = _summarize(json.load(f))
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        change = (after - before) / before if before > 0 else 0
+        regressed = change < -threshold
+        regressions += regressed
+        engine, size, connections, segment_size = key
+        print(f"{engine:<10} 大小 {_mib(size):>8}M  连接 {connections:>3}  分段 {_mib(segment_size):>6}M  "
+              f"{_mib(before):>8} -> {_mib(after):>8} MiB/s  {change:+.1%}{'  回退' if regressed else ''}")
+    missing = set(baseline) ^ set(current)
+    if missing:
+        print(f"{len(missing)} 个矩阵位置只出现在其中一份结果中，未比较")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线下载吞吐量基准测试")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="逗号分隔: python,aria2c,aria2-rpc")
+    parser.add_argument("--sizes", default="64M,256M", help="文件大小列表")
+    parser.add_argument("--connections", default="1,4,8,16", help="连接数列表")
+    parser.add_argument("--segment-sizes", default="4M", help="分段大小列表（aria2c 为 --min-split-size）")
+    parser.add_argument("--repeat", type=int, default=1, help="每个矩阵位置重复次数")
+    parser.add_argument("--bandwidth", default="0", help="服务器总带宽（字节/秒，可写 100M），0 不限制")
+    parser.add_argument("--per-connection", default="0", help="服务器单连接带宽，0 不限制")
+    parser.add_argument("--latency", type=float, default=0.0, help="服务器每个请求的响应延迟（秒）")
+    parser.add_argument("--no-ranges", action="store_true", help="服务器不支持Range请求")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="每个响应在中途断开的概率")
+    parser.add_argument("--seed", type=int, default=0, help="合成文件内容和故障注入的随机种子")
+    parser.add_argument("--verify", action="store_true", help="下载后校验文件的SHA-256")
+    parser.add_argument("--workdir", default=None, help="下载临时目录（默认系统临时目录）")
+    parser.add_argument("--output", default="benchmark_results.json", help="结果JSON文件")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="对比两份结果")
+    parser.add_argument("--threshold", type=float, default=0.1, help="吞吐量下降超过该比例视为回退")
+    parser.add_argument("--trial", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.trial:
+        print(json.dumps(run_trial(json.loads(args.trial))))
+        return 0
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    report = run_matrix(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    failed = sum(1 for result in report["results"] if not result["ok"])
+    print(f"结果已保存到 {args.output}（{len(report['results'])} 次试验，{failed} 次失败）")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""离线的合成文件HTTP服务器，用于下载吞吐量基准测试
+
+GET/HEAD /t/<试验ID>/<字节数>.bin 返回确定性的伪随机内容，可配置总带宽、单连接带宽、
+响应延迟、是否支持Range，以及按概率在传输中途断开连接。
+GET /stats/<试验ID> 返回该试验的首字节时间、请求数和发送字节数。
+
+单独运行: python benchmark/server.py --port 8765 --bandwidth 50M --latency 0.05
+"""
+import sys
+import json
+import time
+import random
+import socket
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from plugin_modules import load
+
+TokenBucket = load("bandwidth").TokenBucket
+
+# 内容以一个质数长度的伪随机块循环，按MiB对齐放错位置的分段也能被校验发现
+PATTERN_SIZE = 1048573
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def parse_size(text):
+    """解析 "64M"、"1.5G"、"512K" 这样的大小，返回字节数"""
+    text = str(text).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text or 0))
+
+
+class SyntheticContent:
+    """由种子决定的文件内容，任意偏移处的数据都可以直接生成"""
+
+    def __init__(self, seed=0):
+        pattern = random.Random(seed).randbytes(PATTERN_SIZE)
+        self._doubled = pattern + pattern
+
+    def read(self, offset, size):
+        parts = []
+        while size > 0:
+            start = offset % PATTERN_SIZE
+            n = min(size, PATTERN_SIZE)
+            parts.append(self._doubled[start:start + n])
+            offset += n
+            size -= n
+        return b"".join(parts)
+
+    def sha256(self, total_size):
+        digest = hashlib.sha256()
+        for offset in range(0, total_size, PATTERN_SIZE):
+            digest.update(self.read(offset, min(PATTERN_SIZE, total_size - offset)))
+        return digest.hexdigest()
+
+
+class TrialStats:
+    def __init__(self):
+        self.first_byte_at = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+
+    def to_dict(self):
+        return {"first_byte_at": self.first_byte_at, "requests": self.requests,
+                "bytes_sent": self.bytes_sent, "dropped": self.dropped}
+
+
+class SyntheticServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bandwidth=0, per_connection=0, latency=0.0, ranges=True,
+                 fail_rate=0.0, seed=0):
+        super().__init__(address, _Handler)
+        self.per_connection = per_connection
+        self.latency = latency
+        self.ranges = ranges
+        self.fail_rate = fail_rate
+        self.content = SyntheticContent(seed)
+        self.bandwidth = TokenBucket(bandwidth, burst_seconds=0.1)
+        self._random = random.Random(seed)
+        self._trials = {}
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # 客户端取消或断开连接是正常情况（例如下载引擎在分段完成后关闭连接）
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def trial(self, trial_id):
+        with self._lock:
+            return self._trials.setdefault(trial_id, TrialStats())
+
+    def should_drop(self):
+        with self._lock:
+            return self.fail_rate > 0 and self._random.random() < self.fail_rate
+
+    def random_offset(self, length):
+        with self._lock:
+            return self._random.randrange(length) if length > 0 else 0
+
+    def settings(self):
+        return {"bandwidth": self.bandwidth.rate, "per_connection": self.per_connection,
+                "latency": self.latency, "ranges": self.ranges, "fail_rate": self.fail_rate}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        if self.path.startswith("/stats/"):
+            stats = self.server.trial(self.path[len("/stats/"):]).to_dict()
+            self._send_json(200, stats)
+        elif self.path == "/settings":
+            self._send_json(200, self.server.settings())
+        else:
+            self._serve(send_body=True)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse_path(self):
+        # /t/<试验ID>/<字节数>.bin
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "t" or not parts[2].endswith(".bin"):
+            return None, None
+        try:
+            return parts[1], int(parts[2][:-len(".bin")])
+        except ValueError:
+            return None, None
+
+    def _parse_range(self, total_size):
+        header = self.headers.get("Range")
+        if not self.server.ranges or not header or not header.startswith("bytes="):
+            return None
+        start_text, _, end_text = header[len("bytes="):].split(",")[0].partition("-")
+        try:
+            if not start_text:
+                start = max(0, total_size - int(end_text))
+                return start, total_size - 1
+            start = int(start_text)
+            end = min(int(end_text), total_size - 1) if end_text else total_size - 1
+        except ValueError:
+            return None
+        return (start, end) if start <= end else False
+
+    def _serve(self, send_body):
+        trial_id, total_size = self._parse_path()
+        if trial_id is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        stats = self.server.trial(trial_id)
+        with self.server._lock:
+            stats.requests += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        byte_range = self._parse_range(total_size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{total_size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total_size}")
+        else:
+            start, end = 0, total_size - 1
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if send_body:
+            self._send_body(stats, start, end + 1)
+
+    def _send_body(self, stats, start, end):
+        # 按概率在传输中途的随机位置断开连接
+        drop_at = start + self.server.random_offset(end - start) if self.server.should_drop() else None
+        connection = TokenBucket(self.server.per_connection, burst_seconds=0.1)
+        offset = start
+        while offset < end:
+            size = min(SEND_CHUNK_SIZE, end - offset)
+            if drop_at is not None and offset + size > drop_at:
+                with self.server._lock:
+                    stats.dropped += 1
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            delay = max(self.server.bandwidth.reserve(size), connection.reserve(size))
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(self.server.content.read(offset, size))
+            except OSError:
+                return
+            with self.server._lock:
+                if stats.first_byte_at is None:
+                    stats.first_byte_at = time.time()
+                stats.bytes_sent += size
+            offset += size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线的合成文件HTTP服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 表示自动选择端口")
+    parser.add_argument("--bandwidth", default="0", help="总带宽（字节/秒，可写 50M），0 不限制")
+    parser.add_argument("--per-connection", default="0", help="单连接带宽（字节/秒），0 不限制")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的响应延迟（秒）")
+    parser.add_argument("--no-ranges", action="store_true", help="不支持Range请求")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="每个响应在中途断开的概率")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = SyntheticServer((args.host, args.port), bandwidth=parse_size(args.bandwidth),
+                             per_connection=parse_size(args.per_connection), latency=args.latency,
+                             ranges=not args.no_ranges, fail_rate=args.fail_rate, seed=args.seed)
+    # 第一行输出监听地址，供基准测试脚本读取
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
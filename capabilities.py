@@ -0,0 +1,141 @@
+import os
+import re
+import time
+import shutil
+import platform
+import threading
+import subprocess
+
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# Windows上随插件分发的aria2c
+BUNDLED_ARIA2_DIR = os.path.join(PLUGIN_DIR, "aria2-1.37.0-win-64bit")
+# 运行 aria2c --version 的超时（秒）
+VERSION_TIMEOUT = 5
+
+_VERSION_RE = re.compile(r"^aria2 version (\S+)", re.MULTILINE)
+_FEATURES_RE = re.compile(r"^Enabled Features:\s*(.*)$", re.MULTILINE)
+_HASHES_RE = re.compile(r"^Hash Algorithms:\s*(.*)$", re.MULTILINE)
+
+
+def _search_dirs():
+    """查找aria2c的目录：Windows上先查捆绑目录和插件目录，然后是PATH"""
+    dirs = []
+    if platform.system() == "Windows":
+        dirs += [BUNDLED_ARIA2_DIR, PLUGIN_DIR]
+    dirs += [path for path in os.environ.get("PATH", "").split(os.pathsep) if path]
+    return dirs
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _split_list(text):
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+
+def parse_aria2_version(output):
+    """解析 aria2c --version 的输出，返回 (版本号, 功能列表, 哈希算法列表)"""
+    version = _VERSION_RE.search(output)
+    features = _FEATURES_RE.search(output)
+    hashes = _HASHES_RE.search(output)
+    return (version.group(1) if version else None,
+            _split_list(features.group(1)) if features else [],
+            _split_list(hashes.group(1)) if hashes else [])
+
+
+class CapabilityProbe:
+    """检测可用的下载引擎（aria2c的路径、版本和功能，内置Python引擎），结果缓存到环境变化为止
+
+    检测只在第一次需要时进行，不在插件导入时运行子进程。PATH、查找目录或aria2c文件变化后
+    （例如安装或升级了aria2c）下次调用 get() 时自动重新检测，也可以用 refresh=True 强制重新检测。
+    """
+
+    def __init__(self):
+        self._result = None
+        self._key = None
+        self._lock = threading.Lock()
+
+    def _cache_key(self):
+        dirs = _search_dirs()
+        key = [os.environ.get("PATH", "")] + [_mtime(path) for path in dirs]
+        if self._result and self._result["aria2c"]["path"]:
+            key.append(_mtime(self._result["aria2c"]["path"]))
+        return tuple(key)
+
+    def get(self, refresh=False):
+        """返回检测结果；多个线程同时调用时只检测一次"""
+        with self._lock:
+            if refresh or self._result is None or self._cache_key() != self._key:
+                self._result = self._probe()
+                self._key = self._cache_key()
+            return self._result
+
+    def cached(self):
+        """已有的检测结果，尚未检测时返回None"""
+        return self._result
+
+    def invalidate(self):
+        with self._lock:
+            self._result = None
+
+    def _probe(self):
+        started = time.monotonic()
+        result = {
+            "platform": platform.system(),
+            "aria2c": self._probe_aria2c(),
+            "python": self._probe_python(),
+            "probed_at": time.time(),
+        }
+        result["probe_seconds"] = round(time.monotonic() - started, 3)
+        return result
+
+    def _probe_aria2c(self):
+        info = {"available": False, "path": None, "version": None, "features": [], "hash_algorithms": [],
+                "error": None}
+        path = shutil.which("aria2c", path=os.pathsep.join(_search_dirs()))
+        if not path:
+            print("未找到aria2c，将使用内置的Python多连接下载引擎。如需安装aria2c：")
+            if platform.system() == "Linux":
+                print("Linux: 使用包管理器安装，如 'sudo apt install aria2'")
+            elif platform.system() == "Darwin":
+                print("macOS: 使用Homebrew安装，'brew install aria2'")
+            return info
+        info["path"] = path
+        try:
+            result = subprocess.run([path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True, timeout=VERSION_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            info["error"] = str(e)
+            print(f"检查aria2c时出错: {str(e)}")
+            return info
+        if result.returncode != 0:
+            info["error"] = f"aria2c --version 返回 {result.returncode}"
+            print(f"检查aria2c时出错: {info['error']}")
+            return info
+        info["version"], info["features"], info["hash_algorithms"] = parse_aria2_version(result.stdout)
+        info["available"] = True
+        return info
+
+    def _probe_python(self):
+        try:
+            import aiohttp
+        except ImportError as e:
+            return {"available": False, "aiohttp": None, "error": str(e)}
+        return {"available": True, "aiohttp": getattr(aiohttp, "__version__", None), "error": None}
+
+
+def aria2c_supports(info, url):
+    """aria2c能否下载该地址：没有HTTPS功能的构建无法下载https地址"""
+    if not info["available"]:
+        return False
+    if url.lower().startswith("https://") and info["features"] and "HTTPS" not in info["features"]:
+        return False
+    return True
+
+
+capability_probe = CapabilityProbe()
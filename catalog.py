@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+from .download_queue import DownloadError
+from .integrity import read_safetensors_header
+
+
+SAFETENSORS_EXTENSIONS = (".safetensors", ".sft")
+
+# 按张量名称特征识别常见的模型结构，按顺序匹配，第一个全部命中的规则生效
+ARCHITECTURE_RULES = (
+    ("Flux", ("double_blocks.", "single_blocks.")),
+    ("SD3", ("joint_blocks.",)),
+    ("SDXL", ("model.diffusion_model.input_blocks.", "conditioner.embedders.")),
+    ("SD1.x/SD2.x", ("model.diffusion_model.input_blocks.", "cond_stage_model.")),
+    ("UNet", ("input_blocks.", "output_blocks.")),
+    ("LoRA", ("lora_",)),
+    ("VAE", ("encoder.down.", "decoder.up.")),
+    ("CLIP", ("text_model.encoder.",)),
+    ("T5", ("encoder.block.",)),
+    ("ControlNet", ("control_model.",)),
+)
+
+
+def guess_architecture(names, metadata):
+    """从 __metadata__ 的 modelspec.architecture 或张量名称推断模型结构，无法识别时返回None"""
+    if metadata and metadata.get("modelspec.architecture"):
+        return metadata["modelspec.architecture"]
+    # 在拼接后的名称中查找，比逐个名称匹配快得多
+    joined = "\n".join(names)
+    for architecture, markers in ARCHITECTURE_RULES:
+        if all(marker in joined for marker in markers):
+            return architecture
+    return None
+
+
+def summarize_header(header):
+    """从safetensors头部统计张量数、参数量和各类型的参数量，返回 (摘要, {张量名: [类型, 形状]})
+
+    张量的形状或类型格式无效时抛出ValueError。
+    """
+    metadata = header.get("__metadata__") or {}
+    tensors = {}
+    dtypes = {}
+    parameters = 0
+    for name, info in header.items():
+        if name == "__metadata__" or not isinstance(info, dict):
+            continue
+        shape = info.get("shape") or []
+        if (not isinstance(shape, list)
+                or not all(isinstance(size, int) and not isinstance(size, bool) and size >= 0 for size in shape)):
+            raise ValueError(f"张量 '{name}' 的形状无效: {shape!r}")
+        if not isinstance(info.get("dtype"), (str, type(None))):
+            raise ValueError(f"张量 '{name}' 的类型无效: {info.get('dtype')!r}")
+        count = 1
+        for size in shape:
+            count *= size
+        parameters += count
+        dtypes[info.get("dtype")] = dtypes.get(info.get("dtype"), 0) + count
+        tensors[name] = [info.get("dtype"), shape]
+    summary = {
+        "tensor_count": len(tensors),
+        "parameters": parameters,
+        "dtypes": dtypes,
+        "metadata": metadata if isinstance(metadata, dict) else {},
+        "architecture": guess_architecture(tensors, metadata if isinstance(metadata, dict) else {}),
+    }
+    return summary, tensors
+
+
+def _scan_files(root):
+    """递归列出root下的safetensors文件，返回 [(路径, stat)]；跟随符号链接并避免循环"""
+    results = []
+    visited = set()
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            real = os.path.realpath(directory)
+            if real in visited:
+                continue
+            visited.add(real)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(SAFETENSORS_EXTENSIONS):
+                        results.append((os.path.abspath(entry.path), entry.stat()))
+        except OSError:
+            continue
+    return results
+
+
+def _locate(path, roots):
+    """文件所在的模型目录，返回 (目录名, 目录内的相对路径)；不在任何模型目录下时返回 (None, 文件名)"""
+    for model_dir, root in roots.items():
+        root = os.path.abspath(root)
+        if path.startswith(root + os.sep):
+            return model_dir, os.path.relpath(path, root)
+    return None, os.path.basename(path)
+
+
+class ModelCatalog:
+    """模型目录下所有safetensors文件的头部目录，缓存在SQLite数据库中
+
+    只读取每个文件开头的JSON头部（通常几KB到几百KB），记录张量名称、形状、类型、参数量和
+    __metadata__。以 (路径, 大小, mtime) 为缓存键，刷新时只重新读取新增或变化的文件；
+    列出目录只查询数据库，不打开模型文件。张量列表压缩保存，只在查询单个文件时返回。
+    """
+
+    def __init__(self, db_path, ttl=30.0):
+        self.db_path = db_path
+        # 两次扫描目录的最短间隔（秒），期间直接返回数据库中的结果
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._conn = None
+        self._scanned_at = None
+
+    def _db(self):
+        # 调用方需持有 self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS models ("
+                " path TEXT PRIMARY KEY, model_dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER,"
+                " header_size INTEGER, tensor_count INTEGER, parameters INTEGER, dtypes TEXT, metadata TEXT,"
+                " architecture TEXT, tensors BLOB, error TEXT, updated_at REAL)"
+            )
+        return self._conn
+
+    def refresh(self, roots, force=False):
+        """扫描 {目录名: 路径} 下的safetensors文件，增量更新目录，返回本次扫描的统计；
+        距上次扫描不足 ttl 秒且 force 为False时不扫描，返回None"""
+        with self._scan_lock:
+            if not force and self._scanned_at is not None and time.monotonic() - self._scanned_at < self.ttl:
+                return None
+            started = time.monotonic()
+            found = {}
+            for model_dir, root in roots.items():
+                for path, st in _scan_files(root):
+                    found.setdefault(path, (model_dir, os.path.relpath(path, root), st))
+            with self._lock:
+                known = {row[0]: row[1:] for row in
+                         self._db().execute("SELECT path, model_dir, name, size, mtime_ns FROM models")}
+            changed = [path for path, (model_dir, name, st) in found.items()
+                       if known.get(path) != (model_dir, name, st.st_size, st.st_mtime_ns)]
+            # 模型目录外的文件（例如下载到自定义路径）只在文件被删除后移除
+            removed = [path for path in known if path not in found
+                       and (_locate(path, roots)[0] is not None or not os.path.exists(path))]
+            rows = [self._read_entry(path, *found[path]) for path in changed]
+            with self._lock:
+                db = self._db()
+                db.executemany("DELETE FROM models WHERE path = ?", [(path,) for path in removed])
+                db.executemany("INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               rows)
+                db.commit()
+            self._scanned_at = time.monotonic()
+            return {"files": len(found), "updated": len(changed), "removed": len(removed),
+                    "seconds": round(self._scanned_at - started, 3)}
+
+    def update_file(self, path, roots=None):
+        """更新单个文件的记录（例如下载完成后），不是safetensors文件时忽略"""
+        path = os.path.abspath(path)
+        if not path.lower().endswith(SAFETENSORS_EXTENSIONS):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        model_dir, name = _locate(path, roots or {})
+        row = self._read_entry(path, model_dir, name, st)
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            db.commit()
+
+    def _read_entry(self, path, model_dir, name, st):
+        header_size = tensor_count = parameters = architecture = tensors = error = None
+        dtypes, metadata = {}, {}
+        try:
+            header, header_size, _ = read_safetensors_header(path)
+            summary, tensor_map = summarize_header(header)
+            tensor_count, parameters = summary["tensor_count"], summary["parameters"]
+            dtypes, metadata, architecture = summary["dtypes"], summary["metadata"], summary["architecture"]
+            tensors = zlib.compress(json.dumps(tensor_map, separators=(",", ":")).encode("utf-8"))
+        except (OSError, DownloadError) as e:
+            error = str(e)
+        except (TypeError, ValueError) as e:
+            # 头部是有效的JSON但内容格式不对，记为无效文件，不中断整个扫描
+            error = f"safetensors头部格式无效: {str(e)}"
+        return (path, model_dir, name, st.st_size, st.st_mtime_ns, header_size, tensor_count, parameters,
+                json.dumps(dtypes), json.dumps(metadata), architecture, tensors, error, time.time())
+
+    def entries(self, model_dir=None, details=False):
+        """目录中的所有文件（按目录名和文件名排序）；details 为True时包含 __metadata__"""
+        columns = ("path, model_dir, name, size, mtime_ns, header_size, tensor_count, parameters, dtypes,"
+                   " architecture, error" + (", metadata" if details else ""))
+        query = f"SELECT {columns} FROM models"
+        params = ()
+        if model_dir:
+            query += " WHERE model_dir = ?"
+            params = (model_dir,)
+        with self._lock:
+            rows = self._db().execute(query + " ORDER BY model_dir, name", params).fetchall()
+        return [self._row_to_dict(row, details) for row in rows]
+
+    def get(self, path, include_tensors=True):
+        """单个文件的完整记录（包括 __metadata__ 和张量列表），不在目录中时返回None"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT path, model_dir, name, size, mtime_ns, header_size, tensor_count, parameters, dtypes,"
+                " architecture, error, metadata, tensors FROM models WHERE path = ?",
+                (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        entry = self._row_to_dict(row[:12], True)
+        if include_tensors:
+            entry["tensors"] = json.loads(zlib.decompress(row[12]).decode("utf-8")) if row[12] else {}
+        return entry
+
+    @staticmethod
+    def _row_to_dict(row, details):
+        entry = {
+            "path": row[0],
+            "model_dir": row[1],
+            "name": row[2],
+            "size": row[3],
+            "mtime": row[4] / 1e9,
+            "header_size": row[5],
+            "tensor_count": row[6],
+            "parameters": row[7],
+            "dtypes": json.loads(row[8]) if row[8] else {},
+            "architecture": row[9],
+            "error": row[10],
+        }
+        if details:
+            entry["metadata"] = json.loads(row[11]) if row[11] else {}
+        return entry
+
+
+# 全局目录，数据库保存在插件目录下
+model_catalog = ModelCatalog(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_catalog.db"))
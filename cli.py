@@ -0,0 +1,172 @@
+"""命令行批量下载：不启动ComfyUI，按清单并行下载模型，与节点使用同一个下载队列、下载引擎、去重和校验
+
+清单格式与 /model_downloader/prefetch 的 manifest 相同（JSON，安装了PyYAML时也可以是YAML），
+例如 {"https://huggingface.co/.../model.safetensors": {"model_dir": "checkpoints", "sha256": "..."}}。
+已存在的文件跳过。标准输出每行一个JSON事件（与前端收到的事件相同，另有 plan 和 summary），
+日志输出到标准错误。
+
+    python cli.py models.yaml --models-dir /opt/ComfyUI/models --jobs 4
+
+返回码: 0 全部成功，1 有文件下载失败，2 参数或清单错误，3 校验失败，4 磁盘空间不足，130 被中断。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import importlib
+import importlib.util
+
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# 注册插件包时使用的包名，插件模块之间使用相对导入
+PACKAGE = "model_downloader_plugin"
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CHECKSUM = 3
+EXIT_DISK_SPACE = 4
+EXIT_INTERRUPTED = 130
+
+
+def load(name):
+    """导入插件模块（不执行依赖ComfyUI服务器的 __init__.py），见 benchmark/plugin_modules.py"""
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE, os.path.join(PLUGIN_DIR, "__init__.py"), submodule_search_locations=[PLUGIN_DIR])
+        sys.modules[PACKAGE] = importlib.util.module_from_spec(spec)
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def read_manifest(path):
+    """读取清单文件（"-" 为标准输入），.yaml/.yml 需要PyYAML"""
+    text = sys.stdin.read() if path == "-" else open(path, "r", encoding="utf-8").read()
+    if path.lower().endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("读取YAML清单需要安装PyYAML（pip install pyyaml），或改用JSON")
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def default_models_dir():
+    """ComfyUI的models目录：有ComfyUI时取 folder_paths，否则按插件位于 custom_nodes/ 下推算"""
+    try:
+        import folder_paths
+        return folder_paths.models_dir
+    except ImportError:
+        return os.path.abspath(os.path.join(PLUGIN_DIR, "..", "..", "models"))
+
+
+class JsonLinesSink:
+    """把事件逐行写成JSON，多个线程同时写时不交错"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event, data):
+        line = json.dumps(dict(data, event=event), ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+def exit_code(jobs, errors):
+    """按失败原因确定返回码：清单错误优先，其次是校验失败和磁盘空间不足"""
+    if errors:
+        return EXIT_USAGE
+    completed = load("download_queue").STATE_COMPLETED
+    causes = [job.error_cause for job in jobs if job.state != completed]
+    if not causes:
+        return EXIT_OK
+    if "checksum" in causes:
+        return EXIT_CHECKSUM
+    if "disk_space" in causes:
+        return EXIT_DISK_SPACE
+    return EXIT_FAILED
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="按清单并行下载ComfyUI模型（不需要启动ComfyUI）")
+    parser.add_argument("manifest", help="清单文件（JSON或YAML），- 为标准输入")
+    parser.add_argument("--models-dir", default=None, help="ComfyUI的models目录，默认按插件位置推算")
+    parser.add_argument("--jobs", type=int, default=None, help="同时下载的文件数，默认3")
+    parser.add_argument("--threads", type=int, default=0, help="每个文件的连接数，0为自动调整")
+    parser.add_argument("--use-mirror", choices=["yes", "no"], default="no")
+    parser.add_argument("--backend", choices=["rpc", "subprocess", "python"], default=None,
+                        help="下载后端，默认与节点相同（有aria2c时使用RPC）")
+    parser.add_argument("--progress-interval", type=float, default=1.0, help="进度事件的间隔（秒）")
+    parser.add_argument("--dry-run", action="store_true", help="只输出缺失和已存在的文件，不下载")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # 插件模块的日志都用print输出，标准输出只留给JSON事件
+    out, sys.stdout = sys.stdout, sys.stderr
+    sink = JsonLinesSink(out)
+
+    # 这些设置在导入插件模块时读取
+    os.environ["MODEL_DOWNLOADER_RESUME"] = "0"
+    os.environ["MODEL_DOWNLOADER_PROGRESS_INTERVAL"] = str(args.progress_interval)
+    if args.jobs:
+        os.environ["MODEL_DOWNLOADER_MAX_CONCURRENT"] = str(args.jobs)
+    if args.backend:
+        os.environ["MODEL_DOWNLOADER_BACKEND"] = args.backend
+
+    try:
+        manifest = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        sink("error", {"error": f"无法读取清单: {str(e)}"})
+        return EXIT_USAGE
+
+    models_dir = args.models_dir or default_models_dir()
+    if not os.path.isdir(models_dir):
+        sink("error", {"error": f"models目录不存在: {models_dir}（用 --models-dir 指定）"})
+        return EXIT_USAGE
+    load("model_index").model_dir_index.set_base_path(models_dir)
+    load("progress").progress_reporter.set_sinks([sink])
+    prefetch = load("prefetch")
+    aria2_rpc = load("aria2_rpc")
+
+    started = time.monotonic()
+    try:
+        if args.dry_run:
+            missing, present, unresolved = prefetch.prefetch_manager.plan(None, manifest)
+            sink("plan", {"missing": [name for name, _ in missing], "present": present, "unresolved": unresolved})
+            return EXIT_OK
+        group = prefetch.prefetch_manager.start(None, manifest, use_mirror=args.use_mirror, threads=args.threads)
+    except ValueError as e:
+        sink("error", {"error": f"清单无效: {str(e)}"})
+        return EXIT_USAGE
+    sink("plan", {"missing": [job.filename for job in group.jobs] + list(group.errors), "present": group.present,
+                  "unresolved": group.unresolved, "job_ids": [job.job_id for job in group.jobs]})
+
+    download_queue = load("model_downloader").download_queue
+    try:
+        group.wait()
+        # 任务结束后状态回调（任务日志、哈希索引等）仍在工作线程中执行，退出前等它们写完
+        download_queue.wait_idle(timeout=60)
+    except KeyboardInterrupt:
+        for job in group.jobs:
+            job.cancel()
+        download_queue.wait_idle(timeout=10)
+        sink("summary", dict(group.summary(), exit_code=EXIT_INTERRUPTED))
+        return EXIT_INTERRUPTED
+    finally:
+        aria2_rpc.stop_daemon()
+
+    code = exit_code(group.jobs, group.errors)
+    failed = [{"job_id": job.job_id, "path": job.save_path, "cause": job.error_cause, "result": job.result}
+              for job in group.jobs if job.state != load("download_queue").STATE_COMPLETED]
+    sink("summary", dict(group.summary(), failed=failed, seconds=round(time.monotonic() - started, 3),
+                         exit_code=code))
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
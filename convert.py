@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .download_queue import DownloadError, format_size
+from .convert_worker import PICKLE_EXTENSIONS, SAFETENSORS_EXTENSIONS, ConversionError
+from .disk_space import disk_space
+from .integrity import validate_safetensors, read_safetensors_header
+from .metrics import metrics
+
+
+# 节点的 convert 选项：下载完成后转换为safetensors，可同时把float32/float64张量降为fp16或bf16
+CONVERT_MODES = ("none", "safetensors", "safetensors-fp16", "safetensors-bf16")
+_MODE_DTYPES = {"safetensors": None, "safetensors-fp16": "fp16", "safetensors-bf16": "bf16"}
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "convert_worker.py")
+TEMP_SUFFIX = ".converting"
+# 转换子进程算出输出大小后等待父进程预留磁盘空间
+PROCEED = "proceed"
+
+
+def output_path(path, mode):
+    """转换结果的路径：model.ckpt -> model.safetensors，降精度时为 model.fp16.safetensors"""
+    dtype = _MODE_DTYPES[mode]
+    stem = os.path.splitext(path)[0]
+    return f"{stem}.{dtype}.safetensors" if dtype else f"{stem}.safetensors"
+
+
+class ConversionPool:
+    """下载完成后的格式转换，每个转换在单独的子进程中运行，最多同时运行 max_workers 个
+
+    转换不占用下载队列的工作线程，子进程崩溃或内存不足也不影响ComfyUI。同一文件和模式的转换
+    只运行一次，转换结果不比源文件旧时直接复用。默认保留源文件，delete_source 为True时
+    在转换结果通过校验后删除源文件。
+    """
+
+    def __init__(self, max_workers=2, delete_source=False):
+        self.max_workers = max_workers
+        self.delete_source = delete_source
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def is_current(self, path, mode):
+        """转换结果存在且不比源文件旧，或源文件已在转换后删除"""
+        target = output_path(path, mode)
+        if target == path:
+            return True
+        try:
+            source_mtime = os.path.getmtime(path)
+        except OSError:
+            return self.replaced(path, mode) is not None
+        try:
+            return os.path.getmtime(target) >= source_mtime
+        except OSError:
+            return False
+
+    def replaced(self, path, mode):
+        """源文件已被转换结果替换（源文件不存在，转换结果的元数据记录由它转换而来）时返回转换结果的路径"""
+        target = output_path(path, mode)
+        if target == path or os.path.exists(path):
+            return None
+        try:
+            metadata = read_safetensors_header(target)[0].get("__metadata__")
+        except (OSError, DownloadError):
+            return None
+        if isinstance(metadata, dict) and metadata.get("converted_from") == os.path.basename(path):
+            return target
+        return None
+
+    def submit(self, path, mode):
+        """开始转换并返回Future，结果为转换结果的说明，失败时抛出ConversionError
+
+        同一转换正在进行或已经成功时返回同一个Future。
+        """
+        key = (os.path.abspath(path), mode)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and (not future.done()
+                                       or (future.exception() is None and self.is_current(path, mode))):
+                return future
+            if self._executor is None:
+                # 第一次需要转换时才创建线程池；线程只负责等待转换子进程
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="model-downloader-convert")
+            future = self._executor.submit(self._convert, path, mode)
+            future.add_done_callback(lambda done: _log_failure(path, done))
+            self._futures[key] = future
+            return future
+
+    def _convert(self, path, mode):
+        target = output_path(path, mode)
+        if target == path:
+            return "已是safetensors格式，无需转换"
+        if self.is_current(path, mode):
+            return f"已转换: {os.path.basename(target)}"
+        if not path.lower().endswith(PICKLE_EXTENSIONS + SAFETENSORS_EXTENSIONS):
+            raise ConversionError(f"不支持转换的文件类型: {os.path.basename(path)}")
+
+        temp_path = target + TEMP_SUFFIX
+        dtype = _MODE_DTYPES[mode]
+        cmd = [sys.executable, WORKER_SCRIPT, path, temp_path, "--wait-for-space"]
+        if dtype:
+            cmd += ["--dtype", dtype]
+        print(f"开始转换: {path} -> {target}")
+        started = time.monotonic()
+        reservation = None
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True)
+        try:
+            # 子进程先输出转换结果的大小（按张量字节数计算，共享存储的pickle转换后可能比源文件大），
+            # 预留磁盘空间后才开始写入
+            line = process.stdout.readline()
+            if line:
+                try:
+                    planned_size = json.loads(line)["planned_size"]
+                except (ValueError, KeyError, TypeError):
+                    raise ConversionError(f"转换进程输出无效: {line.strip()}")
+                reservation = disk_space.reserve(temp_path, planned_size)
+                process.stdin.write(PROCEED + "\n")
+                process.stdin.flush()
+            stdout, stderr = process.communicate()
+            if process.returncode != 0:
+                lines = stderr.strip().splitlines()
+                raise ConversionError(f"转换失败: {lines[-1] if lines else f'返回码 {process.returncode}'}")
+            summary = json.loads(stdout.strip().splitlines()[-1])
+            validate_safetensors(temp_path)
+            os.replace(temp_path, target)
+        except DownloadError as e:
+            _stop(process)
+            _remove(temp_path)
+            raise ConversionError(str(e))
+        except BaseException:
+            _stop(process)
+            _remove(temp_path)
+            raise
+        finally:
+            if reservation is not None:
+                disk_space.release(reservation)
+            metrics.observe("model_downloader_postprocess_seconds", time.monotonic() - started, stage="convert")
+        if self.delete_source:
+            # 转换结果已通过校验，按设置删除源文件，节省空间并避免在模型列表中重复出现
+            _remove(path)
+        print(f"转换完成 ({summary['tensors']} 个张量, {time.monotonic() - started:.1f}s): {target}")
+        kept = "，已删除源文件" if self.delete_source else ""
+        return (f"已转换为 {os.path.basename(target)} ({summary['tensors']} 个张量, "
+                f"{format_size(summary['size'])}{kept})")
+
+
+def _log_failure(path, future):
+    # 下载完成后在后台开始的转换没有调用方等待结果，失败信息输出到控制台
+    if future.exception() is not None:
+        print(f"转换 {path} 失败: {str(future.exception())}")
+
+
+def _stop(process):
+    if process.poll() is None:
+        process.kill()
+        process.communicate()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# MODEL_DOWNLOADER_CONVERT_DELETE_SOURCE=1 时转换成功后删除源文件（默认保留）
+conversion_pool = ConversionPool(max_workers=max(1, int(os.environ.get("MODEL_DOWNLOADER_CONVERT_WORKERS", "2"))),
+                                 delete_source=os.environ.get("MODEL_DOWNLOADER_CONVERT_DELETE_SOURCE", "0")
+                                 in ("1", "true", "yes"))
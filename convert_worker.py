@@ -0,0 +1,172 @@
+"""在独立进程中把下载的模型文件转换为safetensors，由 convert.py 的转换池调用
+
+源文件通过内存映射读取，逐个张量转换精度并写出，峰值内存约为一个张量的大小。
+pickle（.ckpt/.pt/.pth/.bin）只用 weights_only 方式加载，不执行文件中的任意代码。
+
+单独运行: python convert_worker.py <源文件> <目标文件> [--dtype fp16|bf16] [--wait-for-space]
+成功时在标准输出打印一行JSON结果，失败时返回码非0，错误信息输出到标准错误。
+--wait-for-space 时先打印一行 {"planned_size": 输出字节数}，从标准输入读到 proceed 后才开始写入，
+父进程在此期间预留磁盘空间。
+"""
+import os
+import sys
+import json
+import struct
+import argparse
+
+
+PICKLE_EXTENSIONS = (".ckpt", ".pt", ".pth", ".bin")
+SAFETENSORS_EXTENSIONS = (".safetensors", ".sft")
+# safetensors 头部按8字节对齐，数据区的张量从对齐的位置开始
+HEADER_ALIGNMENT = 8
+
+
+class ConversionError(Exception):
+    """模型文件无法转换"""
+
+
+def _dtype_codes(torch):
+    codes = {
+        torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+        torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8", torch.uint8: "U8",
+        torch.bool: "BOOL",
+    }
+    for name, code in (("float8_e4m3fn", "F8_E4M3"), ("float8_e5m2", "F8_E5M2")):
+        if hasattr(torch, name):
+            codes[getattr(torch, name)] = code
+    return codes
+
+
+def _load_pickle(path, torch):
+    """以内存映射方式加载pickle中的state_dict，返回 ([(名称, 类型, 形状, 读取函数)], 跳过的非张量条目数)"""
+    try:
+        try:
+            data = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except TypeError:
+            # 旧版PyTorch不支持mmap参数，只能整个加载到内存
+            print("当前PyTorch不支持内存映射加载，整个文件将读入内存", file=sys.stderr)
+            data = torch.load(path, map_location="cpu", weights_only=True)
+        except RuntimeError as e:
+            if "mmap" not in str(e):
+                raise
+            # 旧的非zip格式不支持内存映射
+            print("文件为旧格式，不支持内存映射，整个文件将读入内存", file=sys.stderr)
+            data = torch.load(path, map_location="cpu", weights_only=True)
+    except Exception as e:
+        raise ConversionError(f"无法安全加载pickle（只允许张量数据）: {str(e)}")
+    # 训练检查点通常把权重放在 state_dict 下，其余是步数等元数据
+    if isinstance(data, dict) and isinstance(data.get("state_dict"), dict):
+        data = data["state_dict"]
+    if not isinstance(data, dict):
+        raise ConversionError(f"文件内容不是state_dict: {type(data).__name__}")
+    tensors = {str(name): value for name, value in data.items() if isinstance(value, torch.Tensor)}
+    return [(name, tensor.dtype, tuple(tensor.shape), (lambda tensor=tensor: tensor))
+            for name, tensor in tensors.items()], len(data) - len(tensors)
+
+
+def _load_safetensors(path, torch):
+    """返回safetensors中各张量的 (名称, 类型, 形状, 读取函数)；张量在写出时才逐个读取"""
+    from safetensors import safe_open
+
+    dtypes = {code: dtype for dtype, code in _dtype_codes(torch).items()}
+    handle = safe_open(path, framework="pt", device="cpu")
+    entries = []
+    for name in handle.keys():
+        tensor_slice = handle.get_slice(name)
+        dtype = dtypes.get(tensor_slice.get_dtype())
+        if dtype is None:
+            raise ConversionError(f"不支持的张量类型 {tensor_slice.get_dtype()}: {name}")
+        entries.append((name, dtype, tuple(tensor_slice.get_shape()),
+                        (lambda name=name: handle.get_tensor(name))))
+    return entries, 0
+
+
+def build_header(tensors, metadata=None):
+    """按 [(名称, 类型代码, 形状, 字节数)] 的顺序排列数据区，返回对齐后的safetensors头部字节"""
+    header = {"__metadata__": metadata} if metadata else {}
+    offset = 0
+    for name, code, shape, num_bytes in tensors:
+        header[name] = {"dtype": code, "shape": list(shape), "data_offsets": [offset, offset + num_bytes]}
+        offset += num_bytes
+    data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return data + b" " * (-len(data) % HEADER_ALIGNMENT)
+
+
+def convert(source, target, dtype=None, on_plan=None):
+    """把source转换为safetensors写到target；dtype 为 fp16/bf16 时把 float32/float64 张量降为该精度
+
+    on_plan(输出字节数) 在开始写入前调用；pickle中共享存储的张量会分别写出，输出可能比源文件大。
+    """
+    import torch
+
+    lower = source.lower()
+    if lower.endswith(PICKLE_EXTENSIONS):
+        entries, skipped = _load_pickle(source, torch)
+    elif lower.endswith(SAFETENSORS_EXTENSIONS):
+        entries, skipped = _load_safetensors(source, torch)
+    else:
+        raise ConversionError(f"不支持转换的文件类型: {os.path.basename(source)}")
+    if not entries:
+        raise ConversionError("文件中没有张量")
+
+    codes = _dtype_codes(torch)
+    target_dtype = {None: None, "fp16": torch.float16, "bf16": torch.bfloat16}[dtype]
+    plan = []
+    for name, source_dtype, shape, load in entries:
+        out_dtype = source_dtype
+        if target_dtype is not None and source_dtype in (torch.float32, torch.float64):
+            out_dtype = target_dtype
+        if out_dtype not in codes:
+            raise ConversionError(f"不支持的张量类型 {source_dtype}: {name}")
+        numel = 1
+        for size in shape:
+            numel *= size
+        item_size = torch.empty((), dtype=out_dtype).element_size()
+        plan.append((name, out_dtype, shape, numel * item_size, load))
+
+    metadata = {"format": "pt", "converted_from": os.path.basename(source)}
+    header = build_header([(name, codes[out_dtype], shape, num_bytes)
+                           for name, out_dtype, shape, num_bytes, _ in plan], metadata)
+    if on_plan is not None:
+        on_plan(8 + len(header) + sum(num_bytes for _, _, _, num_bytes, _ in plan))
+    with open(target, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, out_dtype, shape, num_bytes, load in plan:
+            # 每次只有一个张量（转换精度后的副本）在内存中
+            tensor = load().to(out_dtype).contiguous()
+            data = tensor.reshape(-1).view(torch.uint8).numpy()
+            if data.nbytes != num_bytes:
+                raise ConversionError(f"张量 {name} 的大小与头部不一致")
+            f.write(memoryview(data))
+            del tensor, data
+    return {"tensors": len(plan), "skipped": skipped, "size": os.path.getsize(target)}
+
+
+def _wait_for_space(planned_size):
+    print(json.dumps({"planned_size": planned_size}), flush=True)
+    if sys.stdin.readline().strip() != "proceed":
+        raise ConversionError("没有预留到磁盘空间，取消转换")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把模型文件转换为safetensors")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--dtype", choices=["fp16", "bf16"], default=None,
+                        help="把float32/float64张量降为该精度，默认保持原精度")
+    parser.add_argument("--wait-for-space", action="store_true",
+                        help="写入前打印输出大小，等待标准输入的 proceed")
+    args = parser.parse_args(argv)
+    try:
+        result = convert(args.source, args.target, args.dtype,
+                         on_plan=_wait_for_space if args.wait_for_space else None)
+    except ConversionError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    print(json.dumps(result), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
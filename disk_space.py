@@ -0,0 +1,113 @@
+import os
+import shutil
+import threading
+
+from .download_queue import DownloadError, format_size
+
+
+# 下载后至少保留的磁盘空间（字节），避免下载占满磁盘导致ComfyUI的其他写入失败
+DEFAULT_MARGIN = 1024 ** 3
+# 等待其他下载释放预留空间时重新检查的间隔（秒），期间其他程序也可能释放空间
+RECHECK_INTERVAL = 5
+
+
+def existing_dir(path):
+    """path或它最近的已存在的上级目录（自定义路径可能尚未创建）"""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def allocated_bytes(path):
+    """文件已占用的磁盘空间（包括预分配的部分），文件不存在时为0"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(st, "st_blocks", None)
+    return blocks * 512 if blocks is not None else st.st_size
+
+
+class Reservation:
+    """一个正在下载的文件预留的空间：文件最终大小减去已经占用的部分"""
+
+    def __init__(self, device, path, size):
+        self.device = device
+        self.path = path
+        self.size = size
+
+    @property
+    def outstanding(self):
+        return max(0, self.size - allocated_bytes(self.path))
+
+
+class DiskSpaceManager:
+    """下载前的磁盘空间准入检查
+
+    按文件系统记录各个正在下载的文件还要占用的空间，新的下载只有在剩余空间减去这些预留和
+    安全余量后仍放得下时才开始，避免并发任务一起把磁盘写满后在接近完成时失败。
+    """
+
+    def __init__(self, margin=DEFAULT_MARGIN):
+        self.margin = margin
+        self._reservations = []
+        self._condition = threading.Condition()
+
+    def usage(self, path):
+        """path所在文件系统的 (剩余空间, 已预留空间)"""
+        directory = existing_dir(path)
+        device = os.stat(directory).st_dev
+        with self._condition:
+            reserved = sum(r.outstanding for r in self._reservations if r.device == device)
+        return shutil.disk_usage(directory).free, reserved
+
+    def reserve(self, path, size, check_cancelled=None, on_wait=None):
+        """为下载到path（临时文件路径）的size字节预留空间，返回Reservation
+
+        剩余空间连这一个文件都放不下时立即抛出 DownloadError；只是和其他下载的预留加起来放不下时
+        等待，直到其他下载结束（失败或取消的下载会释放空间）或者能确定放不下为止。
+        """
+        directory = existing_dir(os.path.dirname(path))
+        reservation = Reservation(os.stat(directory).st_dev, path, size)
+        waiting = False
+        with self._condition:
+            while True:
+                needed = reservation.outstanding
+                free = shutil.disk_usage(directory).free
+                if needed + self.margin > free:
+                    raise DownloadError(
+                        f"磁盘空间不足: {directory} 还需要 {format_size(needed)}，剩余 {format_size(free)}"
+                        f"（保留 {format_size(self.margin)}）", cause="disk_space")
+                reserved = sum(r.outstanding for r in self._reservations if r.device == reservation.device)
+                if needed + reserved + self.margin <= free:
+                    self._reservations.append(reservation)
+                    return reservation
+                if not waiting:
+                    waiting = True
+                    print(f"磁盘空间不足以同时下载: {directory} 剩余 {format_size(free)}，其他下载还需要 "
+                          f"{format_size(reserved)}，等待其他下载结束")
+                    if on_wait:
+                        on_wait()
+                self._condition.wait(RECHECK_INTERVAL)
+                if check_cancelled:
+                    check_cancelled()
+
+    def release(self, reservation):
+        with self._condition:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+            self._condition.notify_all()
+
+
+def _load_margin():
+    try:
+        return int(os.environ.get("MODEL_DOWNLOADER_DISK_MARGIN", DEFAULT_MARGIN))
+    except ValueError:
+        return DEFAULT_MARGIN
+
+
+disk_space = DiskSpaceManager(_load_margin())
@@ -0,0 +1,484 @@
+import os
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+
+
+# 任务状态
+STATE_QUEUED = "queued"
+STATE_RUNNING = "running"
+STATE_PAUSED = "paused"
+STATE_COMPLETED = "completed"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+
+FINISHED_STATES = (STATE_COMPLETED, STATE_FAILED, STATE_CANCELLED)
+
+
+def format_size(num_bytes):
+    """把字节数格式化为aria2风格的 KiB/MiB/GiB 文本"""
+    size = float(num_bytes)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+
+
+def format_eta(seconds):
+    """把剩余秒数格式化为 1h2m3s 形式"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h{minutes}m{seconds}s"
+    if minutes:
+        return f"{minutes}m{seconds}s"
+    return f"{seconds}s"
+
+
+class DownloadError(Exception):
+    """下载失败，消息即返回给节点的状态文本；cause 为失败原因的分类（如 timeout、checksum），用于统计"""
+
+    def __init__(self, message="", cause="error"):
+        super().__init__(message)
+        self.cause = cause
+
+
+class DownloadCancelled(Exception):
+    """下载任务被取消"""
+
+
+class DownloadJob:
+    """单个下载任务及其状态"""
+
+    def __init__(self, url, save_dir, filename, threads=16, use_mirror="no", priority=0, sha256=None,
+                 job_id=None, convert="none", extract=False):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.url = url
+        self.save_dir = save_dir
+        self.filename = filename
+        self.threads = threads
+        self.use_mirror = use_mirror
+        self.priority = priority
+        # 期望的SHA-256，来自清单或HEAD请求的 X-Linked-Etag
+        self.expected_sha256 = sha256
+        # 下载前HEAD请求得到的上游信息（remote_info.RemoteFileInfo），每个任务只请求一次
+        self.remote = None
+        # 下载完成后的格式转换，见 convert.CONVERT_MODES
+        self.convert = convert
+        # 为True时边下载边把压缩包解压到 save_dir，不保存压缩包本身，见 extract.py
+        self.extract = extract
+
+        self.state = STATE_QUEUED
+        self.progress = 0
+        self.completed_bytes = 0
+        self.total_bytes = 0
+        self.speed_bps = 0
+        self.eta_seconds = None
+        self.speed = ""
+        self.eta = ""
+        self.message = "排队中"
+        self.result = None
+        # 失败原因分类，见 DownloadError.cause
+        self.error_cause = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # 状态版本号，任务每次变化时由所属的下载队列递增，见 DownloadQueue.changes()
+        self.version = 0
+        self._on_change = None
+
+        self.cancel_requested = False
+        self._cancel_callbacks = []
+        self._pause_handler = None
+        self._resume_handler = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def save_path(self):
+        return os.path.join(self.save_dir, self.filename)
+
+    @property
+    def is_finished(self):
+        return self.state in FINISHED_STATES
+
+    def on_cancel(self, callback):
+        """注册取消回调（例如终止aria2c进程），任务已被取消时立即调用"""
+        with self._lock:
+            if not self.cancel_requested:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """请求取消任务"""
+        with self._lock:
+            if self.cancel_requested or self.is_finished:
+                return False
+            self.cancel_requested = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消下载任务 {self.job_id} 时出错: {str(e)}")
+        return True
+
+    def set_pause_handlers(self, pause, resume):
+        """由支持暂停的下载后端注册暂停/恢复的实现"""
+        self._pause_handler = pause
+        self._resume_handler = resume
+
+    def pause(self):
+        if self.state != STATE_RUNNING or self._pause_handler is None:
+            return False
+        self._pause_handler()
+        self.state = STATE_PAUSED
+        self.message = "已暂停"
+        return True
+
+    def resume(self):
+        if self.state != STATE_PAUSED or self._resume_handler is None:
+            return False
+        self._resume_handler()
+        self.state = STATE_RUNNING
+        self.message = "下载中"
+        return True
+
+    def check_cancelled(self):
+        """在下载过程中检查取消请求"""
+        if self.cancel_requested:
+            raise DownloadCancelled(f"下载任务 {self.job_id} 已取消")
+
+    def update_progress(self, completed_bytes, total_bytes, speed_bps):
+        """根据精确的字节数更新进度、速度和剩余时间"""
+        self.completed_bytes = completed_bytes
+        self.total_bytes = total_bytes
+        self.speed_bps = speed_bps
+        if total_bytes > 0:
+            self.progress = int(completed_bytes * 100 / total_bytes)
+        self.speed = f"{format_size(speed_bps)}/s"
+        if speed_bps > 0 and total_bytes > completed_bytes:
+            self.eta_seconds = int((total_bytes - completed_bytes) / speed_bps)
+            self.eta = format_eta(self.eta_seconds)
+        elif total_bytes and completed_bytes >= total_bytes:
+            self.eta_seconds = 0
+            self.eta = "0s"
+        else:
+            self.eta_seconds = None
+            self.eta = "计算中..."
+        self.message = f"下载中: {self.progress}%"
+        self.touch()
+
+    def touch(self):
+        """标记任务状态已变化（更新版本号）"""
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def wait(self, timeout=None):
+        """等待任务结束，返回是否已结束"""
+        return self._done.wait(timeout)
+
+    def _finish(self, state, result):
+        self.state = state
+        self.result = result
+        self.finished_at = time.time()
+        self._done.set()
+
+    def to_dict(self, compact=False):
+        """任务状态；compact 为True时省略格式化好的文本（speed、eta、message、status），只保留数值和结果"""
+        if compact:
+            return {
+                "job_id": self.job_id,
+                "version": self.version,
+                "state": self.state,
+                "priority": self.priority,
+                "completed_bytes": self.completed_bytes,
+                "total_bytes": self.total_bytes,
+                "speed_bps": int(self.speed_bps),
+                "eta_seconds": self.eta_seconds,
+                "result": self.result,
+                "url": self.url,
+                "save_path": self.save_path,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+        return {
+            "job_id": self.job_id,
+            "version": self.version,
+            "state": self.state,
+            "is_downloading": self.state in (STATE_RUNNING, STATE_PAUSED),
+            "priority": self.priority,
+            "progress": self.progress,
+            "completed_bytes": self.completed_bytes,
+            "total_bytes": self.total_bytes,
+            "speed_bps": int(self.speed_bps),
+            "eta_seconds": self.eta_seconds,
+            "speed": self.speed,
+            "eta": self.eta,
+            "message": self.message,
+            "status": self.result or self.message,
+            "url": self.url,
+            "save_path": self.save_path,
+            "threads": self.threads,
+            "convert": self.convert,
+            "extract": self.extract,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class DownloadQueue:
+    """有界工作线程池的下载队列，按优先级（高优先）+ 先进先出调度
+
+    队列维护单调递增的版本号：任务每次变化（包括进度）都获得新的版本号，客户端可以只获取
+    某个版本之后变化的任务（changes()）。已结束的任务最多保留 max_history 个。
+    """
+
+    def __init__(self, runner, max_workers=3, max_history=200):
+        # runner(job) 在工作线程中执行实际下载，成功时返回结果字符串，失败时抛出DownloadError
+        self._runner = runner
+        self._max_workers = max(1, int(max_workers))
+        self.max_history = max(0, int(max_history))
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._workers = 0
+        self._active = 0
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._version = 0
+        self._version_lock = threading.Lock()
+        # 被清理出历史的任务 (版本号, job_id)；更早的删除记录已丢弃，早于 _removed_floor 的客户端需要完整同步
+        self._removed = deque(maxlen=1000)
+        self._removed_floor = 0
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    def set_max_workers(self, max_workers):
+        """调整并发下载数，立即生效"""
+        with self._cond:
+            self._max_workers = max(1, int(max_workers))
+            self._spawn_workers()
+            self._cond.notify_all()
+
+    def add_listener(self, listener):
+        """注册任务状态变化回调 listener(job)"""
+        self._listeners.append(listener)
+
+    @property
+    def version(self):
+        return self._version
+
+    def _next_version(self):
+        with self._version_lock:
+            self._version += 1
+            return self._version
+
+    def _touch(self, job):
+        job.version = self._next_version()
+
+    def _register(self, job):
+        # 调用方需持有 self._cond
+        self._jobs[job.job_id] = job
+        job._on_change = self._touch
+
+    def notify(self, job):
+        self._touch(job)
+        if job.is_finished:
+            self._prune_history()
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"下载状态回调出错: {str(e)}")
+
+    def submit(self, job):
+        """提交任务，返回任务本身"""
+        with self._cond:
+            self._register(job)
+            heapq.heappush(self._heap, (-job.priority, next(self._seq), job))
+            self._spawn_workers()
+            self._cond.notify()
+        self.notify(job)
+        return job
+
+    def add_finished(self, job, result):
+        """登记一个无需下载即已完成的任务（例如文件已存在）"""
+        with self._cond:
+            self._register(job)
+            job.progress = 100
+            job.message = "下载完成"
+            job._finish(STATE_COMPLETED, result)
+        self.notify(job)
+        return job
+
+    def cancel(self, job_id):
+        """取消排队中或正在下载的任务"""
+        job = self.get(job_id)
+        if job is None or not job.cancel():
+            return False
+        with self._cond:
+            if job.state == STATE_QUEUED:
+                # 排队中的任务直接结束，工作线程取出时会跳过
+                job.message = "已取消"
+                job._finish(STATE_CANCELLED, "下载已取消")
+        self.notify(job)
+        return True
+
+    def pause(self, job_id):
+        """暂停正在下载的任务（需要下载后端支持）"""
+        job = self.get(job_id)
+        if job is None or not job.pause():
+            return False
+        self.notify(job)
+        return True
+
+    def resume(self, job_id):
+        """恢复已暂停的任务"""
+        job = self.get(job_id)
+        if job is None or not job.resume():
+            return False
+        self.notify(job)
+        return True
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def find_active(self, save_path):
+        """返回保存到save_path且尚未结束的任务，没有时返回None"""
+        save_path = os.path.abspath(save_path)
+        with self._cond:
+            for job in self._jobs.values():
+                if not job.is_finished and os.path.abspath(job.save_path) == save_path:
+                    return job
+        return None
+
+    def list_jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def wait_idle(self, timeout=None):
+        """等待队列中没有排队和正在运行的任务（包括已结束任务的状态回调都执行完），返回是否已空闲"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            # 已取消的排队任务仍留在堆中，直到被工作线程取出跳过
+            while self._active or any(not job.is_finished for _, _, job in self._heap):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def status(self, job_id=None, compact=False):
+        """返回单个任务或全部任务的状态"""
+        if job_id:
+            job = self.get(job_id)
+            return job.to_dict(compact) if job else None
+        with self._cond:
+            queued = sum(1 for job in self._jobs.values() if job.state == STATE_QUEUED)
+            return {
+                "version": self._version,
+                "max_concurrent": self._max_workers,
+                "active": self._active,
+                "queued": queued,
+                "jobs": [job.to_dict(compact) for job in self._jobs.values()],
+            }
+
+    def changes(self, since, job_ids=None, compact=False):
+        """返回版本 since 之后变化的任务和被清理的任务ID
+
+        since 早于已丢弃的删除记录、或大于当前版本（例如服务重启后）时返回全部任务（"full": True），
+        客户端应以此替换本地状态。
+        """
+        with self._cond:
+            full = since < self._removed_floor or since > self._version
+            jobs = [job for job in self._jobs.values()
+                    if (full or job.version > since) and (not job_ids or job.job_id in job_ids)]
+            removed = [] if full else [job_id for version, job_id in self._removed
+                                       if version > since and (not job_ids or job_id in job_ids)]
+            queued = sum(1 for job in self._jobs.values() if job.state == STATE_QUEUED)
+            return {
+                "version": self._version,
+                "since": since,
+                "full": full,
+                "max_concurrent": self._max_workers,
+                "active": self._active,
+                "queued": queued,
+                "jobs": [job.to_dict(compact) for job in sorted(jobs, key=lambda job: job.version)],
+                "removed": removed,
+            }
+
+    def _prune_history(self):
+        """已结束的任务超过 max_history 个时删除最早结束的任务"""
+        with self._cond:
+            finished = [job for job in self._jobs.values() if job.is_finished]
+            if len(finished) <= self.max_history:
+                return
+            finished.sort(key=lambda job: job.finished_at or 0)
+            for job in finished[:len(finished) - self.max_history]:
+                del self._jobs[job.job_id]
+                job._on_change = None
+                if len(self._removed) == self._removed.maxlen:
+                    self._removed_floor = self._removed[0][0]
+                self._removed.append((self._next_version(), job.job_id))
+
+    def _spawn_workers(self):
+        # 调用方需持有 self._cond
+        while self._workers < self._max_workers and self._workers < len(self._heap) + self._active:
+            self._workers += 1
+            worker = threading.Thread(target=self._worker_loop, name="model-downloader-worker")
+            worker.daemon = True
+            worker.start()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap and self._workers <= self._max_workers:
+                    # 空闲一段时间后退出，避免常驻线程
+                    if not self._cond.wait(timeout=30) and not self._heap:
+                        self._workers -= 1
+                        return
+                if self._workers > self._max_workers:
+                    self._workers -= 1
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                if job.is_finished:
+                    continue
+                job.state = STATE_RUNNING
+                job.started_at = time.time()
+                job.message = "下载中"
+                self._active += 1
+            self.notify(job)
+            self._run(job)
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def _run(self, job):
+        try:
+            job.check_cancelled()
+            result = self._runner(job)
+            job.check_cancelled()
+            job.message = "下载完成"
+            job._finish(STATE_COMPLETED, result)
+        except DownloadCancelled:
+            job.message = "已取消"
+            job._finish(STATE_CANCELLED, "下载已取消")
+        except DownloadError as e:
+            job.message = "下载失败"
+            job.error_cause = e.cause
+            job._finish(STATE_FAILED, str(e))
+        except Exception as e:
+            job.message = "下载出错"
+            job.error_cause = "internal"
+            job._finish(STATE_FAILED, f"下载过程中出错: {str(e)}")
+        self.notify(job)
@@ -0,0 +1,451 @@
+import os
+import json
+import time
+import zlib
+import struct
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from .download_queue import DownloadError, DownloadCancelled
+
+
+# 支持边下载边解压的压缩包类型（扩展名 -> 类型）
+ARCHIVE_TYPES = (
+    (".tar.gz", "tar:gz"), (".tgz", "tar:gz"), (".tar.bz2", "tar:bz2"), (".tar.xz", "tar:xz"),
+    (".tar.zst", "tar:zst"), (".tzst", "tar:zst"), (".tar", "tar:"), (".zip", "zip"),
+)
+READ_CHUNK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = 30
+# 每个zip成员的请求失败后的重试次数
+MEMBER_RETRIES = 3
+TEMP_SUFFIX = ".extracting"
+
+# zip 文件结构（APPNOTE.TXT）
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD64_LOCATOR = struct.Struct("<4sLQL")
+_EOCD64 = struct.Struct("<4sQ2H2L4Q")
+_CENTRAL_ENTRY = struct.Struct("<4s6H3L5H2L")
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+# EOCD 最大长度：22字节的记录加上最长65535字节的注释
+_EOCD_SEARCH = _EOCD.size + 0xFFFF
+
+
+def archive_type(filename):
+    """按扩展名返回压缩包类型（如 "zip"、"tar:gz"），不是支持的压缩包时返回None"""
+    lower = filename.lower()
+    for extension, kind in ARCHIVE_TYPES:
+        if lower.endswith(extension):
+            return kind
+    return None
+
+
+def member_path(dest, name):
+    """压缩包内的路径对应的目标路径；绝对路径、盘符或 .. 会写到dest之外，抛出DownloadError"""
+    name = name.replace("\\", "/")
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts or name.startswith("/") or ".." in parts or ":" in parts[0]:
+        raise DownloadError(f"压缩包中的路径不安全: {name}", cause="archive")
+    return os.path.join(dest, *parts)
+
+
+def _manifest_path(dest, archive_name):
+    return os.path.join(dest, f".{archive_name}.extracted.json")
+
+
+def read_manifest(dest, archive_name):
+    """此前解压的记录；记录的文件都还在且大小未变时返回记录，否则返回None"""
+    try:
+        with open(_manifest_path(dest, archive_name), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for name, size in manifest["files"]:
+            if os.path.getsize(os.path.join(dest, name)) != size:
+                return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return manifest
+
+
+def _write_manifest(dest, archive_name, url, files):
+    path = _manifest_path(dest, archive_name)
+    with open(path + TEMP_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump({"url": url, "files": files, "extracted_at": time.time()}, f, ensure_ascii=False)
+    os.replace(path + TEMP_SUFFIX, path)
+
+
+def _zstd_reader(fileobj):
+    try:
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    except ImportError:
+        pass
+    try:
+        # Python 3.14 起标准库自带zstd
+        from compression import zstd
+        return zstd.ZstdFile(fileobj)
+    except ImportError:
+        raise DownloadError("解压 .tar.zst 需要安装 zstandard（pip install zstandard）", cause="archive")
+
+
+class _ResponseReader:
+    """HTTP响应的只读文件对象：统计收到的字节数、按全局预算限速并检查取消"""
+
+    def __init__(self, response, extractor):
+        self._response = response
+        self._extractor = extractor
+
+    def read(self, size=-1):
+        self._extractor.check_cancelled()
+        if size is None or size < 0:
+            size = READ_CHUNK_SIZE
+        try:
+            data = self._response.read(min(size, READ_CHUNK_SIZE))
+        except (OSError, urllib.error.URLError) as e:
+            raise DownloadError(f"下载过程中连接中断: {str(e)}", cause="connection")
+        self._extractor.received(len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._response.close()
+
+
+class ArchiveExtractor:
+    """边下载边把压缩包解压到目标目录，磁盘上只保留解压出的文件
+
+    tar（包括 gz/bz2/xz/zst 压缩）按顺序流式解压。zip 的文件目录在末尾，先用Range请求读取
+    末尾的中央目录，再并行请求各个成员的数据区间边下边解压；服务器不支持Range时才先把zip
+    完整下载到目标目录下的临时文件再解压。每个文件先写到临时文件名，完整写完后再改名。
+    """
+
+    def __init__(self, urls, dest, archive_name, connections=4, on_progress=None, should_cancel=None,
+                 network_limiter=None, disk_limiter=None, on_plan=None):
+        self.kind = archive_type(archive_name)
+        if self.kind is None:
+            raise DownloadError(f"不支持解压的文件类型: {archive_name}", cause="archive")
+        self.urls = list(urls)
+        self.dest = dest
+        self.archive_name = archive_name
+        self.connections = max(1, connections)
+        self.on_progress = on_progress
+        self.should_cancel = should_cancel
+        self.network_limiter = network_limiter
+        self.disk_limiter = disk_limiter
+        # on_plan(字节数) 在开始写入前调用，用于检查磁盘空间：zip为解压后的总大小，
+        # tar只能提前知道压缩包大小，作为解压后大小的下限
+        self.on_plan = on_plan
+        self.url = None
+        self.total = 0
+        self.completed = 0
+        self.files = []
+        self._started = time.monotonic()
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def check_cancelled(self):
+        if self.should_cancel and self.should_cancel():
+            raise DownloadCancelled("解压已取消")
+        if self._failed:
+            raise DownloadCancelled("其他成员下载失败")
+
+    def received(self, num_bytes):
+        if self.network_limiter is not None:
+            delay = self.network_limiter.reserve(num_bytes)
+            if delay > 0:
+                time.sleep(delay)
+        with self._lock:
+            self.completed += num_bytes
+            completed = self.completed
+        if self.on_progress:
+            elapsed = time.monotonic() - self._started
+            self.on_progress(completed, max(self.total, completed), completed / elapsed if elapsed > 0 else 0)
+
+    def extract(self):
+        """下载并解压，完成后写入解压记录，返回解压出的 [(相对路径, 大小)]"""
+        os.makedirs(self.dest, exist_ok=True)
+        if self.kind == "zip":
+            self._extract_zip()
+        else:
+            self._extract_tar(self.kind.split(":", 1)[1])
+        files = sorted(self.files)
+        _write_manifest(self.dest, self.archive_name, self.urls[0], files)
+        return files
+
+    def _request(self, url, byte_range=None):
+        headers = {"Range": f"bytes={byte_range}"} if byte_range else {}
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            return urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            raise DownloadError(f"请求失败: HTTP {e.code}", cause=f"http_{e.code}")
+        except (urllib.error.URLError, OSError) as e:
+            raise DownloadError(f"无法连接: {str(e)}", cause="connection")
+
+    def _open_first(self, byte_range=None):
+        """依次尝试各个源，返回第一个成功的响应"""
+        last_error = None
+        for url in self.urls:
+            try:
+                response = self._request(url, byte_range)
+            except DownloadError as e:
+                print(f"下载压缩包失败 ({url}): {str(e)}")
+                last_error = e
+                continue
+            # 之后的请求直接使用重定向后的地址
+            self.url = response.geturl()
+            return response
+        raise last_error
+
+    def _write_member(self, name, source, size=None, crc=None):
+        """把一个成员写到目标目录：先写临时文件，校验大小和CRC后改名"""
+        path = member_path(self.dest, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + TEMP_SUFFIX
+        written = 0
+        checksum = 0
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in source:
+                    if self.disk_limiter is not None:
+                        delay = self.disk_limiter.reserve(len(chunk))
+                        if delay > 0:
+                            time.sleep(delay)
+                    f.write(chunk)
+                    written += len(chunk)
+                    if crc is not None:
+                        checksum = zlib.crc32(chunk, checksum)
+            if size is not None and written != size:
+                raise DownloadError(f"{name} 的大小不一致: 预期 {size}，实际 {written}", cause="archive")
+            if crc is not None and checksum != crc:
+                raise DownloadError(f"{name} 的CRC校验失败", cause="checksum")
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.files.append((os.path.relpath(path, self.dest).replace(os.sep, "/"), written))
+
+    # tar
+
+    def _extract_tar(self, compression):
+        response = self._open_first()
+        try:
+            self.total = int(response.headers.get("Content-Length") or 0)
+            if self.on_plan and self.total:
+                self.on_plan(self.total)
+            stream = _ResponseReader(response, self)
+            mode = f"r|{compression}"
+            if compression == "zst":
+                stream, mode = _zstd_reader(stream), "r|"
+            with tarfile.open(fileobj=stream, mode=mode) as tar:
+                for member in tar:
+                    if member.isdir():
+                        os.makedirs(member_path(self.dest, member.name), exist_ok=True)
+                    elif member.isfile():
+                        fileobj = tar.extractfile(member)
+                        self._write_member(member.name, iter(lambda: fileobj.read(READ_CHUNK_SIZE), b""),
+                                           size=member.size)
+                    else:
+                        # 不创建链接和设备文件，避免写到目标目录之外
+                        print(f"跳过压缩包中的非普通文件: {member.name}")
+        except (tarfile.TarError, EOFError, zlib.error) as e:
+            raise DownloadError(f"无法解压tar: {str(e)}", cause="archive")
+        finally:
+            response.close()
+
+    # zip
+
+    def _extract_zip(self):
+        response = self._open_first(f"-{_EOCD_SEARCH}")
+        try:
+            if response.status != 206:
+                # 服务器不支持Range，只能先完整下载
+                return self._extract_zip_staged(response)
+            self.total = int(response.headers.get("Content-Range", "").rsplit("/", 1)[-1])
+            tail = self._read_all(response)
+        finally:
+            response.close()
+        tail_start = self.total - len(tail)
+        cd_offset, cd_size, count = self._find_central_directory(tail, tail_start)
+        if cd_offset >= tail_start:
+            directory = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+        else:
+            response = self._request(self.url, f"{cd_offset}-{cd_offset + cd_size - 1}")
+            with response:
+                directory = self._read_all(response)
+        entries = _parse_central_directory(directory, count)
+
+        # 每个成员的数据区间到下一个成员的本地头（或中央目录）为止
+        entries.sort(key=lambda entry: entry["offset"])
+        for entry, following in zip(entries, entries[1:] + [{"offset": cd_offset}]):
+            entry["end"] = following["offset"]
+        files = [entry for entry in entries if not entry["name"].endswith("/")]
+        for entry in entries:
+            member_path(self.dest, entry["name"])
+        if self.on_plan:
+            self.on_plan(sum(entry["size"] for entry in files))
+        for entry in entries:
+            if entry["name"].endswith("/"):
+                os.makedirs(member_path(self.dest, entry["name"]), exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:
+            futures = [pool.submit(self._fetch_member, entry) for entry in files]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                self._failed = True
+                raise
+
+    def _read_all(self, response):
+        reader = _ResponseReader(response, self)
+        return b"".join(iter(lambda: reader.read(READ_CHUNK_SIZE), b""))
+
+    def _find_central_directory(self, tail, tail_start):
+        index = tail.rfind(b"PK\x05\x06")
+        if index < 0 or index + _EOCD.size > len(tail):
+            raise DownloadError("不是有效的zip文件: 找不到中央目录", cause="archive")
+        _, _, _, _, count, cd_size, cd_offset, _ = _EOCD.unpack_from(tail, index)
+        if count == 0xFFFF or 0xFFFFFFFF in (cd_size, cd_offset):
+            # ZIP64：EOCD前面是ZIP64 EOCD定位记录
+            locator = index - _EOCD64_LOCATOR.size
+            if locator < 0 or tail[locator:locator + 4] != b"PK\x06\x07":
+                raise DownloadError("zip64文件缺少EOCD定位记录", cause="archive")
+            record_offset = _EOCD64_LOCATOR.unpack_from(tail, locator)[2]
+            if record_offset >= tail_start:
+                record = tail[record_offset - tail_start:record_offset - tail_start + _EOCD64.size]
+            else:
+                with self._request(self.url, f"{record_offset}-{record_offset + _EOCD64.size - 1}") as response:
+                    record = self._read_all(response)
+            if len(record) < _EOCD64.size or record[:4] != b"PK\x06\x06":
+                raise DownloadError("zip64 EOCD记录无效", cause="archive")
+            count, cd_size, cd_offset = _EOCD64.unpack_from(record)[7:10]
+        return cd_offset, cd_size, count
+
+    def _fetch_member(self, entry):
+        for attempt in range(MEMBER_RETRIES + 1):
+            self.check_cancelled()
+            try:
+                return self._extract_member(entry)
+            except DownloadError as e:
+                if e.cause not in ("connection", "closed_early") or attempt == MEMBER_RETRIES:
+                    raise
+                print(f"下载 {entry['name']} 出错，重试 ({attempt + 1}/{MEMBER_RETRIES}): {str(e)}")
+
+    def _extract_member(self, entry):
+        response = self._request(self.url, f"{entry['offset']}-{entry['end'] - 1}")
+        with response:
+            if response.status != 206:
+                raise DownloadError("服务器不再支持Range请求", cause="archive")
+            reader = _ResponseReader(response, self)
+            header = _read_exact(reader, _LOCAL_HEADER.size)
+            fields = _LOCAL_HEADER.unpack(header)
+            if fields[0] != b"PK\x03\x04":
+                raise DownloadError(f"{entry['name']} 的本地文件头无效", cause="archive")
+            _read_exact(reader, fields[9] + fields[10])
+            self._write_member(entry["name"], _member_chunks(reader, entry), size=entry["size"], crc=entry["crc"])
+
+    def _extract_zip_staged(self, response):
+        import zipfile
+
+        self.total = int(response.headers.get("Content-Length") or 0)
+        staged = os.path.join(self.dest, f".{os.getpid()}-{threading.get_ident()}.zip{TEMP_SUFFIX}")
+        reader = _ResponseReader(response, self)
+        try:
+            with open(staged, "wb") as f:
+                for chunk in iter(lambda: reader.read(READ_CHUNK_SIZE), b""):
+                    f.write(chunk)
+            with zipfile.ZipFile(staged) as archive:
+                infos = archive.infolist()
+                for info in infos:
+                    member_path(self.dest, info.filename)
+                if self.on_plan:
+                    self.on_plan(sum(info.file_size for info in infos))
+                for info in infos:
+                    if info.is_dir():
+                        os.makedirs(member_path(self.dest, info.filename), exist_ok=True)
+                        continue
+                    with archive.open(info) as source:
+                        self._write_member(info.filename, iter(lambda: source.read(READ_CHUNK_SIZE), b""),
+                                           size=info.file_size)
+        except zipfile.BadZipFile as e:
+            raise DownloadError(f"不是有效的zip文件: {str(e)}", cause="archive")
+        finally:
+            try:
+                os.remove(staged)
+            except OSError:
+                pass
+
+
+def _read_exact(reader, size):
+    parts = []
+    while size > 0:
+        data = reader.read(size)
+        if not data:
+            raise DownloadError("连接提前关闭", cause="closed_early")
+        parts.append(data)
+        size -= len(data)
+    return b"".join(parts)
+
+
+def _member_chunks(reader, entry):
+    """读取成员的压缩数据并按压缩方式解压，逐块返回"""
+    decompressor = zlib.decompressobj(-15) if entry["method"] == 8 else None
+    remaining = entry["compressed_size"]
+    while remaining > 0:
+        data = reader.read(min(remaining, READ_CHUNK_SIZE))
+        if not data:
+            raise DownloadError("连接提前关闭", cause="closed_early")
+        remaining -= len(data)
+        yield decompressor.decompress(data) if decompressor else data
+    if decompressor:
+        yield decompressor.flush()
+
+
+def _parse_central_directory(data, count):
+    entries = []
+    position = 0
+    for _ in range(count):
+        if data[position:position + 4] != b"PK\x01\x02":
+            raise DownloadError("zip中央目录损坏", cause="archive")
+        (_, _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length, comment_length,
+         _, _, _, offset) = _CENTRAL_ENTRY.unpack_from(data, position)
+        position += _CENTRAL_ENTRY.size
+        raw_name = data[position:position + name_length]
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = data[position + name_length:position + name_length + extra_length]
+        position += name_length + extra_length + comment_length
+        size, compressed_size, offset = _apply_zip64_extra(extra, size, compressed_size, offset)
+        if flags & 0x1:
+            raise DownloadError(f"不支持加密的zip成员: {name}", cause="archive")
+        if method not in (0, 8) and not name.endswith("/"):
+            raise DownloadError(f"不支持的zip压缩方式 {method}: {name}", cause="archive")
+        entries.append({"name": name, "method": method, "crc": crc, "size": size,
+                        "compressed_size": compressed_size, "offset": offset})
+    return entries
+
+
+def _apply_zip64_extra(extra, size, compressed_size, offset):
+    """用ZIP64扩展字段（0x0001）替换值为0xFFFFFFFF的大小和偏移"""
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<2H", extra, position)
+        if header_id == 0x0001:
+            values = extra[position + 4:position + 4 + length]
+            index = 0
+            fields = [size, compressed_size, offset]
+            for i, value in enumerate(fields):
+                if value == 0xFFFFFFFF and index + 8 <= len(values):
+                    fields[i] = struct.unpack_from("<Q", values, index)[0]
+                    index += 8
+            return tuple(fields)
+        position += 4 + length
+    return size, compressed_size, offset
+
@@ -0,0 +1,57 @@
+import os
+import uuid
+import shutil
+import platform
+
+
+# Linux 的 FICLONE ioctl，在 btrfs/xfs 等文件系统上做写时复制克隆
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if platform.system() != "Linux":
+        return False
+    import fcntl
+    with open(src, "rb") as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            fcntl.ioctl(fd, _FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    os.unlink(dst)
+    return False
+
+
+def link_or_copy(src, dst):
+    """把已有文件放到dst：优先reflink，其次硬链接，最后复制，返回使用的方式
+
+    先放到同目录下的临时文件再原子替换dst，模型加载器不会看到缺失或写了一半的文件。
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp_path = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        method = _link_or_copy(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        # dst 与 src 是同一文件的硬链接时 os.replace 不做任何事，临时文件仍在
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+    return method
+
+
+def _link_or_copy(src, dst):
+    try:
+        if _reflink(src, dst):
+            return "reflink"
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
@@ -0,0 +1,303 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .download_queue import DownloadJob, STATE_COMPLETED
+from .model_downloader import ModelDownloader, download_queue
+from .model_index import model_dir_index
+from .hash_index import hash_index
+from .extract import read_manifest
+from .metrics import metrics
+from . import remote_info
+
+
+# 检查结果：unchanged 上游未变化，changed 上游已更新（需要重新下载），missing/modified 本地文件已删除或被修改
+# （不检查也不覆盖），gone 上游已不存在，unknown 上游没有可比较的版本信息，error 请求失败
+STATUS_UNCHANGED = "unchanged"
+STATUS_CHANGED = "changed"
+STATUS_MISSING = "missing"
+STATUS_MODIFIED = "modified"
+STATUS_GONE = "gone"
+STATUS_UNKNOWN = "unknown"
+STATUS_ERROR = "error"
+
+DEFAULT_CONNECTIONS = 16
+REQUEST_TIMEOUT = 15
+
+
+def compare(entry, info):
+    """比较记录的版本信息和HEAD响应，返回检查结果"""
+    if info.status == 304:
+        return STATUS_UNCHANGED
+    if info.status in (404, 410):
+        return STATUS_GONE
+    if info.status is None or info.status >= 400:
+        return STATUS_ERROR
+    # 内容哈希最可靠，其次是ETag；只有Last-Modified和大小时两者都一致才算未变化
+    for new, old in ((info.sha256, entry["sha256"]), (info.etag, entry["etag"])):
+        if new and old:
+            return STATUS_UNCHANGED if new == old else STATUS_CHANGED
+    if info.size and entry["size"] and info.size != entry["size"]:
+        return STATUS_CHANGED
+    if info.last_modified and entry["last_modified"]:
+        return STATUS_UNCHANGED if info.last_modified == entry["last_modified"] else STATUS_CHANGED
+    return STATUS_UNKNOWN
+
+
+def _local_state(entry):
+    """本地文件的 (大小, mtime)；解压任务取解压记录文件，文件不存在时返回None"""
+    save_dir, filename = os.path.split(entry["path"])
+    if entry["extract"]:
+        if read_manifest(save_dir, filename) is None:
+            return None
+        path = os.path.join(save_dir, f".{filename}.extracted.json")
+    else:
+        path = entry["path"]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class FreshnessStore:
+    """已下载文件的上游版本信息（SQLite）：ETag、Last-Modified、大小、仓库commit和SHA-256
+
+    每个文件完成下载时记录下载前HEAD请求得到的版本信息，以后用条件HEAD请求（If-None-Match /
+    If-Modified-Since）检查上游是否更新：未变化的文件只需要一次往返，不传输文件内容。
+    """
+
+    COLUMNS = ("path", "url", "use_mirror", "extract", "etag", "last_modified", "size", "commit_hash", "sha256",
+               "local_size", "local_mtime_ns", "recorded_at", "checked_at", "status", "convert")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        # 调用方需持有 self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, url TEXT, use_mirror TEXT, extract INTEGER, etag TEXT, last_modified TEXT,"
+                " size INTEGER, commit_hash TEXT, sha256 TEXT, local_size INTEGER, local_mtime_ns INTEGER,"
+                " recorded_at REAL, checked_at REAL, status TEXT, convert TEXT)"
+            )
+            # 旧版本创建的数据库没有 convert 列
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+            if "convert" not in columns:
+                self._conn.execute("ALTER TABLE files ADD COLUMN convert TEXT")
+        return self._conn
+
+    def record(self, job, info, sha256=None):
+        """记录任务下载的文件对应的上游版本；sha256 为本地文件的哈希（上游不提供时用于比较）"""
+        entry = {"path": os.path.abspath(job.save_path), "extract": bool(job.extract)}
+        local = _local_state(entry)
+        if local is None:
+            return
+        row = (entry["path"], job.url, job.use_mirror, int(entry["extract"]), info.etag, info.last_modified,
+               info.size or None, info.commit, info.sha256 or sha256, local[0], local[1], time.time(), None,
+               STATUS_UNCHANGED, job.convert)
+        with self._lock:
+            db = self._db()
+            db.execute(f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * len(self.COLUMNS))})", row)
+            db.commit()
+
+    def entries(self, prefix=None):
+        """所有记录（路径以prefix开头的），按路径排序"""
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM files"
+        params = ()
+        if prefix:
+            prefix = os.path.abspath(prefix)
+            query += " WHERE path = ? OR substr(path, 1, ?) = ?"
+            params = (prefix, len(prefix) + 1, prefix + os.sep)
+        with self._lock:
+            rows = self._db().execute(query + " ORDER BY path", params).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(self.COLUMNS, row))
+            entry["commit"] = entry.pop("commit_hash")
+            entry["extract"] = bool(entry["extract"])
+            entry["convert"] = entry["convert"] or "none"
+            entries.append(entry)
+        return entries
+
+    def mark_checked(self, results):
+        """保存一次检查的结果；未变化的文件同时更新上游新返回的commit等信息"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            for result in results:
+                info = result.get("info")
+                db.execute("UPDATE files SET checked_at = ?, status = ? WHERE path = ?",
+                           (now, result["status"], result["path"]))
+                if result["status"] == STATUS_UNCHANGED and info is not None and info.status != 304:
+                    db.execute("UPDATE files SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified),"
+                               " commit_hash = COALESCE(?, commit_hash) WHERE path = ?",
+                               (info.etag, info.last_modified, info.commit, result["path"]))
+            db.commit()
+
+
+class FreshnessChecker:
+    """用有界的并发条件HEAD请求检查一批已下载文件的上游是否更新"""
+
+    def __init__(self, store, max_connections=DEFAULT_CONNECTIONS, timeout=REQUEST_TIMEOUT):
+        self.store = store
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+    def check(self, entry):
+        """检查单个文件，返回 {"path", "url", "status", "info", "error"}"""
+        result = {"path": entry["path"], "url": entry["url"], "status": None, "info": None, "error": None}
+        local = _local_state(entry)
+        if local is None:
+            result["status"] = STATUS_MISSING
+        elif local != (entry["local_size"], entry["local_mtime_ns"]):
+            # 下载后在本地被修改过，不覆盖用户的文件
+            result["status"] = STATUS_MODIFIED
+        else:
+            headers = {}
+            if entry["etag"]:
+                headers["If-None-Match"] = f'"{entry["etag"]}"'
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            try:
+                result["info"] = remote_info.head(entry["url"], timeout=self.timeout, headers=headers)
+                result["status"] = compare(entry, result["info"])
+            except Exception as e:
+                result["status"] = STATUS_ERROR
+                result["error"] = str(e)
+        metrics.inc("model_downloader_freshness_checks_total", status=result["status"])
+        return result
+
+    def sweep(self, prefix=None, max_connections=None):
+        """检查路径以prefix开头的所有已记录文件，最多同时发出 max_connections 个请求，返回检查结果列表"""
+        entries = self.store.entries(prefix)
+        if not entries:
+            return []
+        workers = max(1, min(max_connections or self.max_connections, len(entries)))
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model-downloader-freshness") as pool:
+            results = list(pool.map(self.check, entries))
+        self.store.mark_checked(results)
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        print(f"检查了 {len(results)} 个文件的上游版本 ({time.monotonic() - started:.1f}s): "
+              + ", ".join(f"{status} {count}" for status, count in sorted(counts.items())))
+        return results
+
+
+freshness_store = FreshnessStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_freshness.db"))
+freshness_checker = FreshnessChecker(freshness_store,
+                                     max_connections=int(os.environ.get("MODEL_DOWNLOADER_FRESHNESS_CONNECTIONS",
+                                                                        DEFAULT_CONNECTIONS)))
+
+
+def result_to_dict(result):
+    """检查结果的JSON形式"""
+    info = result["info"]
+    return {
+        "path": result["path"],
+        "url": result["url"],
+        "status": result["status"],
+        "error": result["error"],
+        "remote": info.to_dict() if info is not None else None,
+        "job_id": result.get("job_id"),
+    }
+
+
+def update_changed(prefix=None, update=True, max_connections=None, priority=0):
+    """检查已下载文件的上游版本，update 为True时重新下载上游已更新的文件，返回 (检查结果, 下载任务)"""
+    results = freshness_checker.sweep(prefix, max_connections)
+    jobs = []
+    if not update:
+        return results, jobs
+    entries = {entry["path"]: entry for entry in freshness_store.entries(prefix)}
+    for result in results:
+        entry = entries.get(result["path"])
+        if result["status"] != STATUS_CHANGED or entry is None:
+            continue
+        save_dir, filename = os.path.split(entry["path"])
+        # 沿用原任务的解压和转换设置，更新后的文件同样解压或转换
+        job = DownloadJob(entry["url"], save_dir, filename, threads=0, use_mirror=entry["use_mirror"] or "no",
+                          priority=priority, sha256=result["info"].sha256, convert=entry["convert"],
+                          extract=entry["extract"])
+        # 检查时的HEAD响应就是新版本的信息，下载时不再请求
+        job.remote = result["info"]
+        print(f"上游已更新，重新下载 {job.job_id}: {job.url}\n保存到: {job.save_path}")
+        job = ModelDownloader.submit_unique(job, force=True)
+        if entry["convert"] != "none":
+            # 已有的任务可能没有要求转换
+            job.convert = entry["convert"]
+        result["job_id"] = job.job_id
+        jobs.append(job)
+    return results, jobs
+
+
+class ModelUpdateChecker:
+    """检查已下载模型的上游是否更新，只重新下载已更新的文件"""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "model_dir": (["all"] + model_dir_index.names(), ),
+                # no 时只检查，不下载
+                "update": (["yes", "no"], ),
+                "max_connections": ("INT", {
+                    "default": DEFAULT_CONNECTIONS,
+                    "min": 1,
+                    "max": 64,
+                    "step": 1
+                }),
+            },
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("status",)
+    FUNCTION = "check_updates"
+    CATEGORY = "下载"
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return time.time()
+
+    def check_updates(self, model_dir, update, max_connections):
+        prefix = None
+        if model_dir != "all":
+            prefix = model_dir_index.resolve(model_dir)
+            if not prefix:
+                return (f"错误: 无法找到模型目录 '{model_dir}'。", )
+        results, jobs = update_changed(prefix, update == "yes", max_connections)
+        for job in jobs:
+            job.wait()
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        lines = [f"检查完成: 共 {len(results)} 个文件，未变化 {counts.get(STATUS_UNCHANGED, 0)} 个，"
+                 f"已更新 {counts.get(STATUS_CHANGED, 0)} 个"]
+        lines += [f"{job.filename}: {job.result}" for job in jobs]
+        lines += [f"{os.path.basename(result['path'])}: {result['status']}"
+                  + (f" ({result['error']})" if result["error"] else "")
+                  for result in results if result["status"] not in (STATUS_UNCHANGED, STATUS_CHANGED)]
+        return ("\n".join(lines), )
+
+
+def _record_freshness(job):
+    """下载完成后记录文件对应的上游版本"""
+    info = job.remote
+    if job.state != STATE_COMPLETED or info is None or info.status is None or info.status >= 400:
+        return
+    try:
+        freshness_store.record(job, info, sha256=None if job.extract else hash_index.cached_hash(job.save_path))
+    except Exception as e:
+        print(f"记录上游版本信息失败: {str(e)}")
+
+
+download_queue.add_listener(_record_freshness)
@@ -0,0 +1,231 @@
+import os
+import mmap
+import sqlite3
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 模型文件扩展名，扫描时忽略其他文件
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".onnx", ".gguf", ".sft", ".pkl")
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+# 模型目录的扫描结果超过该时间（秒）后在后台重新扫描
+SCAN_INTERVAL = 600
+# 还没有任何扫描结果时，查找最多等待首次扫描的时间（秒）
+SCAN_WAIT = 60
+
+
+def sha256_file(path):
+    """计算文件的SHA-256，使用mmap分块读取（hashlib在大块数据上会释放GIL，可多线程并行）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+                finally:
+                    view.release()
+        except (OSError, ValueError):
+            # 部分文件系统不支持mmap，改用普通分块读取
+            f.seek(0)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashIndex:
+    """本地模型文件的SHA-256索引，缓存在sidecar SQLite数据库中
+
+    以 (path, inode, size, mtime) 作为缓存键，文件未变化时不会重新计算哈希。
+    模型目录在后台线程中扫描（只读取文件大小），查找时只对大小相同的候选文件计算哈希。
+    """
+
+    def __init__(self, db_path, max_workers=None):
+        self.db_path = db_path
+        self.max_workers = max_workers or os.cpu_count() or 4
+        self._lock = threading.Lock()
+        self._conn = None
+        # 最近一次扫描的 (目录, {路径: 大小}, 扫描时间)
+        self._snapshot = None
+        self._scan_lock = threading.Lock()
+        self._scans = {}
+
+    def _db(self):
+        # 调用方需持有 self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        return self._conn
+
+    def _cached(self, path, st):
+        with self._lock:
+            row = self._db().execute(
+                "SELECT sha256 FROM files WHERE path = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_ino, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, sha256, st=None):
+        """记录文件的哈希（例如下载时边下边算得到的哈希）"""
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO files (path, inode, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)",
+                (path, st.st_ino, st.st_size, st.st_mtime_ns, sha256),
+            )
+            db.commit()
+
+    def cached_hash(self, path):
+        """返回缓存中未过期的SHA-256，没有记录或文件已变化时返回None（不计算哈希）"""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return self._cached(path, st)
+
+    def get_hash(self, path):
+        """返回文件的SHA-256，未变化的文件直接读取缓存"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        sha256 = self._cached(path, st)
+        if sha256 is None:
+            sha256 = sha256_file(path)
+            self.record(path, sha256, st)
+        return sha256
+
+    def hash_files(self, paths):
+        """并行计算多个文件的哈希，返回 {path: sha256}"""
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for path, sha256 in zip(paths, pool.map(self._safe_hash, paths)):
+                if sha256:
+                    results[path] = sha256
+        return results
+
+    def _safe_hash(self, path):
+        try:
+            return self.get_hash(path)
+        except OSError as e:
+            print(f"计算文件哈希失败 {path}: {str(e)}")
+            return None
+
+    def find(self, sha256, roots=None, size=0):
+        """返回内容为sha256的本地文件路径，没有时返回None
+
+        先查数据库中已知的文件；找不到且知道文件大小时，对roots的扫描结果中大小相同的
+        文件计算哈希（结果写入数据库，未变化的文件以后不再计算）。
+        """
+        sha256 = sha256.lower()
+        with self._lock:
+            rows = self._db().execute("SELECT path FROM files WHERE sha256 = ?", (sha256,)).fetchall()
+        for (path,) in rows:
+            try:
+                if self._cached(path, os.stat(path)) == sha256:
+                    return path
+            except OSError:
+                continue
+
+        if not roots or not size:
+            # 不知道文件大小时无法筛选候选文件，避免对整个模型目录计算哈希
+            return None
+        for path, file_hash in self.hash_files(self.candidates(roots, size)).items():
+            if file_hash == sha256:
+                return path
+        return None
+
+    def candidates(self, roots, size):
+        """最近一次扫描roots时大小为size的文件，不在调用方遍历目录
+
+        扫描结果过期时在后台重新扫描并先使用旧结果；还没有扫描过这些目录时等待扫描完成。
+        """
+        roots = tuple(roots)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != roots:
+            self.start_scan(roots).join(SCAN_WAIT)
+            snapshot = self._snapshot
+            if snapshot is None or snapshot[0] != roots:
+                return []
+        elif time.monotonic() - snapshot[2] > SCAN_INTERVAL:
+            self.start_scan(roots)
+        return [path for path, file_size in snapshot[1].items() if file_size == size]
+
+    def start_scan(self, roots):
+        """在后台线程中扫描roots，同一组目录已在扫描时不重复开始，返回扫描线程"""
+        roots = tuple(roots)
+        with self._scan_lock:
+            thread = self._scans.get(roots)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._safe_scan, args=(roots,), name="model-downloader-hash-scan",
+                                          daemon=True)
+                self._scans[roots] = thread
+                thread.start()
+            return thread
+
+    def _safe_scan(self, roots):
+        try:
+            self.scan(roots)
+        except Exception as e:
+            print(f"扫描模型目录失败: {str(e)}")
+
+    def scan(self, roots):
+        """记录roots下所有模型文件的大小（只stat，不读取内容），并删除已不存在的文件记录"""
+        started = time.monotonic()
+        sizes = {}
+        for path in _walk_model_files(roots):
+            try:
+                sizes[path] = os.stat(path).st_size
+            except OSError:
+                continue
+        self._snapshot = (tuple(roots), sizes, time.monotonic())
+        removed = self.prune()
+        print(f"已扫描模型目录: {len(sizes)} 个模型文件，删除 {removed} 条失效的哈希记录 "
+              f"({time.monotonic() - started:.1f}s)")
+        return sizes
+
+    def prune(self):
+        """删除已不存在的文件记录"""
+        with self._lock:
+            db = self._db()
+            paths = [row[0] for row in db.execute("SELECT path FROM files")]
+            missing = [(path,) for path in paths if not os.path.exists(path)]
+            db.executemany("DELETE FROM files WHERE path = ?", missing)
+            db.commit()
+        return len(missing)
+
+
+def _walk_model_files(roots):
+    seen = set()
+    visited_dirs = set()
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            # 模型目录常是指向其他存储的符号链接，跟随链接时避免重复或循环遍历
+            real_dir = os.path.realpath(dirpath)
+            if real_dir in visited_dirs:
+                dirnames[:] = []
+                continue
+            visited_dirs.add(real_dir)
+            for filename in filenames:
+                if filename.lower().endswith(MODEL_EXTENSIONS):
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    if path not in seen:
+                        seen.add(path)
+                        yield path
+
+
+# 全局索引，数据库保存在插件目录下
+hash_index = HashIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_hashes.db"))
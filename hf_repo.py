@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import fnmatch
+import urllib.parse
+import urllib.request
+import urllib.error
+
+from .mirrors import host_of, load_mirror_groups, sources_for
+
+
+# 仓库类型对应的URL前缀和API路径
+REPO_TYPES = {"model": ("", "models"), "dataset": ("datasets/", "datasets"), "space": ("spaces/", "spaces")}
+
+_LINK_NEXT_RE = re.compile(r'<([^>]+)>\s*;\s*rel="?next"?')
+
+
+class RepoError(Exception):
+    """列出仓库文件失败"""
+
+
+class RepoRef:
+    """Hugging Face 仓库地址：endpoint、类型、仓库ID、版本和仓库内的子路径"""
+
+    def __init__(self, endpoint, repo_type, repo_id, revision="main", path=""):
+        self.endpoint = endpoint.rstrip("/")
+        self.repo_type = repo_type
+        self.repo_id = repo_id
+        self.revision = revision or "main"
+        self.path = path.strip("/")
+
+    def with_endpoint(self, endpoint):
+        return RepoRef(endpoint, self.repo_type, self.repo_id, self.revision, self.path)
+
+    def tree_url(self):
+        api = REPO_TYPES[self.repo_type][1]
+        revision = urllib.parse.quote(self.revision, safe="")
+        path = f"/{urllib.parse.quote(self.path)}" if self.path else ""
+        return f"{self.endpoint}/api/{api}/{self.repo_id}/tree/{revision}{path}?recursive=true&expand=false"
+
+    def resolve_url(self, file_path):
+        prefix = REPO_TYPES[self.repo_type][0]
+        revision = urllib.parse.quote(self.revision, safe="")
+        return f"{self.endpoint}/{prefix}{self.repo_id}/resolve/{revision}/{urllib.parse.quote(file_path)}"
+
+
+def hub_hosts():
+    """Hugging Face Hub 及其镜像的主机名（包括 HF_ENDPOINT 指定的主机）"""
+    hosts = {"huggingface.co", "hf-mirror.com"}
+    for group in load_mirror_groups():
+        if "huggingface.co" in group:
+            hosts.update(group)
+    if os.environ.get("HF_ENDPOINT"):
+        hosts.add(host_of(os.environ["HF_ENDPOINT"]))
+    return hosts
+
+
+def parse_repo_url(url, revision=None):
+    """把仓库地址解析为RepoRef；单个文件的地址（/resolve/、/blob/）或非Hub地址返回None
+
+    支持 https://huggingface.co/组织/仓库、.../tree/<版本>/<子目录>，以及 datasets/、spaces/ 前缀。
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    if not parts.scheme or host_of(url) not in hub_hosts():
+        return None
+    segments = [urllib.parse.unquote(segment) for segment in parts.path.split("/") if segment]
+    repo_type = "model"
+    if segments and segments[0] in ("datasets", "spaces"):
+        repo_type = segments.pop(0)[:-1]
+    if len(segments) < 2:
+        return None
+    repo_id = "/".join(segments[:2])
+    rest = segments[2:]
+    path = ""
+    if rest:
+        if rest[0] != "tree" or len(rest) < 2:
+            return None
+        revision = revision or rest[1]
+        path = "/".join(rest[2:])
+    return RepoRef(f"{parts.scheme}://{parts.netloc}", repo_type, repo_id, revision, path)
+
+
+def _auth_headers():
+    token = os.environ.get("HF_TOKEN") or os.environ.get("HUGGING_FACE_HUB_TOKEN")
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+def _fetch_tree(url, timeout):
+    """读取tree接口的所有分页，返回条目列表"""
+    entries = []
+    while url:
+        request = urllib.request.Request(url, headers={"Accept": "application/json", **_auth_headers()})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            entries.extend(json.loads(response.read().decode("utf-8")))
+            link = _LINK_NEXT_RE.search(response.headers.get("Link", ""))
+        url = urllib.parse.urljoin(url, link.group(1)) if link else None
+    return entries
+
+
+def list_repo_files(repo, use_mirror="no", timeout=30):
+    """通过Hub API的tree接口列出仓库文件，返回 (实际使用的RepoRef, [{"path", "size", "sha256"}])
+
+    use_mirror 为 yes 时依次尝试等价的镜像站点。
+    """
+    errors = []
+    for tree_url in sources_for(repo.tree_url(), use_mirror):
+        endpoint = "{0.scheme}://{0.netloc}".format(urllib.parse.urlsplit(tree_url))
+        try:
+            entries = _fetch_tree(tree_url, timeout)
+        except urllib.error.HTTPError as e:
+            errors.append(f"{host_of(tree_url)}: HTTP {e.code}")
+            if e.code in (401, 403, 404):
+                # 仓库不存在、版本不存在或需要授权，换镜像也不会成功
+                break
+            continue
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            errors.append(f"{host_of(tree_url)}: {str(e)}")
+            continue
+        files = []
+        for entry in entries:
+            if entry.get("type") != "file":
+                continue
+            lfs = entry.get("lfs") or {}
+            files.append({
+                "path": entry["path"],
+                "size": lfs.get("size") or entry.get("size") or 0,
+                # 只有LFS文件的oid是SHA-256，普通文件的oid是git blob哈希
+                "sha256": lfs.get("oid") or lfs.get("sha256"),
+            })
+        return repo.with_endpoint(endpoint), files
+    raise RepoError(f"无法列出仓库 {repo.repo_id} 的文件: {'; '.join(errors)}")
+
+
+def _patterns(value):
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [pattern.strip() for pattern in value if pattern.strip()]
+    return [pattern.strip() for pattern in re.split(r"[,\n]", value) if pattern.strip()]
+
+
+def filter_files(files, include=None, exclude=None):
+    """按glob过滤文件路径（逗号或换行分隔）；include为空时包含全部文件"""
+    include, exclude = _patterns(include), _patterns(exclude)
+
+    def matches(path, patterns):
+        return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern)
+                   for pattern in patterns)
+
+    return [entry for entry in files
+            if (not include or matches(entry["path"], include)) and not matches(entry["path"], exclude)]
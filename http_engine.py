@@ -0,0 +1,542 @@
+import os
+import re
+import json
+import errno
+import time
+import asyncio
+from collections import deque
+
+import aiohttp
+
+from .download_queue import DownloadError, DownloadCancelled
+
+
+_CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+# 每次落盘的最小数据量，减少小块写入的系统调用次数
+WRITE_BUFFER_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 1024 * 1024
+# 连接数上限（运行中可通过 set_connections 调整）
+MAX_CONNECTIONS = 32
+
+# 断点续传状态文件后缀，记录尚未下载完成的分段
+STATE_SUFFIX = ".mdstate"
+STATE_SAVE_INTERVAL = 2.0
+
+
+def _pwrite(fd, data, offset):
+    """按位置写入，不移动文件指针，各分段直接写到最终位置，无需合并"""
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # Windows没有pwrite；事件循环单线程执行，lseek与write之间不会被其他分段打断
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+def _preallocate(fd, size):
+    """预分配目标文件大小，减少碎片并尽早发现磁盘空间不足"""
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # 部分文件系统（如某些网络文件系统）不支持fallocate
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+def error_cause(error):
+    """把下载异常归类为统计用的原因"""
+    if isinstance(error, DownloadError):
+        return error.cause
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, aiohttp.ClientPayloadError):
+        return "closed_early"
+    if isinstance(error, aiohttp.ClientResponseError):
+        return f"http_{error.status}"
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return "connection"
+    return "error"
+
+
+class Segment:
+    """文件中的一个字节区间 [start, end]"""
+
+    __slots__ = ("start", "end", "retries")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.retries = 0
+
+    @property
+    def remaining(self):
+        return self.end - self.start + 1
+
+
+class Source:
+    """同一文件的一个下载源，记录实时吞吐量用于分配分段"""
+
+    # 连续失败这么多次后不再使用该源（还有其他可用源时）
+    MAX_FAILURES = 3
+
+    def __init__(self, url, prior_rate=None):
+        self.url = url
+        self.final_url = None
+        self.rate = prior_rate
+        self.active = 0
+        self.bytes = 0
+        # 从该源收到的全部字节（包括未完成和重试的分段），用于统计流量
+        self.received = 0
+        self.seconds = 0.0
+        self.latency = None
+        self.failures = 0
+        self.disabled = False
+
+    def observe(self, num_bytes, seconds, latency):
+        """记录一个分段的传输结果，按指数平滑更新吞吐量"""
+        self.bytes += num_bytes
+        self.seconds += seconds
+        self.failures = 0
+        if seconds > 0 and num_bytes > 0:
+            rate = num_bytes / seconds
+            self.rate = rate if self.rate is None else self.rate * 0.7 + rate * 0.3
+        self.latency = latency if self.latency is None else self.latency * 0.7 + latency * 0.3
+
+
+class SegmentedDownloader:
+    """基于asyncio的多连接分段HTTP下载器，在aria2c不可用时使用
+
+    url 可以是同一文件的多个等价地址（镜像），各分段分配给当前最快的源。
+    """
+
+    def __init__(self, url, path, connections=16, segment_size=None, max_retries=5,
+                 on_progress=None, should_cancel=None, headers=None, progress_interval=0.5, resume=True,
+                 source_priors=None, network_limiter=None, disk_limiter=None, on_response=None, on_retry=None):
+        urls = list(url) if isinstance(url, (list, tuple)) else [url]
+        self.url = urls[0]
+        # source_priors: {url: 历史吞吐量}，用于在本次下载开始时给源排序
+        self.sources = [Source(u, (source_priors or {}).get(u)) for u in urls]
+        self.path = path
+        self.connections = max(1, int(connections))
+        self.segment_size = segment_size
+        self.max_retries = max_retries
+        self.on_progress = on_progress
+        self.should_cancel = should_cancel
+        self.headers = dict(headers or {})
+        self.progress_interval = progress_interval
+        self.resume = resume
+        # 限速器提供 reserve(字节数) -> 需要等待的秒数，多个下载可共享同一个限速器
+        self.network_limiter = network_limiter
+        self.disk_limiter = disk_limiter
+        # 统计回调: on_response(url, 响应时间秒数)、on_retry(url, 原因)
+        self.on_response = on_response
+        self.on_retry = on_retry
+        self.state_path = path + STATE_SUFFIX
+
+        self.total_size = 0
+        self.completed = 0
+        self._fd = None
+        self._segments = []
+        self._pending = deque()
+        self._inflight = set()
+        self._session = None
+        self._workers = set()
+        self._loop = None
+        self._running = None
+
+    def download(self):
+        """在当前线程中同步执行下载"""
+        asyncio.run(self.run())
+
+    def pause(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._running.clear)
+
+    def resume(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._running.set)
+
+    def set_connections(self, connections):
+        """调整下载中的连接数，可在任意线程调用；多出的连接在完成当前分段后退出"""
+        connections = max(1, min(MAX_CONNECTIONS, int(connections)))
+        if self._loop is None:
+            self.connections = connections
+        else:
+            self._loop.call_soon_threadsafe(self._apply_connections, connections)
+
+    def _apply_connections(self, connections):
+        self.connections = connections
+        if self._session is not None:
+            self._spawn_workers()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._running = asyncio.Event()
+        self._running.set()
+
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS + 1)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector,
+                                         headers=self.headers) as session:
+            main = asyncio.ensure_future(self._download(session))
+            reporter = asyncio.ensure_future(self._report_progress(main))
+            try:
+                await main
+            except BaseException as e:
+                # 失败或取消时保留已下载的数据和分段状态，下次可以续传
+                self._save_state()
+                if isinstance(e, asyncio.CancelledError):
+                    # 由进度任务在检测到取消请求时中断（包括暂停中或连接卡住的情况）
+                    raise DownloadCancelled("下载任务已取消")
+                raise
+            finally:
+                reporter.cancel()
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+        self._remove_state()
+        self._emit_progress(0)
+
+    async def _download(self, session):
+        # 用 Range: bytes=0-0 探测服务器是否支持分段下载，同时跟随重定向拿到最终地址
+        response, source = await self._probe(session)
+        async with response:
+            final_url = str(response.url)
+            content_range = _CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+            if response.status == 206 and content_range and content_range.group(3) != "*":
+                self.total_size = int(content_range.group(3))
+                source.final_url = final_url
+            else:
+                # 服务器忽略了Range，直接把这次响应作为单连接下载
+                self.total_size = int(response.headers.get("Content-Length") or 0)
+                self._open_file(truncate=True)
+                try:
+                    await self._stream_single(response, source)
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"下载出错，重新开始单连接下载: {str(e)}")
+                    self._notify_retry(source, e)
+                    self.completed = 0
+        if response.status != 206:
+            await self._download_single(session, source, final_url)
+            return
+
+        segments = self._load_state() if self.resume else None
+        if segments is not None:
+            # 从上次中断处继续，只下载尚未完成的分段
+            self._open_file(truncate=False)
+            self.completed = self.total_size - sum(segment.remaining for segment in segments)
+            print(f"从断点继续下载: 已有 {self.completed}/{self.total_size} 字节")
+        else:
+            self._open_file(truncate=True)
+            segments = self._plan_segments()
+        self._segments = segments
+        if self.total_size == 0:
+            return
+
+        self._pending.extend(segments)
+        self._session = session
+        self._spawn_workers()
+        try:
+            # 连接数调整时会新增工作协程，逐个等待直到全部结束
+            while self._workers:
+                done, _ = await asyncio.wait(set(self._workers), return_when=asyncio.FIRST_COMPLETED)
+                for worker in done:
+                    self._workers.discard(worker)
+                    worker.result()
+        finally:
+            self._session = None
+            for worker in self._workers:
+                worker.cancel()
+
+    def _open_file(self, truncate):
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.path, flags, 0o644)
+        _preallocate(self._fd, self.total_size)
+
+    async def _probe(self, session):
+        """依次尝试各个源，返回第一个可用的 (响应, 源)"""
+        last_error, cause = None, "error"
+        for source in self.sources:
+            try:
+                started = time.monotonic()
+                response = await session.get(source.url, headers={"Range": "bytes=0-0"}, allow_redirects=True)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error, cause = str(e), error_cause(e)
+                source.failures += 1
+                continue
+            if response.status >= 400:
+                last_error, cause = f"HTTP {response.status}", f"http_{response.status}"
+                source.failures += 1
+                response.release()
+                continue
+            source.latency = time.monotonic() - started
+            self._notify_response(source, source.latency)
+            return response, source
+        raise DownloadError(f"下载失败: {last_error}", cause=cause)
+
+    def _pick_source(self):
+        """选择下一个分段的源：先让每个源都试一次，之后按 吞吐量/(当前连接数+1) 选最快的"""
+        candidates = [source for source in self.sources if not source.disabled]
+        if not candidates:
+            # 所有源都被禁用时重新启用，交给重试次数决定是否失败
+            for source in self.sources:
+                source.disabled = False
+                source.failures = 0
+            candidates = self.sources
+        untried = [source for source in candidates
+                   if source.rate is None and source.active == 0 and not source.failures]
+        if untried:
+            return untried[0]
+        # 速度未知时优先选择没有出错、连接数少的源
+        return max(candidates, key=lambda source: ((source.rate or 0) / (source.active + 1),
+                                                   -source.failures, -source.active))
+
+    def contiguous_bytes(self):
+        """从文件开头起已连续写入磁盘的字节数（用于边下载边计算哈希）"""
+        if not self._segments:
+            return self.completed if self._fd is not None else 0
+        return min((segment.start for segment in self._segments if segment.remaining > 0),
+                   default=self.total_size)
+
+    def source_stats(self):
+        """各源在本次下载中的统计 [(url, 字节数, 秒数, 延迟)]"""
+        return [(source.url, source.bytes, source.seconds, source.latency) for source in self.sources]
+
+    def _load_state(self):
+        """读取断点续传状态，文件大小不一致或记录的URL不在本次的源中时返回None"""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            # 镜像按主机统计重新排序，续传时排在第一位的源可能与上次不同
+            if (state.get("url") not in [source.url for source in self.sources]
+                    or state.get("total_size") != self.total_size
+                    or os.path.getsize(self.path) != self.total_size):
+                return None
+            return [Segment(start, end) for start, end in state["segments"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_state(self):
+        if not self._segments or not self.total_size:
+            return
+        state = {
+            "url": self.url,
+            "total_size": self.total_size,
+            "segments": [[segment.start, segment.end] for segment in self._segments if segment.remaining > 0],
+        }
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            print(f"保存断点续传状态失败: {str(e)}")
+
+    def _remove_state(self):
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+
+    def _plan_segments(self):
+        segment_size = self.segment_size
+        if not segment_size:
+            # 每个连接约4个分段，便于快的连接多分担，慢的连接少分担
+            segment_size = max(MIN_SEGMENT_SIZE, -(-self.total_size // (self.connections * 4)))
+        return [Segment(start, min(start + segment_size, self.total_size) - 1)
+                for start in range(0, self.total_size, segment_size)]
+
+    def _spawn_workers(self):
+        idle = len(self._pending) + len(self._inflight)
+        while len(self._workers) < self.connections and idle > 0:
+            self._workers.add(asyncio.ensure_future(self._segment_worker(self._session)))
+            idle -= 1
+
+    def _next_segment(self):
+        """取下一个待下载的分段；没有排队的分段时，把正在下载的最大分段后半段拆出来"""
+        if self._pending:
+            return self._pending.popleft()
+        largest = max(self._inflight, key=lambda segment: segment.remaining, default=None)
+        if largest is None or largest.remaining < 2 * MIN_SEGMENT_SIZE:
+            return None
+        middle = largest.start + largest.remaining // 2
+        segment = Segment(middle, largest.end)
+        largest.end = middle - 1
+        self._segments.append(segment)
+        return segment
+
+    async def _segment_worker(self, session):
+        while True:
+            # 连接数调低后多出的工作协程退出
+            if len(self._workers) > self.connections:
+                self._workers.discard(asyncio.current_task())
+                return
+            segment = self._next_segment()
+            if segment is None:
+                return
+            source = self._pick_source()
+            self._inflight.add(segment)
+            try:
+                await self._fetch_segment(session, source, segment)
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                segment.retries += 1
+                source.failures += 1
+                if source.failures >= Source.MAX_FAILURES and len(self.sources) > 1:
+                    source.disabled = True
+                    print(f"下载源 {source.url} 连续出错，暂停使用")
+                if segment.retries > self.max_retries:
+                    raise DownloadError(f"下载失败: 分段 {segment.start}-{segment.end} 重试{self.max_retries}次后仍出错: {str(e)}",
+                                        cause=error_cause(e))
+                print(f"分段 {segment.start}-{segment.end} 下载出错，第{segment.retries}次重试: {str(e)}")
+                self._notify_retry(source, e)
+                self._inflight.discard(segment)
+                await asyncio.sleep(min(2 ** segment.retries, 30))
+                self._pending.append(segment)
+            finally:
+                self._inflight.discard(segment)
+
+    async def _fetch_segment(self, session, source, segment):
+        headers = {"Range": f"bytes={segment.start}-{segment.end}"}
+        start_offset = segment.start
+        started = time.monotonic()
+        source.active += 1
+        try:
+            # 第一次请求某个源时跟随重定向，之后直接请求最终地址
+            async with session.get(source.final_url or source.url, headers=headers) as response:
+                if response.status != 206:
+                    raise DownloadError(f"分段请求返回 HTTP {response.status}", cause=f"http_{response.status}")
+                content_range = _CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+                if content_range and content_range.group(3) not in ("*", str(self.total_size)):
+                    # 镜像上的文件与其他源不一致，不能混用
+                    source.disabled = True
+                    raise DownloadError(f"下载源 {source.url} 的文件大小不一致", cause="size_mismatch")
+                source.final_url = str(response.url)
+                latency = time.monotonic() - started
+                self._notify_response(source, latency)
+                await self._write_stream(response, source, segment)
+        finally:
+            source.active -= 1
+        source.observe(segment.start - start_offset, time.monotonic() - started, latency)
+        if segment.remaining > 0:
+            raise DownloadError("连接提前关闭", cause="closed_early")
+
+    async def _write_stream(self, response, source, segment=None):
+        # segment 为 None 时顺序写入整个文件
+        offset = segment.start if segment else 0
+        buffer = bytearray()
+        try:
+            async for chunk in response.content.iter_any():
+                if not self._running.is_set():
+                    await self._running.wait()
+                self._check_cancelled()
+                source.received += len(chunk)
+                if segment is not None and len(chunk) > segment.remaining - len(buffer):
+                    chunk = chunk[:max(0, segment.remaining - len(buffer))]
+                buffer += chunk
+                await self._throttle(self.network_limiter, len(chunk))
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    await self._throttle(self.disk_limiter, len(buffer))
+                    offset = self._flush(buffer, offset, segment)
+                if segment is not None and segment.remaining - len(buffer) <= 0:
+                    # 分段已完成（或后半段已被拆给其他连接），不再读取剩余数据
+                    break
+            if buffer:
+                await self._throttle(self.disk_limiter, len(buffer))
+        finally:
+            # 连接中断时也写入已收到的数据，分段重试时从断点继续
+            if buffer:
+                self._flush(buffer, offset, segment)
+
+    async def _throttle(self, limiter, num_bytes):
+        if limiter is not None:
+            delay = limiter.reserve(num_bytes)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def _flush(self, buffer, offset, segment):
+        if segment is not None and len(buffer) > segment.remaining:
+            # 缓冲期间分段的后半段被拆给了其他连接
+            del buffer[segment.remaining:]
+        _pwrite(self._fd, buffer, offset)
+        written = len(buffer)
+        self.completed += written
+        if segment is not None:
+            segment.start += written
+        del buffer[:]
+        return offset + written
+
+    async def _download_single(self, session, source, url):
+        for attempt in range(self.max_retries + 1):
+            try:
+                started = time.monotonic()
+                async with session.get(url) as response:
+                    if response.status >= 400:
+                        raise DownloadError(f"下载失败: HTTP {response.status}", cause=f"http_{response.status}")
+                    self._notify_response(source, time.monotonic() - started)
+                    await self._stream_single(response, source)
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise DownloadError(f"下载失败: {str(e)}", cause=error_cause(e))
+                print(f"下载出错，第{attempt + 1}次重试: {str(e)}")
+                self._notify_retry(source, e)
+                self.completed = 0
+                await asyncio.sleep(min(2 ** (attempt + 1), 30))
+
+    async def _stream_single(self, response, source):
+        await self._write_stream(response, source)
+        if self.total_size and self.completed < self.total_size:
+            raise aiohttp.ClientPayloadError(f"连接提前关闭，只收到 {self.completed}/{self.total_size} 字节")
+
+    def _notify_response(self, source, seconds):
+        if self.on_response is not None:
+            self.on_response(source.url, seconds)
+
+    def _notify_retry(self, source, error):
+        if self.on_retry is not None:
+            self.on_retry(source.url, error_cause(error))
+
+    def _check_cancelled(self):
+        if self.should_cancel is not None and self.should_cancel():
+            raise DownloadCancelled("下载任务已取消")
+
+    async def _report_progress(self, main):
+        last_completed = self.completed
+        last_time = time.monotonic()
+        last_saved = last_time
+        speed = 0
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if self.should_cancel is not None and self.should_cancel():
+                main.cancel()
+                return
+            now = time.monotonic()
+            instant = (self.completed - last_completed) / max(now - last_time, 1e-6)
+            # 指数平滑，避免速度显示剧烈跳动
+            speed = instant if speed == 0 else speed * 0.7 + instant * 0.3
+            last_completed, last_time = self.completed, now
+            self._emit_progress(speed)
+            # 定期保存分段状态，进程被强制结束后也能续传
+            if now - last_saved >= STATE_SAVE_INTERVAL:
+                self._save_state()
+                last_saved = now
+
+    def _emit_progress(self, speed):
+        if self.on_progress is not None:
+            self.on_progress(self.completed, self.total_size, speed)
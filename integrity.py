@@ -0,0 +1,189 @@
+import os
+import json
+import struct
+import hashlib
+import threading
+
+from .download_queue import DownloadError
+
+
+# 下载中的文件名后缀，ComfyUI按扩展名扫描模型目录，不会看到未完成的文件
+PARTIAL_SUFFIX = ".part"
+# 各下载后端的断点续传控制文件
+CONTROL_SUFFIXES = (".aria2", ".mdstate")
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+# safetensors 头部的合理上限，超过时视为文件损坏
+MAX_SAFETENSORS_HEADER = 100 * 1024 * 1024
+
+
+def partial_path(save_path):
+    return save_path + PARTIAL_SUFFIX
+
+
+def adopt_legacy_partial(save_path):
+    """旧版本直接下载到最终路径；发现未完成的下载时改名为临时文件名以便续传"""
+    part = partial_path(save_path)
+    if os.path.exists(part) or not os.path.exists(save_path):
+        return
+    controls = [suffix for suffix in CONTROL_SUFFIXES if os.path.exists(save_path + suffix)]
+    if not controls:
+        return
+    os.replace(save_path, part)
+    for suffix in controls:
+        os.replace(save_path + suffix, part + suffix)
+    print(f"已将未完成的下载改为临时文件继续: {part}")
+
+
+class PrefixHasher:
+    """边下载边计算SHA-256：后台线程读取文件中已连续写完的前缀并更新哈希
+
+    分段下载时各分段乱序写入，下载引擎通过 set_available() 告知从文件开头起
+    已连续写完的字节数；刚写入的数据通常仍在页缓存中，不需要下载后再读一遍磁盘。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._digest = hashlib.sha256()
+        self._hashed = 0
+        self._available = 0
+        self._reset_requested = False
+        self._error = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="model-downloader-hash")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def hashed_bytes(self):
+        return self._hashed
+
+    def set_available(self, num_bytes):
+        with self._condition:
+            if num_bytes < self._available:
+                # 下载从头重新开始（例如单连接下载重试），已计算的哈希作废
+                self._reset_requested = True
+            self._available = num_bytes
+            self._condition.notify_all()
+
+    def finish(self, total_size):
+        """等待哈希计算到 total_size 字节并返回十六进制摘要"""
+        self.set_available(total_size)
+        with self._condition:
+            while (self._hashed < total_size or self._reset_requested) and self._error is None:
+                self._condition.wait()
+        self.stop()
+        if self._error is not None:
+            raise DownloadError(f"计算文件哈希失败: {str(self._error)}", cause="disk")
+        return self._digest.hexdigest()
+
+    def stop(self):
+        """停止后台线程（下载失败或取消时调用）"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        fd = None
+        try:
+            while True:
+                with self._condition:
+                    while not self._stopped and not self._reset_requested and self._hashed >= self._available:
+                        self._condition.wait()
+                    if self._stopped:
+                        return
+                    if self._reset_requested:
+                        self._digest = hashlib.sha256()
+                        self._hashed = 0
+                        self._reset_requested = False
+                    start, end = self._hashed, min(self._available, self._hashed + READ_CHUNK_SIZE)
+                if fd is None:
+                    fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                data = _pread(fd, end - start, start)
+                if not data:
+                    raise OSError(f"文件比预期短: 在 {start} 字节处结束")
+                with self._condition:
+                    if not self._reset_requested:
+                        self._digest.update(data)
+                        self._hashed = start + len(data)
+                    self._condition.notify_all()
+        except OSError as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+def _pread(fd, size, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def read_safetensors_header(path):
+    """只读取safetensors开头的头部，返回 (头部dict, 头部长度, 文件大小)；头部无效时抛出DownloadError"""
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise DownloadError("safetensors文件不完整: 缺少头部长度", cause="corrupt")
+        header_size = struct.unpack("<Q", prefix)[0]
+        if header_size > MAX_SAFETENSORS_HEADER or 8 + header_size > file_size:
+            raise DownloadError(f"safetensors头部长度无效: {header_size}", cause="corrupt")
+        try:
+            header = json.loads(f.read(header_size).decode("utf-8"))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise DownloadError(f"safetensors头部不是有效的JSON: {str(e)}", cause="corrupt")
+    if not isinstance(header, dict):
+        raise DownloadError("safetensors头部格式无效", cause="corrupt")
+    return header, header_size, file_size
+
+
+def validate_safetensors(path):
+    """检查safetensors头部：长度合理、JSON可解析、所有张量的数据区间都在文件内且恰好覆盖数据区"""
+    header, header_size, file_size = read_safetensors_header(path)
+
+    data_size = file_size - 8 - header_size
+    data_end = 0
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        try:
+            begin, end = info["data_offsets"]
+        except (TypeError, KeyError, ValueError):
+            raise DownloadError(f"safetensors张量 '{name}' 缺少data_offsets", cause="corrupt")
+        if not 0 <= begin <= end <= data_size:
+            raise DownloadError(f"safetensors张量 '{name}' 的数据超出文件范围，文件可能被截断", cause="corrupt")
+        data_end = max(data_end, end)
+    if data_end != data_size:
+        raise DownloadError(f"safetensors数据区大小不一致: 头部声明 {data_end} 字节，实际 {data_size} 字节", cause="corrupt")
+    return header
+
+
+def verify_and_publish(part_path, save_path, digest, expected_sha256=None):
+    """校验临时文件（SHA-256、safetensors头部），通过后原子地改名为最终文件
+
+    校验失败时删除临时文件（内容已不可信，不能续传）并抛出DownloadError。
+    """
+    try:
+        if expected_sha256 and digest != expected_sha256.lower():
+            raise DownloadError(f"SHA-256校验失败: 预期 {expected_sha256}，实际 {digest}", cause="checksum")
+        if save_path.lower().endswith((".safetensors", ".sft")):
+            validate_safetensors(part_path)
+    except DownloadError:
+        _remove_partial(part_path)
+        raise
+    os.replace(part_path, save_path)
+
+
+def _remove_partial(part_path):
+    for path in [part_path] + [part_path + suffix for suffix in CONTROL_SUFFIXES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .download_queue import DownloadJob, STATE_QUEUED, STATE_RUNNING, STATE_PAUSED, STATE_COMPLETED
+
+
+# 重启时需要恢复的任务状态
+INTERRUPTED_STATES = (STATE_QUEUED, STATE_RUNNING, STATE_PAUSED)
+
+
+class JobJournal:
+    """持久化的下载任务日志（SQLite），用于重启后恢复中断的任务和识别已完成的文件"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        # 调用方需持有 self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, url TEXT, save_dir TEXT, filename TEXT, threads INTEGER,"
+                " use_mirror TEXT, priority INTEGER, sha256 TEXT, state TEXT, result TEXT,"
+                " size INTEGER, mtime_ns INTEGER, created_at REAL, updated_at REAL, convert TEXT)"
+            )
+            # 旧版本创建的数据库没有 convert 列
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "convert" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN convert TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_path ON jobs (save_dir, filename)")
+        return self._conn
+
+    def update(self, job):
+        """记录任务的最新状态（作为下载队列的状态回调）"""
+        if job.extract:
+            # 解压任务没有可续传的文件，重启后不恢复；是否已解压由目标目录中的解压记录判断
+            return
+        size = mtime_ns = None
+        if job.state == STATE_COMPLETED:
+            try:
+                st = os.stat(job.save_path)
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+            except OSError:
+                pass
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, url, save_dir, filename, threads, use_mirror, priority,"
+                " sha256, state, result, size, mtime_ns, created_at, updated_at, convert)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.job_id, job.url, job.save_dir, job.filename, job.threads, job.use_mirror, job.priority,
+                 job.expected_sha256, job.state, job.result, size, mtime_ns, job.created_at, time.time(),
+                 job.convert),
+            )
+            db.commit()
+
+    def interrupted_jobs(self):
+        """返回上次运行时未完成的任务（重新创建的DownloadJob，保留原job_id）"""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT job_id, url, save_dir, filename, threads, use_mirror, priority, sha256, created_at, convert"
+                " FROM jobs WHERE state IN (?, ?, ?) ORDER BY created_at",
+                INTERRUPTED_STATES,
+            ).fetchall()
+        jobs = []
+        for job_id, url, save_dir, filename, threads, use_mirror, priority, sha256, created_at, convert in rows:
+            job = DownloadJob(url, save_dir, filename, threads=threads, use_mirror=use_mirror,
+                              priority=priority, sha256=sha256, job_id=job_id, convert=convert or "none")
+            job.created_at = created_at
+            jobs.append(job)
+        return jobs
+
+    def completed_unchanged(self, url, save_path):
+        """同一URL已下载到save_path且文件此后未被修改时返回True"""
+        save_dir, filename = os.path.split(save_path)
+        with self._lock:
+            row = self._db().execute(
+                "SELECT size, mtime_ns FROM jobs WHERE url = ? AND save_dir = ? AND filename = ? AND state = ?"
+                " ORDER BY updated_at DESC LIMIT 1",
+                (url, save_dir, filename, STATE_COMPLETED),
+            ).fetchone()
+        if not row or row[0] is None:
+            return False
+        try:
+            st = os.stat(save_path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == tuple(row)
+
+    def prune(self, max_age=30 * 24 * 3600):
+        """删除很久以前结束的任务记录"""
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM jobs WHERE state NOT IN (?, ?, ?) AND updated_at < ?",
+                       (*INTERRUPTED_STATES, time.time() - max_age))
+            db.commit()
+
+
+# 全局任务日志，数据库保存在插件目录下
+job_journal = JobJournal(os.path.join(os.path.dirname(os.path.abspath(__file__)), "download_jobs.db"))
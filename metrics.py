@@ -0,0 +1,152 @@
+import bisect
+import threading
+import time
+
+
+# 秒数类指标的默认分桶
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# 吞吐量（字节/秒）的分桶，1MB/s 到 1GB/s
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(0, 11))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """进程内的计数器和直方图，按Prometheus文本格式输出
+
+    计数器和直方图在事件发生时更新；队列长度这类瞬时值由 add_collector() 注册的
+    回调在抓取时计算。
+    """
+
+    def __init__(self):
+        self._definitions = {}
+        self._values = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._definitions[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=DURATION_BUCKETS):
+        self._definitions[name] = ("histogram", help_text, tuple(sorted(buckets)))
+
+    def add_collector(self, collector):
+        """注册抓取时调用的回调 collector()，返回 [(名称, 类型, 说明, [(标签dict, 值)])]"""
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            counts, total = series.get(key, ([0] * (len(buckets) + 1), 0.0))
+            counts[bisect.bisect_left(buckets, value)] += 1
+            series[key] = (counts, total + value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            values = {name: dict(series) for name, series in self._values.items()}
+        for name, (kind, help_text, buckets) in self._definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(values.get(name, {}).items()):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), counts):
+                    cumulative += count
+                    labels = key + (("le", _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(labels)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"收集下载指标失败: {str(e)}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class TransferMeter:
+    """统计一次下载实际传输的字节：按主机累计字节数，记录首字节时间和平均吞吐量
+
+    下载后端定期调用 update({主机: 累计字节数})。resumed_baseline 为True时第一次 update()
+    的字节数视为续传已有的部分（aria2c只报告包括已有部分在内的完成字节数），不计入流量。
+    """
+
+    def __init__(self, backend, first_byte=True, resumed_baseline=False):
+        self.backend = backend
+        self.started = time.monotonic()
+        self.transferred = 0
+        # 内置引擎自己按请求记录首字节时间
+        self._first_byte = not first_byte
+        self._baseline_pending = resumed_baseline
+        self._reported = {}
+
+    def update(self, host_bytes):
+        if self._baseline_pending:
+            self._baseline_pending = False
+            self._reported = dict(host_bytes)
+            return
+        for host, num_bytes in host_bytes.items():
+            delta = num_bytes - self._reported.get(host, 0)
+            if delta <= 0:
+                # 单连接重试从头下载时累计值会变小，从新的值重新开始计数
+                self._reported[host] = num_bytes
+                continue
+            self._reported[host] = num_bytes
+            self.transferred += delta
+            metrics.inc("model_downloader_bytes_total", delta, host=host)
+            if not self._first_byte:
+                self._first_byte = True
+                metrics.observe("model_downloader_time_to_first_byte_seconds", time.monotonic() - self.started,
+                                host=host, backend=self.backend)
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        if self.transferred > 0 and elapsed > 0:
+            metrics.observe("model_downloader_download_throughput_bytes_per_second",
+                            self.transferred / elapsed, backend=self.backend)
+
+
+metrics = Metrics()
+metrics.counter("model_downloader_bytes_total", "各主机实际下载的字节数")
+metrics.histogram("model_downloader_time_to_first_byte_seconds",
+                  "从发出请求到收到响应的时间（aria2c为从提交任务到收到第一个字节），按主机和下载后端")
+metrics.histogram("model_downloader_download_throughput_bytes_per_second",
+                  "每次下载的平均吞吐量（字节/秒），按下载后端", THROUGHPUT_BUCKETS)
+metrics.counter("model_downloader_retries_total", "内置引擎的分段重试次数，按主机和原因")
+metrics.counter("model_downloader_jobs_total", "已结束的下载任务数，按最终状态")
+metrics.counter("model_downloader_failures_total", "失败的下载任务数，按原因")
+metrics.histogram("model_downloader_postprocess_seconds", "传输完成后的处理时间，按阶段（hash、verify、link、convert）")
+metrics.counter("model_downloader_dedup_hits_total", "无需下载即完成的任务数，按来源（journal、local、shared_cache）")
+metrics.counter("model_downloader_freshness_checks_total", "上游版本检查的文件数，按结果（unchanged、changed 等）")
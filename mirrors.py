@@ -0,0 +1,145 @@
+import os
+import json
+import threading
+import time
+import urllib.parse
+
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 默认的等价主机组：同一组中的主机以相同路径提供相同的文件
+DEFAULT_MIRROR_GROUPS = [
+    ["huggingface.co", "hf-mirror.com"],
+]
+
+# 指数平滑系数，越大越看重最近的下载
+EWMA_ALPHA = 0.3
+
+
+def load_mirror_groups():
+    """读取镜像配置：环境变量 MODEL_DOWNLOADER_MIRRORS（JSON）优先，其次插件目录下的 mirrors.json"""
+    raw = os.environ.get("MODEL_DOWNLOADER_MIRRORS")
+    path = os.path.join(PLUGIN_DIR, "mirrors.json")
+    try:
+        if raw:
+            config = json.loads(raw)
+        elif os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        else:
+            return DEFAULT_MIRROR_GROUPS
+    except (OSError, ValueError) as e:
+        print(f"读取镜像配置失败，使用默认配置: {str(e)}")
+        return DEFAULT_MIRROR_GROUPS
+    groups = config.get("groups") if isinstance(config, dict) else config
+    return [list(group) for group in groups if isinstance(group, list) and len(group) > 1]
+
+
+def host_of(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+class HostStats:
+    """持久化的各主机吞吐量/延迟统计，用于给等价的下载源排序
+
+    吞吐量统一按单个连接计算（两种下载引擎的连接数不同，总速度不可比较）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # 调用方需持有 self._lock
+        if self._stats is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._stats = json.load(f)
+            except (OSError, ValueError):
+                self._stats = {}
+        return self._stats
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._stats, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"保存镜像统计失败: {str(e)}")
+
+    def record(self, host, num_bytes, seconds, latency=None):
+        """记录一次从host下载的结果：num_bytes 为各连接传输的字节数之和，seconds 为各连接用时之和"""
+        if num_bytes <= 0 or seconds <= 0:
+            return
+        throughput = num_bytes / seconds
+        with self._lock:
+            entry = self._load().setdefault(host, {"throughput": throughput, "latency": latency,
+                                                   "samples": 0, "failures": 0})
+            entry["throughput"] = entry["throughput"] * (1 - EWMA_ALPHA) + throughput * EWMA_ALPHA
+            if latency is not None:
+                previous = entry.get("latency")
+                entry["latency"] = latency if previous is None else previous * (1 - EWMA_ALPHA) + latency * EWMA_ALPHA
+            entry["samples"] += 1
+            entry["updated_at"] = time.time()
+            self._save()
+
+    def record_failure(self, host):
+        with self._lock:
+            entry = self._load().setdefault(host, {"throughput": 0, "latency": None, "samples": 0, "failures": 0})
+            entry["failures"] += 1
+            # 失败的主机降低评分，之后仍有机会重新被选中
+            entry["throughput"] *= 0.5
+            entry["updated_at"] = time.time()
+            self._save()
+
+    def score(self, host):
+        """预期吞吐量（字节/秒）；没有统计的主机返回None"""
+        with self._lock:
+            entry = self._load().get(host)
+        if not entry or not entry.get("samples"):
+            return None
+        return entry["throughput"]
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._load()))
+
+    def rank(self, urls):
+        """按预期吞吐量从高到低排序；没有统计的主机排在最前，以便尽快获得统计；
+        只失败过、从未成功下载的主机排在最后（失败次数少的在前）"""
+        with self._lock:
+            stats = self._load()
+            entries = {url: dict(stats.get(host_of(url)) or {}) for url in urls}
+
+        def key(indexed):
+            index, url = indexed
+            entry = entries[url]
+            if entry.get("samples"):
+                return (1, -entry["throughput"], index)
+            if entry.get("failures"):
+                return (2, entry["failures"], index)
+            return (0, 0, index)
+        return [url for _, url in sorted(enumerate(urls), key=key)]
+
+
+def equivalent_urls(url, groups=None):
+    """返回url及其在等价镜像主机上的地址"""
+    parts = urllib.parse.urlsplit(url)
+    host = parts.netloc.lower()
+    for group in groups if groups is not None else load_mirror_groups():
+        if host in group:
+            return [urllib.parse.urlunsplit(parts._replace(netloc=mirror_host)) for mirror_host in
+                    [host] + [h for h in group if h != host]]
+    return [url]
+
+
+def sources_for(url, use_mirror):
+    """下载时使用的源地址列表（按预期速度排序），use_mirror 为 "no" 时只使用原地址"""
+    if use_mirror != "yes":
+        return [url]
+    return host_stats.rank(equivalent_urls(url))
+
+
+host_stats = HostStats(os.path.join(PLUGIN_DIR, "mirror_stats.json"))
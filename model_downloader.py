@@ -1,42 +1,38 @@
 import os
-import sys
+import errno
 import subprocess
-import platform
 import threading
-import json
-import re
 import time
-from pathlib import Path
 
-import folder_paths
-from server import PromptServer
-import numpy as np
+from .download_queue import (DownloadJob, DownloadQueue, DownloadError, DownloadCancelled, STATE_COMPLETED,
+                             STATE_FAILED, STATE_RUNNING, STATE_CANCELLED, format_size)
+from .aria2_rpc import (Aria2RpcError, get_daemon, running_client, contiguous_length,
+                        download_options, command_line, error_cause as aria2_error_cause)
+from .http_engine import SegmentedDownloader, MAX_CONNECTIONS
+from .model_index import model_dir_index
+from .hash_index import hash_index
+from .file_utils import link_or_copy
+from .job_journal import job_journal
+from .progress import progress_reporter, parse_aria2_readout
+from .mirrors import host_of, host_stats, sources_for
+from .autotune import ConnectionTuner, tuning_store
+from .bandwidth import bandwidth_budget
+from .integrity import PARTIAL_SUFFIX, PrefixHasher, adopt_legacy_partial, partial_path, verify_and_publish
+from .shared_cache import shared_cache
+from .hf_repo import RepoError, filter_files, list_repo_files, parse_repo_url
+from .metrics import metrics, TransferMeter
+from .capabilities import capability_probe, aria2c_supports
+from .disk_space import disk_space
+from .convert import CONVERT_MODES, ConversionError, conversion_pool
+from .catalog import model_catalog
+from .extract import ArchiveExtractor, archive_type, read_manifest
+from . import remote_info
 
 class ModelDownloader:
     @classmethod
     def INPUT_TYPES(cls):
-        # 获取ComfyUI模型目录结构
-        model_dirs = {}
-        base_path = folder_paths.models_dir
-        
-        # 遍历models目录下的所有文件夹
-        for item in os.listdir(base_path):
-            item_path = os.path.join(base_path, item)
-            if os.path.isdir(item_path):
-                model_dirs[item] = item_path
-        
-        # 添加自定义节点中的模型目录
-        custom_nodes_path = os.path.join(os.path.dirname(base_path), "custom_nodes")
-        if os.path.exists(custom_nodes_path):
-            for node_dir in os.listdir(custom_nodes_path):
-                node_path = os.path.join(custom_nodes_path, node_dir)
-                if os.path.isdir(node_path):
-                    node_models_path = os.path.join(node_path, "models")
-                    if os.path.exists(node_models_path) and os.path.isdir(node_models_path):
-                        model_dirs[f"custom_nodes/{node_dir}/models"] = node_models_path
-        
-        # 将目录列表转换为ComfyUI下拉菜单格式
-        model_dir_choices = list(model_dirs.keys())
+        # 获取ComfyUI模型目录结构（缓存的目录索引），转换为ComfyUI下拉菜单格式
+        model_dir_choices = model_dir_index.names()
         
         return {
             "required": {
@@ -54,14 +50,33 @@ class ModelDownloader:
                     "multiline": False
                 }),
                 "use_mirror": (["yes", "no"], ),
+                # 0 表示自动调整连接数和分段大小
                 "threads": ("INT", {
-                    "default": 16,
-                    "min": 1,
+                    "default": 0,
+                    "min": 0,
                     "max": 32,
                     "step": 1
                 }),
             },
-            "hidden": {"model_dirs": json.dumps(model_dirs)},
+            # url 为 Hugging Face 仓库地址时下载整个仓库，可指定版本和 glob 过滤（逗号或换行分隔）
+            "optional": {
+                "revision": ("STRING", {
+                    "default": "",
+                    "multiline": False
+                }),
+                "include": ("STRING", {
+                    "default": "",
+                    "multiline": False
+                }),
+                "exclude": ("STRING", {
+                    "default": "",
+                    "multiline": False
+                }),
+                # 下载完成后转换为safetensors（可同时降为fp16/bf16），在后台进程中进行
+                "convert": (list(CONVERT_MODES), ),
+                # URL为压缩包（zip/tar）时边下载边解压到保存目录，不保存压缩包
+                "extract": (["no", "yes"], ),
+            },
         }
 
     RETURN_TYPES = ("STRING",)
@@ -70,210 +85,739 @@ class ModelDownloader:
     CATEGORY = "下载"
     
     @classmethod
-    def IS_CHANGED(cls):
-        # 返回当前时间戳，确保节点状态会更新
+    def IS_CHANGED(cls, url="", model_dir="", custom_path="", subfolder="", convert="none", extract="no",
+                   **kwargs):
+        # 目标文件已存在且经过校验（需要转换时转换结果也已存在，需要解压时解压出的文件都还在）时返回稳定的值，
+        # ComfyUI直接使用缓存的结果，不再执行节点
+        if isinstance(url, str) and url and not parse_repo_url(url):
+            if convert in CONVERT_MODES and convert != "none":
+                # 源文件已被转换结果替换时以转换结果为准
+                replaced = cls.replaced_by_conversion(url, model_dir, custom_path, subfolder, convert)
+                try:
+                    if replaced:
+                        st = os.stat(replaced)
+                        return f"{replaced}:{st.st_size}:{st.st_mtime_ns}"
+                except OSError:
+                    pass
+            verified = cls.verified_target(url, model_dir, custom_path, subfolder, extract=extract == "yes")
+            if verified and convert in CONVERT_MODES and convert != "none":
+                save_dir, filename, _ = cls.resolve_target(url, model_dir, custom_path, subfolder)
+                if not conversion_pool.is_current(os.path.join(save_dir, filename), convert):
+                    verified = None
+            if verified:
+                return verified
+        # 否则返回当前时间戳，每次都执行节点
         return time.time()
 
-    def download_model(self, url, model_dir, custom_path, subfolder, use_mirror, threads, model_dirs=None):
-        # If model_dirs is None, get it from INPUT_TYPES
-        if model_dirs is None:
-            model_dirs = {}
-            base_path = folder_paths.models_dir
-            
-            # 遍历models目录下的所有文件夹
-            for item in os.listdir(base_path):
-                item_path = os.path.join(base_path, item)
-                if os.path.isdir(item_path):
-                    model_dirs[item] = item_path
-            
-            # 添加自定义节点中的模型目录
-            custom_nodes_path = os.path.join(os.path.dirname(base_path), "custom_nodes")
-            if os.path.exists(custom_nodes_path):
-                for node_dir in os.listdir(custom_nodes_path):
-                    node_path = os.path.join(custom_nodes_path, node_dir)
-                    if os.path.isdir(node_path):
-                        node_models_path = os.path.join(node_path, "models")
-                        if os.path.exists(node_models_path) and os.path.isdir(node_models_path):
-                            model_dirs[f"custom_nodes/{node_dir}/models"] = node_models_path
-            model_dirs = json.dumps(model_dirs)
-        # 检查aria2c是否可用
-        aria2c_path = ModelDownloader._get_aria2c_path()
-        if not aria2c_path:
-            return ("错误: 未找到aria2c。请安装aria2c后再试。", )
-        
-        # 处理URL
-        if use_mirror == "yes":
-            url = url.replace("huggingface.co", "hf-mirror.com")
-        
-        # 确定保存路径
+    def download_model(self, url, model_dir, custom_path, subfolder, use_mirror, threads,
+                       revision="", include="", exclude="", convert="none", extract="no"):
+        if parse_repo_url(url):
+            return (ModelDownloader.download_repo(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                                  revision, include, exclude), )
+        if convert in CONVERT_MODES and convert != "none":
+            replaced = ModelDownloader.replaced_by_conversion(url, model_dir, custom_path, subfolder, convert)
+            if replaced:
+                return (f"已转换: {os.path.basename(replaced)}", )
+        
+        job, error = ModelDownloader.create_job(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                                convert=convert, extract=extract == "yes")
+        if error:
+            return (error, )
+        
+        # 提交队列时通常已经开始下载（见 prefetch.start_prompt_downloads），只等待本节点的文件
+        job = ModelDownloader.prompt_job(job) or ModelDownloader.submit_unique(job)
+        job.wait()
+        if convert != "none" and job.state == STATE_COMPLETED:
+            return (f"{job.result}; {ModelDownloader.wait_conversion(job.save_path, convert)}", )
+        
+        # 返回下载结果
+        return (job.result, )
+
+    @classmethod
+    def create_job(cls, url, model_dir, custom_path, subfolder, use_mirror, threads, priority=0,
+                   filename=None, sha256=None, convert="none", extract=False):
+        """校验参数并创建下载任务，返回 (job, 错误信息)
+
+        filename 可以包含子目录（例如工作流中引用的 "SDXL/model.safetensors"），默认取URL的文件名。
+        """
+        # use_mirror 为 yes 时下载阶段会同时使用原地址和等价的镜像地址
+        save_path, filename, error = cls.resolve_target(url, model_dir, custom_path, subfolder, filename)
+        if error:
+            return None, error
+        if convert not in CONVERT_MODES:
+            return None, f"错误: 不支持的转换方式 '{convert}'，可选: {', '.join(CONVERT_MODES)}"
+        if extract and archive_type(filename) is None:
+            return None, f"错误: 只能解压 zip/tar 压缩包（包括 .tar.gz/.tar.bz2/.tar.xz/.tar.zst）: '{filename}'。"
+        if extract and convert != "none":
+            return None, "错误: 解压压缩包时不能同时转换格式。"
+        
+        job = DownloadJob(url, save_path, filename, threads=threads, use_mirror=use_mirror, priority=priority,
+                          sha256=sha256, convert=convert, extract=extract)
+        
+        # 输出日志到控制台
+        threads_text = f"使用 {threads} 个线程下载" if int(threads) > 0 else "自动调整线程数"
+        print(f"下载任务 {job.job_id} 已加入队列: {url}\n保存到: {job.save_path}\n{threads_text}")
+        return job, None
+
+    @classmethod
+    def resolve_target(cls, url, model_dir, custom_path, subfolder, filename=None):
+        """确定保存目录和文件名，返回 (保存目录, 文件名, 错误信息)"""
         if model_dir == "custom":
             if not custom_path:
-                return ("错误: 选择自定义路径时，必须提供有效的路径。", )
+                return None, None, "错误: 选择自定义路径时，必须提供有效的路径。"
             save_path = custom_path
         else:
-            model_dirs_dict = json.loads(model_dirs)
-            save_path = model_dirs_dict.get(model_dir, "")
+            save_path = model_dir_index.resolve(model_dir)
             if not save_path:
-                return (f"错误: 无法找到模型目录 '{model_dir}'。", )
+                return None, None, f"错误: 无法找到模型目录 '{model_dir}'。"
         
         # 如果提供了子文件夹名称，则在保存路径中添加子文件夹
         if subfolder and subfolder.strip():
             save_path = os.path.join(save_path, subfolder.strip())
         
-        # 确保目录存在
-        os.makedirs(save_path, exist_ok=True)
-        
         # 从URL中提取文件名
-        filename = os.path.basename(url)
+        filename = filename or os.path.basename(url)
         if not filename:
-            return ("错误: 无法从URL中提取文件名。", )
+            return None, None, "错误: 无法从URL中提取文件名。"
+        filename_dir, basename = os.path.split(os.path.normpath(filename))
+        if filename_dir.startswith("..") or os.path.isabs(filename_dir):
+            return None, None, f"错误: 文件名不能指向模型目录之外: '{filename}'。"
+        if filename_dir:
+            save_path = os.path.join(save_path, filename_dir)
+        return save_path, basename, None
+    
+    @classmethod
+    def verified_target(cls, url, model_dir, custom_path, subfolder, extract=False):
+        """目标文件已存在且经过校验（本插件下载完成后未被修改，或哈希索引中有未过期的记录）时
+        返回表示文件内容的字符串，否则返回None；只查询缓存，不读取文件内容
+
+        extract 为True时检查压缩包的解压记录：记录的文件都还在且大小未变即视为已校验。
+        """
+        save_dir, filename, error = cls.resolve_target(url, model_dir, custom_path, subfolder)
+        if error:
+            return None
+        save_path = os.path.join(save_dir, filename)
+        if extract:
+            manifest = read_manifest(save_dir, filename)
+            return f"{save_path}:{manifest['extracted_at']}" if manifest else None
+        try:
+            sha256 = hash_index.cached_hash(save_path)
+            if sha256:
+                return sha256
+            if job_journal.completed_unchanged(url, save_path):
+                st = os.stat(save_path)
+                return f"{save_path}:{st.st_size}:{st.st_mtime_ns}"
+        except Exception as e:
+            print(f"检查模型文件状态失败: {str(e)}")
+        return None
+    
+    @classmethod
+    def replaced_by_conversion(cls, url, model_dir, custom_path, subfolder, convert):
+        """下载的文件已被转换结果替换时返回转换结果的路径，否则返回None"""
+        save_dir, filename, error = cls.resolve_target(url, model_dir, custom_path, subfolder)
+        if error:
+            return None
+        return conversion_pool.replaced(os.path.join(save_dir, filename), convert)
+    
+    @classmethod
+    def start_prompt_job(cls, url, model_dir, custom_path, subfolder, use_mirror, threads, convert="none",
+                         extract=False):
+        """提交队列时开始下载节点的文件，节点执行时通过 prompt_job() 取用；目标已校验时不下载"""
+        save_dir, filename, error = cls.resolve_target(url, model_dir, custom_path, subfolder)
+        if error:
+            return None
+        save_path = os.path.join(save_dir, filename)
+        converting = convert in CONVERT_MODES and convert != "none"
+        replaced = converting and conversion_pool.replaced(save_path, convert)
+        if replaced or cls.verified_target(url, model_dir, custom_path, subfolder, extract=extract):
+            with _prompt_jobs_lock:
+                _prompt_jobs.pop(save_path, None)
+            if converting and not replaced:
+                conversion_pool.submit(save_path, convert)
+            return None
+        job, error = cls.create_job(url, model_dir, custom_path, subfolder, use_mirror, threads, convert=convert,
+                                    extract=extract)
+        if error:
+            return None
+        job = cls.submit_unique(job)
+        if convert != "none":
+            # 已有的任务可能是从接口提交的，下载完成后同样开始转换
+            job.convert = convert
+        with _prompt_jobs_lock:
+            _prompt_jobs[save_path] = job
+        return job
+    
+    @classmethod
+    def wait_conversion(cls, path, mode):
+        """等待文件的转换结果（下载完成时通常已经在后台开始），返回结果说明"""
+        try:
+            return conversion_pool.submit(path, mode).result()
+        except ConversionError as e:
+            return str(e)
+        except Exception as e:
+            print(f"转换过程中出错: {str(e)}")
+            return f"转换过程中出错: {str(e)}"
+    
+    @classmethod
+    def prompt_job(cls, job):
+        """返回提交队列时为同一URL和目标路径启动的任务，没有时返回None"""
+        with _prompt_jobs_lock:
+            started = _prompt_jobs.get(job.save_path)
+            if started is None or started.url != job.url:
+                return None
+            if started.is_finished:
+                # 已结束的任务只交给一次节点执行，之后再执行节点时重新提交
+                del _prompt_jobs[job.save_path]
+            return started
+    
+    @classmethod
+    def download_repo(cls, url, model_dir, custom_path, subfolder, use_mirror, threads, revision="",
+                      include="", exclude=""):
+        """下载整个仓库并等待全部完成，返回汇总结果"""
+        jobs, error = cls.create_repo_jobs(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                           revision=revision, include=include, exclude=exclude)
+        if error:
+            return error
+        jobs = [cls.submit_unique(job) for job in jobs]
+        for job in jobs:
+            job.wait()
         
-        # 完整的保存路径
-        full_save_path = os.path.join(save_path, filename)
+        failed = [job for job in jobs if job.state != STATE_COMPLETED]
+        lines = [f"仓库下载完成: 共 {len(jobs)} 个文件，失败 {len(failed)} 个"]
+        lines += [f"{job.filename}: {job.result}" for job in failed]
+        return "\n".join(lines)
+    
+    @classmethod
+    def create_repo_jobs(cls, url, model_dir, custom_path, subfolder, use_mirror, threads, priority=0,
+                         revision="", include="", exclude=""):
+        """列出仓库文件并为每个文件创建下载任务，保持仓库内的目录结构，返回 (jobs, 错误信息)"""
+        repo = parse_repo_url(url, revision=(revision or "").strip() or None)
+        if repo is None:
+            return None, f"错误: 不是Hugging Face仓库地址: '{url}'。"
+        try:
+            repo, files = list_repo_files(repo, use_mirror)
+        except RepoError as e:
+            return None, f"错误: {str(e)}"
+        files = filter_files(files, include, exclude)
+        if not files:
+            return None, f"错误: 仓库 {repo.repo_id} 中没有符合条件的文件。"
         
-        # 更新初始状态信息
-        status_message = f"开始下载: {url}\n保存到: {full_save_path}\n使用 {threads} 个线程下载中..."
-        # 输出日志到控制台
-        print(f"下载状态: {status_message}")
+        jobs = []
+        for entry in files:
+            job, error = cls.create_job(repo.resolve_url(entry["path"]), model_dir, custom_path, subfolder,
+                                        use_mirror, threads, priority=priority, filename=entry["path"],
+                                        sha256=entry["sha256"])
+            if error:
+                return None, error
+            job.total_bytes = entry["size"]
+            jobs.append(job)
+        # 只提醒，空间是否足够在每个文件开始下载时检查
+        total_size = sum(job.total_bytes for job in jobs)
+        free, reserved = disk_space.usage(jobs[0].save_dir)
+        if total_size + reserved + disk_space.margin > free:
+            print(f"警告: 仓库 {repo.repo_id} 的文件共 {format_size(total_size)}，{jobs[0].save_dir} 所在磁盘"
+                  f"剩余 {format_size(free)}，可能无法全部下载")
+        print(f"仓库 {repo.repo_id}@{repo.revision}: {len(jobs)} 个文件已加入队列")
+        return jobs, None
+    
+    @classmethod
+    def submit_job(cls, job, force=False):
+        """提交任务；同一URL此前已下载到目标路径且文件未变化时直接完成，force 为True时总是重新下载
+        （例如上游已更新）"""
+        if not force and job.extract and read_manifest(job.save_dir, job.filename):
+            print(f"压缩包已解压且文件未变化，跳过: {job.save_path}")
+            return download_queue.add_finished(job, "压缩包已解压，跳过")
+        if not force and job_journal.completed_unchanged(job.url, job.save_path):
+            print(f"文件已下载且未变化，跳过: {job.save_path}")
+            metrics.inc("model_downloader_dedup_hits_total", source="journal")
+            return download_queue.add_finished(job, "文件已下载，跳过")
+        warm_up()
+        return download_queue.submit(job)
+    
+    @classmethod
+    def submit_unique(cls, job, force=False):
+        """同一目标路径已有未结束的任务时返回该任务（检查和提交是原子的），否则提交job"""
+        with _submit_lock:
+            return download_queue.find_active(job.save_path) or cls.submit_job(job, force=force)
+
+    @classmethod
+    def _run_job(cls, job):
+        """下载队列的工作函数，在工作线程中执行"""
+        # 确保目录存在
+        os.makedirs(job.save_dir, exist_ok=True)
+        
+        # 下载前记录上游的版本信息（ETag、Last-Modified、commit），以后据此检查上游是否更新
+        try:
+            cls._remote_info(job)
+        except Exception as e:
+            print(f"获取远程文件信息失败: {str(e)}")
         
-        # 直接调用下载方法并获取结果
-        result = self._download_with_aria2c(aria2c_path, url, save_path, filename, threads, use_mirror)
+        # 压缩包边下载边解压，没有单个文件可以去重、共享或计算哈希
+        if job.extract:
+            return cls._run_extract(job)
         
-        # 返回下载结果
-        return (result, )
+        # 本地已有相同内容的模型文件时不再下载
+        if DEDUP_ENABLED:
+            result = cls._reuse_existing_file(job)
+            if result:
+                return result
+        
+        # 多个节点共享缓存目录时，同一文件只由一个节点下载，其他节点等待后链接
+        if shared_cache is not None:
+            return cls._run_with_shared_cache(job)
+        
+        digest = cls._fetch_verified(job, job.save_path)
+        # 记入哈希索引，以后按哈希去重时无需重新计算
+        hash_index.record(job.save_path, digest)
+        return "下载完成"
+    
+    @classmethod
+    def _run_with_shared_cache(cls, job):
+        """通过共享缓存获取文件：缓存中没有时加锁下载到缓存，再链接到模型目录"""
+        if not job.expected_sha256:
+            # 按内容哈希寻址；远程不提供哈希时退回按URL寻址
+            try:
+                job.expected_sha256 = cls._remote_info(job).sha256
+            except Exception as e:
+                print(f"获取远程文件信息失败: {str(e)}")
+        
+        def on_wait():
+            job.speed = "等待其他节点下载"
+            job.touch()
+            cls._send_status(job)
+        
+        downloaded = []
+        
+        def download(target):
+            downloaded.append(target)
+            return cls._fetch_verified(job, target)
+        
+        blob, digest = shared_cache.fetch(job.url, job.expected_sha256, job.filename, download,
+                                          check_cancelled=job.check_cancelled, on_wait=on_wait)
+        if not downloaded:
+            metrics.inc("model_downloader_dedup_hits_total", source="shared_cache")
+        started = time.monotonic()
+        method = link_or_copy(blob, job.save_path)
+        metrics.observe("model_downloader_postprocess_seconds", time.monotonic() - started, stage="link")
+        hash_index.record(job.save_path, digest)
+        job.progress = 100
+        print(f"已从共享缓存通过{method}放到 {job.save_path}")
+        return f"下载完成 (共享缓存, {method})"
+    
+    @classmethod
+    def _run_extract(cls, job):
+        """边下载边把压缩包解压到保存目录，磁盘上只有解压出的文件"""
+        sources = sources_for(job.url, job.use_mirror)
+        meter = TransferMeter("extract")
+        reservations = []
+        
+        def on_progress(completed, total, speed):
+            job.update_progress(completed, total, speed)
+            progress_reporter.update(job)
+            meter.update({host_of(extractor.url or sources[0]): completed})
+        
+        def on_wait():
+            job.speed = "等待磁盘空间"
+            job.touch()
+            cls._send_status(job)
+        
+        def on_plan(size):
+            reservations.append(disk_space.reserve(job.save_path + ".extracting", size,
+                                                   check_cancelled=job.check_cancelled, on_wait=on_wait))
+        
+        connections = int(job.threads) if int(job.threads) > 0 else 4
+        print(f"任务 {job.job_id} 边下载边解压 {job.filename} 到 {job.save_dir}")
+        extractor = ArchiveExtractor(sources, job.save_dir, job.filename, connections=connections,
+                                     on_progress=on_progress, should_cancel=lambda: job.cancel_requested,
+                                     network_limiter=bandwidth_budget.network, disk_limiter=bandwidth_budget.disk,
+                                     on_plan=on_plan)
+        try:
+            files = extractor.extract()
+        except (DownloadError, DownloadCancelled):
+            raise
+        except OSError as e:
+            print(f"解压过程中出错: {str(e)}")
+            cause = "disk_space" if e.errno == errno.ENOSPC else "disk"
+            raise DownloadError(f"解压过程中出错: {str(e)}", cause=cause)
+        finally:
+            for reservation in reservations:
+                disk_space.release(reservation)
+        meter.finish()
+        
+        job.progress = 100
+        job.speed = "完成"
+        job.eta = "0s"
+        total_size = sum(size for _, size in files)
+        print(f"解压完成: {len(files)} 个文件 ({format_size(total_size)}) -> {job.save_dir}")
+        return f"解压完成: {len(files)} 个文件 ({format_size(total_size)})"
+    
+    @classmethod
+    def _fetch_verified(cls, job, target):
+        """下载到target的临时文件，边下载边计算哈希，校验通过后原子地改名为target，返回SHA-256"""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        adopt_legacy_partial(target)
+        reservation = cls._reserve_disk_space(job, target)
+        hasher = PrefixHasher(partial_path(target))
+        try:
+            cls._download(job, hasher, target)
+            # 传输结束后等待哈希追上文件末尾（子进程下载时要从头计算）
+            started = time.monotonic()
+            digest = hasher.finish(os.path.getsize(partial_path(target)))
+            metrics.observe("model_downloader_postprocess_seconds", time.monotonic() - started, stage="hash")
+        except BaseException:
+            hasher.stop()
+            raise
+        finally:
+            if reservation is not None:
+                disk_space.release(reservation)
+        started = time.monotonic()
+        verify_and_publish(partial_path(target), target, digest, expected_sha256=job.expected_sha256)
+        metrics.observe("model_downloader_postprocess_seconds", time.monotonic() - started, stage="verify")
+        print(f"文件校验通过 (SHA-256 {digest}): {target}")
+        return digest
+    
+    @classmethod
+    def _reserve_disk_space(cls, job, target):
+        """确认目标所在的文件系统放得下文件并预留空间，返回预留记录；无法得知文件大小时不检查"""
+        if not job.total_bytes:
+            try:
+                job.total_bytes = cls._remote_info(job).size or 0
+            except Exception as e:
+                print(f"获取远程文件信息失败: {str(e)}")
+        if not job.total_bytes:
+            print(f"无法得知文件大小，跳过磁盘空间检查: {job.url}")
+            return None
+        
+        def on_wait():
+            job.speed = "等待磁盘空间"
+            job.touch()
+            cls._send_status(job)
+        
+        return disk_space.reserve(partial_path(target), job.total_bytes, check_cancelled=job.check_cancelled,
+                                  on_wait=on_wait)
+    
+    @classmethod
+    def _download(cls, job, hasher, target):
+        """选择下载后端，把文件下载到target的临时路径"""
+        backend = cls.select_backend(job.url)
+        if backend == "python":
+            return cls._download_with_http_engine(job, hasher, target)
+        aria2c_path = capability_probe.get()["aria2c"]["path"]
+        
+        # 优先使用常驻的aria2c RPC进程，不可用时退回到每个文件一个aria2c子进程
+        if backend == "rpc":
+            try:
+                client = get_daemon(aria2c_path).ensure_running()
+            except Aria2RpcError as e:
+                print(f"aria2c RPC不可用，改用子进程下载: {str(e)}")
+            else:
+                return cls._download_with_aria2_rpc(client, job, hasher, target)
+        
+        # 子进程无法得知已连续写完的字节数，下载完成后一次性计算哈希
+        return cls._download_with_aria2c(aria2c_path, job, target)
 
     @classmethod
-    def _get_aria2c_path(cls):
-        """检查aria2c是否已安装并返回路径"""
+    def select_backend(cls, url=""):
+        """按配置和检测到的能力选择下载后端：rpc、subprocess 或 python
+
+        未找到aria2c或aria2c不支持该地址时使用内置的Python下载引擎。第一次调用时检测aria2c，
+        之后使用缓存的结果。
+        """
+        if DOWNLOAD_BACKEND == "python":
+            return "python"
+        if not aria2c_supports(capability_probe.get()["aria2c"], url):
+            return "python"
+        return DOWNLOAD_BACKEND
+
+    @classmethod
+    def capabilities(cls, refresh=False):
+        """检测到的下载引擎能力、配置的后端和实际使用的后端"""
+        result = dict(capability_probe.get(refresh))
+        result["configured_backend"] = DOWNLOAD_BACKEND
+        result["backend"] = cls.select_backend()
+        result["aria2_rpc_running"] = running_client() is not None
+        return result
+
+    @classmethod
+    def get_download_status(cls, job_id=None, compact=False):
+        """获取全部任务或指定任务的下载状态"""
+        return download_queue.status(job_id, compact)
+    
+    @classmethod
+    def _remote_info(cls, job):
+        """任务URL的HEAD信息，同一任务只请求一次；请求失败时抛出异常，下次调用时重试"""
+        if job.remote is None:
+            job.remote = remote_info.head(job.url)
+        return job.remote
+    
+    @classmethod
+    def _send_status(cls, job):
+        """任务状态变化时立即发送完整状态到前端"""
+        progress_reporter.send_status(job)
+    
+    @classmethod
+    def _reuse_existing_file(cls, job):
+        """按SHA-256查找本地已有的相同文件，找到时链接/复制到目标路径并返回结果，否则返回None"""
+        info = None
+        for url in sources_for(job.url, job.use_mirror):
+            try:
+                info = cls._remote_info(job) if url == job.url else remote_info.head(url)
+                break
+            except Exception as e:
+                print(f"获取远程文件信息失败 ({host_of(url)}): {str(e)}")
+        if info is None:
+            print("无法获取远程文件信息，跳过去重检查")
+            return None
+        if info.size:
+            job.total_bytes = info.size
+        if not job.expected_sha256:
+            job.expected_sha256 = info.sha256
+        if not job.expected_sha256:
+            return None
+        
         try:
-            # 在Windows上，我们需要检查aria2c.exe
-            if platform.system() == "Windows":
-                aria2c_name = "aria2c.exe"
-                # 首先检查指定的aria2c目录
-                bundled_aria2c_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aria2-1.37.0-win-64bit")
-                bundled_aria2c_path = os.path.join(bundled_aria2c_dir, aria2c_name)
-                if os.path.exists(bundled_aria2c_path):
-                    return bundled_aria2c_path
-                
-                # 然后检查当前目录
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                aria2c_path = os.path.join(current_dir, aria2c_name)
-                if os.path.exists(aria2c_path):
-                    return aria2c_path
-                
-                # 最后检查PATH环境变量中的aria2c
-                for path in os.environ["PATH"].split(os.pathsep):
-                    exe_path = os.path.join(path, aria2c_name)
-                    if os.path.exists(exe_path):
-                        return exe_path
+            if os.path.isfile(job.save_path) and hash_index.get_hash(job.save_path) == job.expected_sha256:
+                print(f"文件已存在且哈希一致，跳过下载: {job.save_path}")
+                metrics.inc("model_downloader_dedup_hits_total", source="local")
+                return "文件已存在，跳过下载"
+            
+            # 在models目录、自定义节点和其他登记的模型目录中查找相同哈希的文件
+            existing = hash_index.find(job.expected_sha256, model_dir_index.model_roots(), size=info.size)
+            if not existing or os.path.abspath(existing) == os.path.abspath(job.save_path):
                 return None
-            else:
-                # 在Linux/Mac上，使用which命令查找aria2c
-                result = subprocess.run(["which", "aria2c"], 
-                                        stdout=subprocess.PIPE, 
-                                        stderr=subprocess.PIPE, 
-                                        text=True)
-                if result.returncode == 0:
-                    return result.stdout.strip()
-                
-                # 如果没找到aria2c，尝试安装
-                print("未找到aria2c，尝试自动安装...")
+            started = time.monotonic()
+            method = link_or_copy(existing, job.save_path)
+            metrics.observe("model_downloader_postprocess_seconds", time.monotonic() - started, stage="link")
+        except OSError as e:
+            print(f"复用本地文件失败，改为下载: {str(e)}")
+            return None
+        
+        metrics.inc("model_downloader_dedup_hits_total", source="local")
+        job.progress = 100
+        print(f"已找到相同文件 {existing}，通过{method}放到 {job.save_path}")
+        return f"已复用本地文件 ({method}): {existing}"
+    
+    @classmethod
+    def _download_with_http_engine(cls, job, hasher, target):
+        """使用内置的asyncio分段下载引擎下载文件"""
+        # 多个镜像时各分段分配给当前最快的源，初始速度取自历史统计
+        sources = sources_for(job.url, job.use_mirror)
+        priors = {url: host_stats.score(host_of(url)) for url in sources}
+        connections, segment_size, tuner = cls._auto_tuning(job, sources[0], MAX_CONNECTIONS, window=3.0)
+        # 内置引擎按请求记录首字节时间
+        meter = TransferMeter("python", first_byte=False)
+        
+        def on_progress(completed, total, speed):
+            job.update_progress(completed, total, speed)
+            progress_reporter.update(job)
+            meter.update(cls._received_by_host(downloader.sources))
+            hasher.set_available(downloader.contiguous_bytes())
+            # 自动模式下根据测得的吞吐量调整连接数
+            target = tuner.observe(completed) if tuner is not None else None
+            if target:
+                print(f"任务 {job.job_id} 调整连接数为 {target}")
+                downloader.set_connections(target)
+        
+        downloader = SegmentedDownloader(sources, partial_path(target), connections=connections,
+                                         segment_size=segment_size,
+                                         on_progress=on_progress,
+                                         should_cancel=lambda: job.cancel_requested,
+                                         source_priors={url: rate for url, rate in priors.items() if rate},
+                                         network_limiter=bandwidth_budget.network,
+                                         disk_limiter=bandwidth_budget.disk,
+                                         on_response=lambda url, seconds: metrics.observe(
+                                             "model_downloader_time_to_first_byte_seconds", seconds,
+                                             host=host_of(url), backend="python"),
+                                         on_retry=lambda url, cause: metrics.inc(
+                                             "model_downloader_retries_total", host=host_of(url), cause=cause))
+        job.set_pause_handlers(downloader.pause, downloader.resume)
+        print(f"任务 {job.job_id} 使用Python下载引擎 ({connections} 个连接): {', '.join(sources)}")
+        started = time.monotonic()
+        _http_downloaders.add(downloader)
+        try:
+            downloader.download()
+        except (DownloadError, DownloadCancelled):
+            raise
+        except OSError as e:
+            print(f"下载过程中出错: {str(e)}")
+            cause = "disk_space" if e.errno == errno.ENOSPC else "disk"
+            raise DownloadError(f"下载过程中出错: {str(e)}", cause=cause)
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            raise DownloadError(f"下载过程中出错: {str(e)}")
+        finally:
+            _http_downloaders.discard(downloader)
+            meter.update(cls._received_by_host(downloader.sources))
+            cls._record_source_stats(downloader.sources)
+        meter.finish()
+        cls._record_tuning(sources[0], downloader.total_size, connections, tuner, time.monotonic() - started)
+        
+        job.progress = 100
+        job.speed = "完成"
+        job.eta = "0s"
+        print(f"下载完成: {target}")
+        return "下载完成"
+    
+    @classmethod
+    def _received_by_host(cls, sources):
+        received = {}
+        for source in sources:
+            host = host_of(source.url)
+            received[host] = received.get(host, 0) + source.received
+        return received
+    
+    @classmethod
+    def _record_source_stats(cls, sources):
+        """把本次下载中各源的速度记入镜像统计，供以后的下载排序"""
+        for source in sources:
+            if source.bytes:
+                host_stats.record(host_of(source.url), source.bytes, source.seconds, source.latency)
+            elif source.failures or source.disabled:
+                host_stats.record_failure(host_of(source.url))
+    
+    @classmethod
+    def _auto_tuning(cls, job, url, max_connections, window):
+        """返回 (连接数, 分段大小, 调优器)；threads 为 0 时按主机和文件大小取历史最佳设置并在下载中继续调整"""
+        if int(job.threads) > 0:
+            return min(int(job.threads), max_connections), None, None
+        if not job.total_bytes:
+            try:
+                job.total_bytes = remote_info.head(url).size or 0
+            except Exception:
+                pass
+        connections, segment_size = tuning_store.initial(host_of(url), job.total_bytes, max_connections)
+        return connections, segment_size, ConnectionTuner(connections, max_connections, window=window)
+    
+    @classmethod
+    def _record_tuning(cls, url, total_size, connections, tuner, elapsed):
+        """记录自动模式测得的最佳连接数；文件太小来不及测量时按平均速度记录初始设置"""
+        if tuner is None:
+            return
+        if tuner.best_throughput > 0:
+            tuning_store.record(host_of(url), total_size, tuner.best_connections, tuner.best_throughput)
+        elif elapsed > 0:
+            tuning_store.record(host_of(url), total_size, connections, total_size / elapsed)
+    
+    @classmethod
+    def _download_with_aria2_rpc(cls, client, job, hasher, target):
+        """通过aria2c JSON-RPC下载文件，进度来自精确的字节数"""
+        sources = sources_for(job.url, job.use_mirror)
+        # aria2c 单服务器连接数上限为16；aria2c 调整连接数会重启该下载（从已有字节继续），测量窗口更长
+        connections, segment_size, tuner = cls._auto_tuning(job, sources[0], 16, window=5.0)
+        options = download_options(os.path.dirname(target), os.path.basename(target) + PARTIAL_SUFFIX,
+                                   connections, segment_size)
+        _apply_aria2_limit(bandwidth_budget, client)
+        try:
+            gid = client.add_uri(sources, options)
+        except Aria2RpcError as e:
+            raise DownloadError(f"下载过程中出错: {str(e)}", cause="aria2_rpc")
+        
+        print(f"任务 {job.job_id} 已提交到aria2c (gid {gid}): {', '.join(sources)}")
+        job.set_pause_handlers(lambda: client.pause(gid), lambda: client.unpause(gid))
+        job.on_cancel(lambda: client.remove(gid))
+        
+        keys = ["status", "totalLength", "completedLength", "downloadSpeed", "errorCode", "errorMessage",
+                "bitfield", "pieceLength", "numPieces"]
+        # 各主机的速度采样 {host: [速度之和, 采样数]}，下载结束后记入镜像统计
+        host_samples = {}
+        polls = 0
+        started = time.monotonic()
+        meter = TransferMeter("aria2_rpc", resumed_baseline=True)
+        try:
+            while True:
                 try:
-                    if platform.system() == "Linux":
-                        # 尝试使用apt安装
-                        print("尝试使用apt安装aria2...")
-                        subprocess.run(["sudo", "apt", "update"], 
-                                      stdout=subprocess.PIPE, 
-                                      stderr=subprocess.PIPE)
-                        result = subprocess.run(["sudo", "apt", "install", "-y", "aria2"], 
-                                              stdout=subprocess.PIPE, 
-                                              stderr=subprocess.PIPE)
-                        if result.returncode == 0:
-                            print("aria2c安装成功！")
-                            # 再次检查aria2c
-                            result = subprocess.run(["which", "aria2c"], 
-                                                  stdout=subprocess.PIPE, 
-                                                  stderr=subprocess.PIPE, 
-                                                  text=True)
-                            if result.returncode == 0:
-                                return result.stdout.strip()
-                    elif platform.system() == "Darwin":  # macOS
-                        # 尝试使用brew安装
-                        print("尝试使用Homebrew安装aria2...")
-                        result = subprocess.run(["brew", "install", "aria2"], 
-                                              stdout=subprocess.PIPE, 
-                                              stderr=subprocess.PIPE)
-                        if result.returncode == 0:
-                            print("aria2c安装成功！")
-                            # 再次检查aria2c
-                            result = subprocess.run(["which", "aria2c"], 
-                                                  stdout=subprocess.PIPE, 
-                                                  stderr=subprocess.PIPE, 
-                                                  text=True)
-                            if result.returncode == 0:
-                                return result.stdout.strip()
-                except Exception as e:
-                    print(f"尝试安装aria2c时出错: {str(e)}")
+                    status = client.tell_status(gid, keys)
+                except Aria2RpcError:
+                    # 任务被取消时gid可能已被移除
+                    job.check_cancelled()
+                    raise
                 
-                print("无法自动安装aria2c，请手动安装：")
-                if platform.system() == "Linux":
-                    print("Linux: 使用包管理器安装，如 'sudo apt install aria2'")
-                elif platform.system() == "Darwin":
-                    print("macOS: 使用Homebrew安装，'brew install aria2'")
-                return None
-        except Exception as e:
-            print(f"检查aria2c时出错: {str(e)}")
-            return None
-
-    # 存储下载状态的字典
-    download_status = {
-        "is_downloading": False,
-        "progress": 0,
-        "speed": "",
-        "eta": "",
-        "message": "",
-        "url": "",
-        "save_path": ""
-    }
+                state = status["status"]
+                job.update_progress(int(status["completedLength"]), int(status["totalLength"]),
+                                    int(status["downloadSpeed"]))
+                hasher.set_available(contiguous_length(status))
+                # aria2c只报告总的完成字节数，流量计入首选主机
+                meter.update({host_of(sources[0]): job.completed_bytes})
+                if state == "complete":
+                    job.progress = 100
+                    job.speed = "完成"
+                    job.eta = "0s"
+                    print(f"下载完成: {target}")
+                    meter.finish()
+                    cls._record_tuning(sources[0], job.total_bytes, connections, tuner, time.monotonic() - started)
+                    return "下载完成"
+                if state == "removed":
+                    job.check_cancelled()
+                    raise DownloadError("下载任务已被aria2c移除", cause="aria2_removed")
+                if state == "error":
+                    message = status.get("errorMessage") or f"错误码 {status.get('errorCode')}"
+                    print(f"下载失败: {message}")
+                    raise DownloadError(f"下载失败: {message}", cause=aria2_error_cause(status.get('errorCode')))
+                if state == "active":
+                    progress_reporter.update(job)
+                    polls += 1
+                    if len(sources) > 1 and polls % 4 == 0:
+                        cls._sample_aria2_servers(client, gid, host_samples)
+                    target = tuner.observe(job.completed_bytes) if tuner is not None else None
+                    if target:
+                        try:
+                            client.change_option(gid, {"split": str(target), "max-connection-per-server": str(target)})
+                            print(f"任务 {job.job_id} 调整连接数为 {target}")
+                        except Aria2RpcError as e:
+                            print(f"调整连接数失败: {str(e)}")
+                            tuner.done = True
+                time.sleep(0.5)
+        except Aria2RpcError as e:
+            raise DownloadError(f"下载过程中出错: {str(e)}", cause="aria2_rpc")
+        finally:
+            for host, (speed_sum, connections) in host_samples.items():
+                # 与Python下载引擎一致，记录单个连接的平均速度（以1秒传输的字节数记录）
+                host_stats.record(host, speed_sum / connections, 1.0)
+            try:
+                client.remove_download_result(gid)
+            except Aria2RpcError:
+                pass
     
     @classmethod
-    def get_download_status(cls):
-        """获取当前下载状态"""
-        return cls.download_status
+    def _sample_aria2_servers(cls, client, gid, host_samples):
+        """采样aria2c各连接当前使用的服务器和速度，按主机累计 [速度之和, 连接数]"""
+        try:
+            servers = client.get_servers(gid)
+        except Aria2RpcError:
+            return
+        speeds = {}
+        for entry in servers or []:
+            for server in entry.get("servers", []):
+                host = host_of(server.get("currentUri", ""))
+                sample = speeds.setdefault(host, [0, 0])
+                sample[0] += int(server.get("downloadSpeed", 0))
+                sample[1] += 1
+        for host, (speed, connections) in speeds.items():
+            if speed > 0:
+                sample = host_samples.setdefault(host, [0, 0])
+                sample[0] += speed
+                sample[1] += connections
     
     @classmethod
-    def _download_with_aria2c(cls, aria2c_path, url, save_dir, filename, threads, use_mirror=False):
+    def _download_with_aria2c(cls, aria2c_path, job, target):
         """使用aria2c下载文件"""
+        sources = sources_for(job.url, job.use_mirror)
+        save_dir, filename = os.path.split(target)
+        # 子进程无法在下载中调整连接数，自动模式只使用历史最佳设置
+        threads, segment_size, tuner = cls._auto_tuning(job, sources[0], 16, window=0)
+        started = time.monotonic()
         try:
             # 初始化下载状态
-            cls.download_status["is_downloading"] = True
-            cls.download_status["progress"] = 0
-            cls.download_status["speed"] = "准备中..."
-            cls.download_status["eta"] = "计算中..."
-            cls.download_status["url"] = url
-            cls.download_status["save_path"] = os.path.join(save_dir, filename)
-            cls.download_status["message"] = "" # 添加空的消息字段，以便前端能够正确处理
+            job.progress = 0
+            job.speed = "准备中..."
+            job.eta = "计算中..."
+            print(f"任务 {job.job_id} 使用aria2c子进程下载: {', '.join(sources)} -> {target}")
             
-            # 只在控制台输出日志
-            print(f"状态: 初始化中")
-            print(f"进度: 0%")
-            print(f"速度: 准备中...")
-            print(f"剩余时间: 计算中...")
-            print(f"URL: {url}")
-            print(f"保存路径: {os.path.join(save_dir, filename)}")
-            
-            # 发送初始状态到前端
-            PromptServer.instance.send_sync("model_download_status", cls.download_status)
-            
-            cmd = [
-                aria2c_path,
-                "-x", str(threads),  # 连接数
-                "-s", str(threads),  # 分段数
-                "-k", "1M",         # 分段大小
-                "--dir", save_dir,   # 保存目录
-                "-o", filename,      # 输出文件名
-                url                  # 下载URL
-            ]
+            options = download_options(save_dir, filename + PARTIAL_SUFFIX, threads, segment_size)
+            # 子进程无法在运行中调整限速，按启动时的全局预算平分给同时下载的任务
+            options["max-overall-download-limit"] = str(
+                bandwidth_budget.effective_overall_limit() // max(1, download_queue.max_workers))
+            cmd = command_line(aria2c_path, sources, options)
             
             process = subprocess.Popen(
                 cmd,
@@ -283,108 +827,207 @@ class ModelDownloader:
                 bufsize=1,
                 universal_newlines=True
             )
+            # 取消任务时终止aria2c进程
+            job.on_cancel(process.terminate)
+            meter = TransferMeter("aria2c", resumed_baseline=True)
             
-            # 读取并处理输出
+            # 读取并处理输出，只解析进度行；控制台输出由 MODEL_DOWNLOADER_ECHO 控制
             for line in process.stdout:
-                print(line, end='')
-                sys.stdout.flush()
-                
-                # 解析aria2c输出的进度信息
-                if "[#" in line:
-                    # 提取进度百分比
-                    progress = 0  # 默认值
-                    progress_match = re.search(r'(\d+)%', line)
-                    if progress_match:
-                        progress = int(progress_match.group(1))
-                        cls.download_status["progress"] = progress
-                    
-                    # 提取下载速度
-                    speed_match = re.search(r'(\d+(\.\d+)?\s*(K|M|G)iB/s)', line)
-                    if speed_match:
-                        cls.download_status["speed"] = speed_match.group(1)
-                    
-                    # 提取剩余时间
-                    eta_match = re.search(r'ETA:(\s*\d+[smh]\d+[smh]?)', line)
-                    if eta_match:
-                        cls.download_status["eta"] = eta_match.group(1).strip()
-                    
-                    # 更新状态
-                    cls.download_status["status"] = f"下载中: {progress}%"
-                    
-                    # 创建简单的文本格式状态信息，使用双反斜杠转义换行符
-                    status_text = f"状态: 下载中: {progress}%\\n"
-                    status_text += f"进度: {progress}%\\n"
-                    status_text += f"速度: {cls.download_status['speed']}\\n"
-                    status_text += f"剩余时间: {cls.download_status['eta']}\\n"
-                    status_text += f"URL: {url}\\n"
-                    status_text += f"保存路径: {os.path.join(save_dir, filename)}"
-                    cls.download_status["message"] = status_text
-                    
-                    # 发送更新到前端
-                    PromptServer.instance.send_sync("model_download_status", cls.download_status)
+                readout = parse_aria2_readout(line)
+                if readout is None:
+                    if progress_reporter.echo and line.strip():
+                        print(line, end='')
+                    continue
+                job.update_progress(*readout)
+                progress_reporter.update(job)
+                meter.update({host_of(sources[0]): job.completed_bytes})
             
             process.wait()
+            job.check_cancelled()
             
-            if process.returncode == 0:
-                cls.download_status["progress"] = 100
-                cls.download_status["speed"] = "完成"
-                cls.download_status["eta"] = "0s"
-                cls.download_status["status"] = "下载完成"
-                # 创建简单的文本格式状态信息，使用双反斜杠转义换行符
-                status_text = f"状态: 下载完成\\n"
-                status_text += f"进度: 100%\\n"
-                status_text += f"速度: 完成\\n"
-                status_text += f"剩余时间: 0s\\n"
-                status_text += f"URL: {url}\\n"
-                status_text += f"保存路径: {os.path.join(save_dir, filename)}"
-                cls.download_status["message"] = status_text
-                print(f"下载完成: {os.path.join(save_dir, filename)}")
-            else:
-                cls.download_status["progress"] = 0
-                cls.download_status["speed"] = "失败"
-                cls.download_status["eta"] = "N/A"
-                cls.download_status["status"] = "下载失败"
-                cls.download_status["message"] = ""
-                # 只在控制台输出日志
-                print(f"状态: 下载失败")
-                print(f"进度: 0%")
-                print(f"速度: 失败")
-                print(f"剩余时间: N/A")
-                print(f"URL: {url}")
-                print(f"保存路径: {os.path.join(save_dir, filename)}")
-                print(f"错误: 返回码 {process.returncode}")
+            if process.returncode != 0:
+                job.progress = 0
+                job.speed = "失败"
+                job.eta = "N/A"
                 print(f"下载失败，返回码: {process.returncode}")
+                # aria2c的返回码与RPC中的errorCode含义相同
+                raise DownloadError(f"下载失败，返回码: {process.returncode}",
+                                    cause=aria2_error_cause(process.returncode))
             
-            # 发送最终状态到前端
-            cls.download_status["is_downloading"] = False
-            PromptServer.instance.send_sync("model_download_status", cls.download_status)
-            
-            # 返回状态信息
-            return cls.download_status["status"]
+            job.progress = 100
+            job.speed = "完成"
+            job.eta = "0s"
+            print(f"下载完成: {target}")
+            meter.finish()
+            cls._record_tuning(sources[0], job.total_bytes, threads, tuner, time.monotonic() - started)
+            return "下载完成"
             
+        except (DownloadError, DownloadCancelled):
+            raise
         except Exception as e:
-            error_message = f"下载过程中出错: {str(e)}"
-            cls.download_status["is_downloading"] = False
-            cls.download_status["progress"] = 0
-            cls.download_status["speed"] = "失败"
-            cls.download_status["eta"] = "N/A"
-            cls.download_status["status"] = error_message
-            cls.download_status["message"] = ""
-            
-            # 只在控制台输出日志
-            print(f"状态: 下载出错")
-            print(f"进度: 0%")
-            print(f"速度: 失败")
-            print(f"剩余时间: N/A")
-            print(f"URL: {url}")
-            save_path = os.path.join(save_dir, filename) if save_dir and filename else "未知"
-            print(f"保存路径: {save_path}")
-            print(f"错误: {str(e)}")
-            # 直接输出错误信息
-            print(error_message)
-            
-            # 发送错误状态到前端
-            PromptServer.instance.send_sync("model_download_status", cls.download_status)
-            
-            # 返回错误信息
-            return error_message
\ No newline at end of file
+            job.speed = "失败"
+            job.eta = "N/A"
+            print(f"下载过程中出错: {str(e)}")
+            raise DownloadError(f"下载过程中出错: {str(e)}")
+
+
+# 下载后端: rpc（常驻aria2c进程，默认）、subprocess（每个文件一个aria2c进程）
+# 或 python（内置的asyncio分段下载引擎）；未找到aria2c时总是使用python引擎
+DOWNLOAD_BACKEND = os.environ.get("MODEL_DOWNLOADER_BACKEND", "rpc")
+
+
+def _apply_aria2_limit(budget, client=None):
+    """把全局下载预算同步给常驻的aria2c进程（aria2c不能单独限制写盘，取两者中较小的限制）"""
+    client = client or running_client()
+    if client is None:
+        return
+    try:
+        client.change_global_option({"max-overall-download-limit": str(budget.effective_overall_limit())})
+    except Aria2RpcError as e:
+        print(f"设置aria2c限速失败: {str(e)}")
+
+
+bandwidth_budget.add_listener(_apply_aria2_limit)
+
+
+_warm_up_started = threading.Event()
+
+
+def _warm_up():
+    """检测下载引擎，使用RPC后端时启动常驻的aria2c进程"""
+    try:
+        if ModelDownloader.select_backend() != "rpc":
+            return
+        get_daemon(capability_probe.get()["aria2c"]["path"]).ensure_running()
+    except Aria2RpcError as e:
+        print(f"启动aria2c RPC服务失败: {str(e)}")
+    except Exception as e:
+        print(f"检测下载引擎失败: {str(e)}")
+
+
+def warm_up():
+    """第一次需要下载时在后台检测下载引擎，插件导入时不运行任何子进程"""
+    if not _warm_up_started.is_set():
+        _warm_up_started.set()
+        threading.Thread(target=_warm_up, name="model-downloader-warm-up", daemon=True).start()
+
+
+# 下载前按SHA-256查找本地已有的相同文件，设置 MODEL_DOWNLOADER_DEDUP=0 关闭
+DEDUP_ENABLED = os.environ.get("MODEL_DOWNLOADER_DEDUP", "1") != "0"
+
+# 全局下载队列，并发数可通过环境变量或设置接口调整
+download_queue = DownloadQueue(
+    ModelDownloader._run_job,
+    max_workers=int(os.environ.get("MODEL_DOWNLOADER_MAX_CONCURRENT", "3")),
+    # 保留的已结束任务数
+    max_history=int(os.environ.get("MODEL_DOWNLOADER_HISTORY", "200")),
+)
+download_queue.add_listener(ModelDownloader._send_status)
+download_queue.add_listener(job_journal.update)
+
+# 保证同一目标路径只有一个未结束的任务
+_submit_lock = threading.Lock()
+
+# 提交队列时为 Model Downloader 节点启动的任务 {保存路径: job}
+_prompt_jobs = {}
+_prompt_jobs_lock = threading.Lock()
+
+# 正在运行的内置引擎下载，用于统计当前连接数
+_http_downloaders = set()
+
+
+def _record_job_metrics(job):
+    if not job.is_finished:
+        return
+    metrics.inc("model_downloader_jobs_total", state=job.state)
+    if job.state == STATE_FAILED:
+        metrics.inc("model_downloader_failures_total", cause=job.error_cause or "error")
+
+
+def _collect_metrics():
+    """抓取时计算的瞬时指标：队列长度、当前速度、连接数和各主机的平均吞吐量"""
+    status = download_queue.status()
+    jobs = [job for job in download_queue.list_jobs() if job.state == STATE_RUNNING]
+    connections = [({"backend": "python"}, sum(source.active for downloader in list(_http_downloaders)
+                                               for source in downloader.sources))]
+    client = running_client()
+    if client is not None:
+        try:
+            active = client.tell_active(["connections"])
+            connections.append(({"backend": "aria2_rpc"}, sum(int(item["connections"]) for item in active)))
+        except Aria2RpcError:
+            pass
+    return [
+        ("model_downloader_queue_depth", "gauge", "下载队列中的任务数，按状态",
+         [({"state": "queued"}, status["queued"]), ({"state": "active"}, status["active"])]),
+        ("model_downloader_current_throughput_bytes_per_second", "gauge", "所有正在下载的任务的当前总速度",
+         [({}, sum(job.speed_bps for job in jobs))]),
+        ("model_downloader_active_connections", "gauge", "当前打开的下载连接数，按下载后端", connections),
+        ("model_downloader_host_throughput_bytes_per_second", "gauge", "各主机单个连接的平均吞吐量（指数平滑）",
+         [({"host": host}, entry["throughput"]) for host, entry in host_stats.snapshot().items()
+          if entry.get("samples")]),
+    ]
+
+
+def _start_conversion(job):
+    """下载完成后立即在后台开始转换，节点执行时只需等待结果"""
+    if job.state == STATE_COMPLETED and job.convert != "none":
+        conversion_pool.submit(job.save_path, job.convert)
+
+
+def _update_catalog(job):
+    """下载完成后读取safetensors头部记入模型目录"""
+    if job.state == STATE_COMPLETED:
+        try:
+            if job.extract:
+                manifest = read_manifest(job.save_dir, job.filename) or {"files": []}
+                for name, _ in manifest["files"]:
+                    model_catalog.update_file(os.path.join(job.save_dir, name), model_dir_index.get())
+                return
+            model_catalog.update_file(job.save_path, model_dir_index.get())
+        except Exception as e:
+            print(f"更新模型目录失败: {str(e)}")
+
+
+download_queue.add_listener(_record_job_metrics)
+download_queue.add_listener(_start_conversion)
+download_queue.add_listener(_update_catalog)
+metrics.add_collector(_collect_metrics)
+
+
+def _resume_interrupted_jobs():
+    """重新提交上次运行时中断的任务，各下载后端会从已有的字节继续"""
+    try:
+        jobs = job_journal.interrupted_jobs()
+        job_journal.prune()
+    except Exception as e:
+        print(f"读取下载任务日志失败: {str(e)}")
+        return
+    for job in jobs:
+        print(f"恢复中断的下载任务 {job.job_id}: {job.url}")
+        # 启动时提示词或接口可能已经提交了同一目标的任务，不能同时写同一个临时文件
+        submitted = ModelDownloader.submit_unique(job)
+        if submitted is job:
+            continue
+        if job.convert != "none":
+            submitted.convert = job.convert
+        # 日志中的记录已由另一个任务接管，下次启动不再恢复
+        job.state = STATE_CANCELLED
+        job.result = f"已由任务 {submitted.job_id} 下载同一文件"
+        try:
+            job_journal.update(job)
+        except Exception as e:
+            print(f"更新下载任务日志失败: {str(e)}")
+
+
+if DEDUP_ENABLED:
+    # 启动时在后台扫描模型目录，下载前查找相同文件时只使用扫描结果，不再遍历目录
+    try:
+        hash_index.start_scan(model_dir_index.model_roots())
+    except OSError as e:
+        print(f"扫描模型目录失败: {str(e)}")
+
+
+# 设置 MODEL_DOWNLOADER_RESUME=0 时不恢复（例如命令行模式，只下载清单中的文件）
+if os.environ.get("MODEL_DOWNLOADER_RESUME", "1") != "0":
+    threading.Thread(target=_resume_interrupted_jobs, name="model-downloader-resume", daemon=True).start()
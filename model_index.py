@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+
+
+def _default_models_dir():
+    import folder_paths
+    return folder_paths.models_dir
+
+
+class ModelDirIndex:
+    """缓存的模型目录索引（目录名 -> 路径），目录mtime变化时自动失效
+
+    索引包含 models/ 下的所有子目录和 custom_nodes/*/models 目录。
+    重建需要对每个目录做 listdir 和多次 stat，在网络文件系统上很慢；
+    校验只需对 models/、custom_nodes/ 及各自定义节点目录做一次 stat，
+    且在 ttl 秒内直接使用内存中的结果。
+    """
+
+    def __init__(self, base_path=None, ttl=5.0):
+        self._base_path = base_path
+        self.ttl = ttl
+        self._dirs = None
+        self._signature = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def set_base_path(self, base_path):
+        """指定models目录（没有ComfyUI的环境，例如命令行），下次访问时重新扫描"""
+        with self._lock:
+            self._base_path = base_path
+            self._dirs = None
+
+    @property
+    def base_path(self):
+        if self._base_path is None:
+            self._base_path = _default_models_dir()
+        return self._base_path
+
+    @property
+    def custom_nodes_path(self):
+        return os.path.join(os.path.dirname(self.base_path), "custom_nodes")
+
+    def get(self):
+        """返回 {目录名: 路径} 的副本"""
+        with self._lock:
+            now = time.monotonic()
+            if self._dirs is None or now - self._checked_at >= self.ttl:
+                signature = self._compute_signature()
+                if self._dirs is None or signature != self._signature:
+                    self._dirs = self._scan()
+                    self._signature = signature
+                self._checked_at = now
+            return dict(self._dirs)
+
+    def names(self):
+        return list(self.get().keys())
+
+    def resolve(self, name):
+        """返回目录名对应的路径，不存在时返回None"""
+        return self.get().get(name)
+
+    def model_roots(self):
+        """所有存放模型的目录：models目录、自定义节点的模型目录和 folder_paths 中登记的其他目录
+        （例如 extra_model_paths.yaml）"""
+        roots = [self.base_path]
+        roots += [path for name, path in self.get().items() if name.startswith("custom_nodes/")]
+        try:
+            import folder_paths
+            for paths, _ in folder_paths.folder_names_and_paths.values():
+                roots += [path for path in paths if path not in roots]
+        except (ImportError, AttributeError, TypeError, ValueError):
+            pass
+        return roots
+
+    def invalidate(self):
+        """强制下次访问时重新扫描"""
+        with self._lock:
+            self._dirs = None
+
+    def _compute_signature(self):
+        # 新建/删除子目录会改变父目录的mtime，自定义节点下新增models目录会改变节点目录的mtime
+        signature = [_mtime(self.base_path), _mtime(self.custom_nodes_path)]
+        try:
+            with os.scandir(self.custom_nodes_path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        signature.append((entry.name, entry.stat().st_mtime_ns))
+        except OSError:
+            pass
+        return signature
+
+    def _scan(self):
+        model_dirs = {}
+
+        # 遍历models目录下的所有文件夹
+        with os.scandir(self.base_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    model_dirs[entry.name] = entry.path
+
+        # 添加自定义节点中的模型目录
+        try:
+            with os.scandir(self.custom_nodes_path) as entries:
+                for entry in entries:
+                    node_models_path = os.path.join(entry.path, "models")
+                    if entry.is_dir() and os.path.isdir(node_models_path):
+                        model_dirs[f"custom_nodes/{entry.name}/models"] = node_models_path
+        except OSError:
+            pass
+        return model_dirs
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# 节点定义、下载和前端接口共享的全局索引
+model_dir_index = ModelDirIndex()
@@ -0,0 +1,377 @@
+import os
+import json
+import threading
+import time
+import uuid
+
+from .download_queue import STATE_QUEUED, STATE_RUNNING, STATE_PAUSED, STATE_COMPLETED, STATE_FAILED, STATE_CANCELLED
+from .hash_index import MODEL_EXTENSIONS
+from .model_index import model_dir_index
+from .model_downloader import ModelDownloader, download_queue
+from .progress import progress_reporter
+from .hf_repo import parse_repo_url
+from .convert import CONVERT_MODES
+
+
+def _load_json(value):
+    if isinstance(value, (dict, list)):
+        return value
+    if not value or not str(value).strip():
+        return None
+    return json.loads(value)
+
+
+def _is_model_reference(value):
+    return isinstance(value, str) and "://" not in value and value.lower().endswith(MODEL_EXTENSIONS)
+
+
+def find_model_references(workflow):
+    """找出工作流引用的模型文件名，支持界面格式（nodes/widgets_values）和API格式（inputs）"""
+    workflow = _load_json(workflow) or {}
+    references = []
+
+    def add(value):
+        value = value.replace("\\", "/")
+        if value not in references:
+            references.append(value)
+
+    if isinstance(workflow.get("nodes"), list):
+        for node in workflow["nodes"]:
+            widgets = node.get("widgets_values")
+            values = widgets.values() if isinstance(widgets, dict) else (widgets or [])
+            for value in values:
+                if _is_model_reference(value):
+                    add(value)
+    else:
+        for node in workflow.values():
+            if isinstance(node, dict) and isinstance(node.get("inputs"), dict):
+                for value in node["inputs"].values():
+                    if _is_model_reference(value):
+                        add(value)
+    return references
+
+
+def _embedded_manifest(workflow):
+    """ComfyUI工作流可以在节点 properties.models 或顶层 models 中记录模型下载地址"""
+    workflow = _load_json(workflow) or {}
+    entries = list(workflow.get("models") or [])
+    for node in workflow.get("nodes") or []:
+        entries.extend((node.get("properties") or {}).get("models") or [])
+    manifest = {}
+    for entry in entries:
+        if isinstance(entry, dict) and entry.get("name") and entry.get("url") and entry.get("directory"):
+            manifest[entry["name"]] = {"url": entry["url"], "model_dir": entry["directory"],
+                                       "subfolder": "", "custom_path": "", "sha256": None}
+    return manifest
+
+
+def _downloader_node_manifest(workflow):
+    """工作流中已有的 Model Downloader 节点本身就是清单条目"""
+    workflow = _load_json(workflow) or {}
+    manifest = {}
+    if isinstance(workflow.get("nodes"), list):
+        for node in workflow["nodes"]:
+            if node.get("type") == "ModelDownloaderNode" and len(node.get("widgets_values") or []) >= 4:
+                url, model_dir, custom_path, subfolder = node["widgets_values"][:4]
+                manifest[os.path.basename(url)] = {"url": url, "model_dir": model_dir, "subfolder": subfolder,
+                                                   "custom_path": custom_path, "sha256": None}
+    else:
+        for node in workflow.values():
+            if isinstance(node, dict) and node.get("class_type") == "ModelDownloaderNode":
+                inputs = node.get("inputs") or {}
+                if isinstance(inputs.get("url"), str) and isinstance(inputs.get("model_dir"), str):
+                    manifest[os.path.basename(inputs["url"])] = {
+                        "url": inputs["url"], "model_dir": inputs["model_dir"],
+                        "subfolder": inputs.get("subfolder") or "", "custom_path": inputs.get("custom_path") or "",
+                        "sha256": None,
+                    }
+    return manifest
+
+
+def parse_manifest(manifest):
+    """解析URL清单，返回 {文件名: {"url", "model_dir", "subfolder", "custom_path", "sha256"}}
+
+    支持 {"文件名": {"url": ..., "model_dir": ...}}、{"URL": {"model_dir": ...}} 和
+    [{"filename": ..., "url": ..., "model_dir": ...}] 三种写法，可选字段 subfolder、custom_path、sha256；
+    不指定文件名时取URL的文件名。
+    """
+    manifest = _load_json(manifest) or {}
+    if isinstance(manifest, list):
+        manifest = {entry.get("filename") or os.path.basename(entry.get("url", "")): entry for entry in manifest}
+    entries = {}
+    for filename, entry in manifest.items():
+        if "://" in filename and isinstance(entry, dict) and not entry.get("url"):
+            entry = dict(entry, url=filename)
+            filename = entry.get("filename") or os.path.basename(filename.split("?", 1)[0])
+        if not isinstance(entry, dict) or not entry.get("url"):
+            raise ValueError(f"清单中 '{filename}' 缺少url")
+        if not entry.get("model_dir"):
+            raise ValueError(f"清单中 '{filename}' 缺少model_dir")
+        entries[filename.replace("\\", "/")] = {
+            "url": _string_field(filename, entry, "url"),
+            "model_dir": _string_field(filename, entry, "model_dir"),
+            "subfolder": _string_field(filename, entry, "subfolder"),
+            "custom_path": _string_field(filename, entry, "custom_path"),
+            "sha256": entry.get("sha256"),
+        }
+    return entries
+
+
+def _string_field(filename, entry, key):
+    """清单条目的字符串字段；YAML中只写了键没写值时为null，视为空字符串"""
+    value = entry.get(key)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValueError(f"清单中 '{filename}' 的 {key} 应为字符串: {value!r}")
+    return value
+
+
+def target_path(filename, entry):
+    """清单条目在本地的目标路径，模型目录不存在时返回None"""
+    if entry["model_dir"] == "custom":
+        base = entry["custom_path"]
+    else:
+        base = model_dir_index.resolve(entry["model_dir"])
+    if not base:
+        return None
+    return os.path.join(base, entry["subfolder"].strip(), filename)
+
+
+class PrefetchGroup:
+    """一次批量预取的任务组"""
+
+    def __init__(self, present, unresolved, errors):
+        self.group_id = uuid.uuid4().hex[:12]
+        self.jobs = []
+        self.present = present
+        self.unresolved = unresolved
+        self.errors = errors
+        self.created_at = time.time()
+
+    def summary(self):
+        counts = {state: 0 for state in (STATE_QUEUED, STATE_RUNNING, STATE_PAUSED,
+                                         STATE_COMPLETED, STATE_FAILED, STATE_CANCELLED)}
+        completed_bytes = total_bytes = speed = 0
+        for job in self.jobs:
+            counts[job.state] += 1
+            completed_bytes += job.total_bytes if job.state == STATE_COMPLETED else job.completed_bytes
+            total_bytes += job.total_bytes
+            if job.state == STATE_RUNNING:
+                speed += job.speed_bps
+        finished = counts[STATE_COMPLETED] + counts[STATE_FAILED] + counts[STATE_CANCELLED]
+        return {
+            "group_id": self.group_id,
+            "done": finished == len(self.jobs),
+            "jobs": len(self.jobs),
+            "states": counts,
+            "bytes": completed_bytes,
+            "total": total_bytes,
+            "speed": int(speed),
+            "job_ids": [job.job_id for job in self.jobs],
+            "present": self.present,
+            "unresolved": self.unresolved,
+            "errors": self.errors,
+        }
+
+    def wait(self):
+        for job in self.jobs:
+            job.wait()
+
+
+class PrefetchManager:
+    """根据工作流和URL清单找出缺失的模型并通过下载队列并行下载"""
+
+    def __init__(self, max_groups=50):
+        self.max_groups = max_groups
+        self._groups = {}
+        self._job_groups = {}
+        self._lock = threading.Lock()
+
+    def plan(self, workflow, manifest):
+        """返回 (缺失的 [(文件名, 条目)], 已存在的文件名, 清单中没有的引用)"""
+        node_entries = _downloader_node_manifest(workflow)
+        entries = _embedded_manifest(workflow)
+        entries.update(node_entries)
+        entries.update(parse_manifest(manifest))
+        if _load_json(workflow):
+            references = find_model_references(workflow)
+            references += [name for name in node_entries if name not in references]
+        else:
+            references = list(entries)
+
+        missing, present, unresolved = [], [], []
+        for filename in references:
+            entry = entries.get(filename) or entries.get(os.path.basename(filename))
+            if entry is None:
+                unresolved.append(filename)
+                continue
+            path = target_path(filename, entry)
+            if path and os.path.isfile(path):
+                present.append(filename)
+            else:
+                missing.append((filename, entry))
+        return missing, present, unresolved
+
+    def start(self, workflow, manifest, use_mirror="no", threads=0, priority=0):
+        """提交所有缺失文件的下载，返回任务组"""
+        missing, present, unresolved = self.plan(workflow, manifest)
+        errors = {}
+        group = PrefetchGroup(present, unresolved, errors)
+        for filename, entry in missing:
+            job, error = ModelDownloader.create_job(entry["url"], entry["model_dir"], entry["custom_path"],
+                                                    entry["subfolder"], use_mirror, threads, priority=priority,
+                                                    filename=filename, sha256=entry["sha256"])
+            if error:
+                errors[filename] = error
+                continue
+            # 同一目标已在下载时复用已有任务
+            job = ModelDownloader.submit_unique(job)
+            group.jobs.append(job)
+
+        with self._lock:
+            self._groups[group.group_id] = group
+            for job in group.jobs:
+                self._job_groups.setdefault(job.job_id, []).append(group)
+            self._prune()
+        print(f"预取任务组 {group.group_id}: 缺失 {len(missing)} 个，已存在 {len(present)} 个，"
+              f"清单中未找到 {len(unresolved)} 个")
+        self._emit(group)
+        return group
+
+    def get(self, group_id):
+        with self._lock:
+            return self._groups.get(group_id)
+
+    def _prune(self):
+        # 调用方需持有 self._lock；只保留最近的任务组
+        while len(self._groups) > self.max_groups:
+            oldest = min(self._groups.values(), key=lambda group: group.created_at)
+            del self._groups[oldest.group_id]
+            for job in oldest.jobs:
+                groups = self._job_groups.get(job.job_id, [])
+                if oldest in groups:
+                    groups.remove(oldest)
+                if not groups:
+                    self._job_groups.pop(job.job_id, None)
+
+    def _groups_of(self, jobs):
+        with self._lock:
+            groups = {}
+            for job in jobs:
+                for group in self._job_groups.get(job.job_id, []):
+                    groups[group.group_id] = group
+            return list(groups.values())
+
+    def on_job_changed(self, job):
+        """下载队列状态回调"""
+        for group in self._groups_of([job]):
+            self._emit(group)
+
+    def on_progress_flush(self, jobs):
+        """进度合并推送回调，为受影响的任务组推送聚合进度"""
+        for group in self._groups_of(jobs):
+            self._emit(group)
+
+    def _emit(self, group):
+        progress_reporter.emit("model_prefetch_progress", group.summary())
+
+
+prefetch_manager = PrefetchManager()
+download_queue.add_listener(prefetch_manager.on_job_changed)
+progress_reporter.add_flush_listener(prefetch_manager.on_progress_flush)
+
+
+def _start_repo_downloads(url, model_dir, custom_path, subfolder, use_mirror, threads, revision, include, exclude):
+    jobs, error = ModelDownloader.create_repo_jobs(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                                   revision=revision, include=include, exclude=exclude)
+    if error:
+        print(f"提交队列时开始仓库下载失败: {error}")
+        return
+    for job in jobs:
+        ModelDownloader.submit_unique(job)
+
+
+def start_prompt_downloads(json_data):
+    """ComfyUI提交队列时的回调（add_on_prompt_handler）：立即并行开始提示中所有
+    Model Downloader 节点的下载，节点执行时只等待自己的文件；返回原样的 json_data"""
+    try:
+        prompt = json_data.get("prompt") or {}
+        for node in prompt.values():
+            if not isinstance(node, dict) or node.get("class_type") != "ModelDownloaderNode":
+                continue
+            inputs = node.get("inputs") or {}
+            names = ("url", "model_dir", "custom_path", "subfolder", "use_mirror")
+            # 连接到其他节点输出的输入（[节点ID, 输出序号]）要到执行时才知道值
+            if not all(isinstance(inputs.get(name), str) for name in names):
+                continue
+            url, model_dir, custom_path, subfolder, use_mirror = (inputs[name] for name in names)
+            threads = inputs.get("threads", 0) if isinstance(inputs.get("threads", 0), int) else 0
+            if parse_repo_url(url):
+                # 列出仓库文件需要请求Hub API，放到后台线程中，不阻塞提交
+                options = [inputs.get(name) if isinstance(inputs.get(name), str) else ""
+                           for name in ("revision", "include", "exclude")]
+                threading.Thread(target=_start_repo_downloads, name="model-downloader-prompt-repo", daemon=True,
+                                 args=(url, model_dir, custom_path, subfolder, use_mirror, threads, *options)).start()
+            else:
+                convert = inputs.get("convert", "none")
+                ModelDownloader.start_prompt_job(url, model_dir, custom_path, subfolder, use_mirror, threads,
+                                                 convert if convert in CONVERT_MODES else "none",
+                                                 extract=inputs.get("extract") == "yes")
+    except Exception as e:
+        print(f"提交队列时开始下载失败: {str(e)}")
+    return json_data
+
+
+class ModelPrefetcher:
+    """工作流模型预取节点：根据工作流JSON和URL清单并行下载所有缺失的模型"""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "workflow_json": ("STRING", {
+                    "multiline": True,
+                    "default": ""
+                }),
+                "manifest": ("STRING", {
+                    "multiline": True,
+                    "default": "{\n  \"model.safetensors\": {\"url\": \"https://huggingface.co/...\", \"model_dir\": \"checkpoints\"}\n}"
+                }),
+                "use_mirror": (["yes", "no"], ),
+                # 0 表示自动调整连接数和分段大小
+                "threads": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 32,
+                    "step": 1
+                }),
+            },
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("status",)
+    FUNCTION = "prefetch"
+    CATEGORY = "下载"
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return time.time()
+
+    def prefetch(self, workflow_json, manifest, use_mirror, threads):
+        try:
+            group = prefetch_manager.start(workflow_json, manifest, use_mirror, threads)
+        except ValueError as e:
+            return (f"错误: {str(e)}", )
+        group.wait()
+
+        summary = group.summary()
+        lines = [f"预取完成: 共 {summary['jobs']} 个下载，成功 {summary['states'][STATE_COMPLETED]} 个，"
+                 f"失败 {summary['states'][STATE_FAILED]} 个，已存在 {len(group.present)} 个"]
+        for job in group.jobs:
+            lines.append(f"{job.filename}: {job.result}")
+        for filename in group.unresolved:
+            lines.append(f"{filename}: 清单中没有下载地址")
+        for filename, error in group.errors.items():
+            lines.append(f"{filename}: {error}")
+        return ("\n".join(lines), )
@@ -0,0 +1,134 @@
+import os
+import re
+import threading
+import time
+
+
+# aria2c控制台进度行，例如 [#2089b0 400MiB/1.2GiB(33%) CN:16 DL:115MiB ETA:7s]
+_ARIA2_SIZES_RE = re.compile(r"\[#\w+\s+([\d.]+)([KMGT]?i?B)/([\d.]+)([KMGT]?i?B)")
+_ARIA2_SPEED_RE = re.compile(r"\sDL:([\d.]+)([KMGT]?i?B)")
+_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+
+
+def parse_aria2_readout(line):
+    """解析aria2c控制台进度行，返回 (已下载字节, 总字节, 速度字节/秒)，不是进度行时返回None"""
+    sizes = _ARIA2_SIZES_RE.search(line)
+    if not sizes:
+        return None
+    completed = float(sizes.group(1)) * _UNITS.get(sizes.group(2), 1)
+    total = float(sizes.group(3)) * _UNITS.get(sizes.group(4), 1)
+    speed = _ARIA2_SPEED_RE.search(line)
+    speed_bps = float(speed.group(1)) * _UNITS.get(speed.group(2), 1) if speed else 0
+    return int(completed), int(total), speed_bps
+
+
+def _prompt_server_sink(event, data):
+    # 延迟导入，命令行等没有ComfyUI服务器的环境下不推送
+    try:
+        from server import PromptServer
+    except ImportError:
+        return
+    if PromptServer.instance is not None:
+        PromptServer.instance.send_sync(event, data)
+
+
+class ProgressReporter:
+    """节流、合并的下载进度推送
+
+    下载引擎只调用 update(job) 标记进度变化；后台线程每隔 interval 秒把所有
+    有变化的任务合并成一条 model_download_progress 消息发出，只包含
+    job_id、字节数、速度和剩余时间。任务状态变化（开始、暂停、完成等）
+    通过 send_status 立即发送完整状态。
+    """
+
+    def __init__(self, interval=1.0, echo=False):
+        self.interval = interval
+        self.echo = echo
+        self._sinks = [_prompt_server_sink]
+        self._flush_listeners = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_sink(self, sink):
+        """注册额外的事件接收函数 sink(event, data)"""
+        self._sinks.append(sink)
+
+    def set_sinks(self, sinks):
+        """替换全部事件接收函数（例如命令行模式下只输出到标准输出）"""
+        self._sinks = list(sinks)
+
+    def add_flush_listener(self, listener):
+        """注册合并推送时的回调 listener(jobs)，用于推送聚合进度"""
+        self._flush_listeners.append(listener)
+
+    def emit(self, event, data):
+        for sink in self._sinks:
+            try:
+                sink(event, data)
+            except Exception as e:
+                print(f"推送下载进度失败: {str(e)}")
+
+    def update(self, job):
+        """标记任务进度有变化，由后台线程按频率合并推送"""
+        with self._lock:
+            self._pending[job.job_id] = job
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name="model-downloader-progress")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def send_status(self, job):
+        """立即发送任务的完整状态（状态变化时调用）"""
+        with self._lock:
+            self._pending.pop(job.job_id, None)
+        self.emit("model_download_status", job.to_dict())
+
+    def flush(self):
+        with self._lock:
+            jobs, self._pending = list(self._pending.values()), {}
+        if not jobs:
+            return False
+        deltas = [progress_delta(job) for job in jobs]
+        self.emit("model_download_progress", {"jobs": deltas})
+        for listener in self._flush_listeners:
+            try:
+                listener(jobs)
+            except Exception as e:
+                print(f"推送聚合进度失败: {str(e)}")
+        if self.echo:
+            for job in jobs:
+                print(f"[{job.job_id}] {job.progress}% {job.speed} ETA {job.eta} {job.filename}")
+        return True
+
+    def _flush_loop(self):
+        idle_since = time.monotonic()
+        while True:
+            time.sleep(max(self.interval, 0.05))
+            if self.flush():
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > 30:
+                # 长时间没有进度时退出，下次update时重新启动
+                with self._lock:
+                    if not self._pending:
+                        self._thread = None
+                        return
+
+
+def progress_delta(job):
+    """紧凑的进度增量"""
+    return {
+        "job_id": job.job_id,
+        "bytes": job.completed_bytes,
+        "total": job.total_bytes,
+        "speed": int(job.speed_bps),
+        "eta": job.eta_seconds,
+    }
+
+
+# 全局进度推送，推送间隔和控制台输出可通过环境变量或设置接口调整
+progress_reporter = ProgressReporter(
+    interval=float(os.environ.get("MODEL_DOWNLOADER_PROGRESS_INTERVAL", "1.0")),
+    echo=os.environ.get("MODEL_DOWNLOADER_ECHO", "0") == "1",
+)
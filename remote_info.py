@@ -0,0 +1,104 @@
+import re
+import urllib.parse
+import urllib.request
+import urllib.error
+
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class RemoteFileInfo:
+    """HEAD请求得到的远程文件元数据"""
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.size = 0
+        self.sha256 = None
+        self.etag = None
+        self.last_modified = None
+        self.commit = None
+        self.location = None
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "status": self.status,
+            "size": self.size,
+            "sha256": self.sha256,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "commit": self.commit,
+        }
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # urllib跟随重定向时会把HEAD改成GET，这里自己处理重定向
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _strip_etag(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"')
+
+
+def head(url, timeout=15, max_redirects=5, headers=None):
+    """发送HEAD请求获取文件大小和哈希
+
+    Hugging Face 的 LFS 文件在第一次 302 响应中就带有 X-Linked-Etag（文件的SHA-256）
+    和 X-Linked-Size，因此遇到这两个头时不再继续跟随重定向。
+    """
+    info = RemoteFileInfo(url)
+    current = url
+    for _ in range(max_redirects + 1):
+        request = urllib.request.Request(current, method="HEAD", headers=headers or {})
+        try:
+            response = _opener.open(request, timeout=timeout)
+            status = response.status
+            response_headers = response.headers
+            response.close()
+        except urllib.error.HTTPError as e:
+            status = e.code
+            response_headers = e.headers
+        _merge_headers(info, response_headers, status)
+        info.status = status
+
+        if status in (301, 302, 303, 307, 308) and response_headers.get("Location"):
+            info.location = urllib.parse.urljoin(current, response_headers["Location"])
+            if info.sha256 and info.size:
+                break
+            current = info.location
+            continue
+        break
+    return info
+
+
+def _merge_headers(info, headers, status):
+    # 先出现的值优先（例如Hugging Face重定向前的 X-Linked-* 头）
+    linked_etag = _strip_etag(headers.get("X-Linked-Etag"))
+    etag = _strip_etag(headers.get("ETag"))
+    # 只有Hugging Face的 X-Linked-Etag 约定为LFS文件的SHA-256；普通ETag即使形如64位十六进制也可能是
+    # 服务器自己的版本标识，当作哈希会让校验失败并删除正确的下载
+    if info.sha256 is None and linked_etag and _SHA256_RE.match(linked_etag.lower()):
+        info.sha256 = linked_etag.lower()
+    if info.etag is None:
+        info.etag = linked_etag or etag
+    if not info.size:
+        # 重定向响应的Content-Length只是响应体长度，不是文件大小
+        size = headers.get("X-Linked-Size")
+        if not size and 200 <= status < 300:
+            size = headers.get("Content-Length")
+        if size and size.isdigit():
+            info.size = int(size)
+    if info.last_modified is None:
+        info.last_modified = headers.get("Last-Modified")
+    if info.commit is None:
+        info.commit = headers.get("X-Repo-Commit")
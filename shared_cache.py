@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+from .download_queue import DownloadError
+
+
+class CacheLock:
+    """基于 O_EXCL 锁文件的跨节点建议锁
+
+    持有者在后台定期更新锁文件的修改时间作为心跳；心跳超时，或锁文件记录的
+    本机进程已不存在时，视为持有者已崩溃，其他节点可以接管。
+    """
+
+    def __init__(self, path, stale_after=60.0):
+        self.path = path
+        self.stale_after = stale_after
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def try_acquire(self):
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_if_stale():
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "acquired_at": time.time(),
+                           "token": uuid.uuid4().hex}, f)
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name="model-downloader-cache-lock")
+            self._heartbeat.daemon = True
+            self._heartbeat.start()
+            return True
+        return False
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(self.stale_after / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def _identity(self, path):
+        """锁文件的 (inode, mtime, 持有者token) 和持有者信息；内容尚未写入时持有者信息为空"""
+        st = os.stat(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                owner = json.load(f)
+        except ValueError:
+            owner = {}
+        return (st.st_ino, st.st_mtime_ns, owner.get("token")), st, owner
+
+    def _stale_identity(self):
+        """锁已失效时返回锁文件的标识，否则返回None"""
+        try:
+            identity, st, owner = self._identity(self.path)
+        except OSError:
+            # 锁文件已被删除
+            return None
+        if time.time() - st.st_mtime > self.stale_after:
+            return identity
+        if owner and owner.get("host") == socket.gethostname() and not _pid_alive(owner.get("pid")):
+            return identity
+        return None
+
+    def _break_if_stale(self):
+        identity = self._stale_identity()
+        if identity is None:
+            return False
+        # 多个节点几乎同时发现锁失效：先接管的节点可能已经删掉旧锁并创建了新锁，后到的节点改名移走的
+        # 就是这把新锁。改名后核对移走的正是判断为失效的那个文件，不是时放回原处，不接管
+        stale_path = f"{self.path}.stale-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(self.path, stale_path)
+        except OSError:
+            return False
+        try:
+            moved = self._identity(stale_path)[0]
+        except OSError:
+            moved = None
+        if moved != identity:
+            self._restore(stale_path)
+            return False
+        print(f"接管已失效的共享缓存锁: {self.path}")
+        try:
+            os.remove(stale_path)
+        except OSError:
+            pass
+        return True
+
+    def _restore(self, stale_path):
+        # 用硬链接放回，不会覆盖此间又有节点新建的锁；文件系统不支持硬链接时退回改名
+        try:
+            os.link(stale_path, self.path)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not os.path.exists(self.path):
+                try:
+                    os.rename(stale_path, self.path)
+                    return
+                except OSError:
+                    pass
+        try:
+            os.remove(stale_path)
+        except OSError:
+            pass
+
+
+def _pid_alive(pid):
+    if not isinstance(pid, int) or os.name == "nt":
+        # Windows 上无法用 os.kill 探测，只依赖心跳超时
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class SharedCache:
+    """多个ComfyUI节点共享的按内容寻址的下载缓存
+
+    目录结构：blobs/<sha256> 为文件内容，urls/<URL哈希>.json 记录URL对应的内容哈希，
+    locks/ 为下载锁，incoming/ 为正在下载的文件。
+    """
+
+    def __init__(self, root, stale_after=60.0, poll_interval=1.0):
+        self.root = root
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        for name in ("blobs", "urls", "locks", "incoming"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256.lower())
+
+    def _url_record_path(self, url):
+        return os.path.join(self.root, "urls", _url_key(url) + ".json")
+
+    def lookup(self, url, sha256=None):
+        """返回缓存中已有的 (blob路径, sha256)，没有时返回None"""
+        if sha256:
+            path = self.blob_path(sha256)
+            return (path, sha256.lower()) if os.path.isfile(path) else None
+        try:
+            with open(self._url_record_path(url), "r", encoding="utf-8") as f:
+                sha256 = json.load(f)["sha256"]
+        except (OSError, ValueError, KeyError):
+            return None
+        path = self.blob_path(sha256)
+        return (path, sha256) if os.path.isfile(path) else None
+
+    def _record_url(self, url, sha256):
+        path = self._url_record_path(url)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "sha256": sha256, "cached_at": time.time()}, f)
+        os.replace(tmp_path, path)
+
+    def fetch(self, url, sha256, filename, download, check_cancelled=None, on_wait=None):
+        """返回文件在缓存中的 (blob路径, sha256)
+
+        缓存中没有时尝试加锁，拿到锁的节点调用 download(target) 下载并校验到target
+        （返回SHA-256）；其他节点等待锁释放后直接使用缓存，持有者失败时由等待者接管下载。
+        """
+        key = sha256.lower() if sha256 else "url-" + _url_key(url)
+        lock = CacheLock(os.path.join(self.root, "locks", key + ".lock"), self.stale_after)
+        waiting = False
+        while True:
+            cached = self.lookup(url, sha256)
+            if cached:
+                return cached
+            if lock.try_acquire():
+                try:
+                    return self._download_locked(url, sha256, key, filename, download)
+                finally:
+                    lock.release()
+            if not waiting:
+                waiting = True
+                print(f"其他节点正在下载 {filename}，等待完成后从共享缓存获取")
+                if on_wait is not None:
+                    on_wait()
+            if check_cancelled is not None:
+                check_cancelled()
+            time.sleep(self.poll_interval)
+
+    def _download_locked(self, url, sha256, key, filename, download):
+        cached = self.lookup(url, sha256)
+        if cached:
+            return cached
+        # 保留原扩展名，下载后的格式校验（如safetensors头部）按扩展名进行
+        target = os.path.join(self.root, "incoming", f"{key[:32]}-{filename}")
+        digest = download(target)
+        if sha256 and digest != sha256.lower():
+            raise DownloadError(f"SHA-256校验失败: 预期 {sha256}，实际 {digest}", cause="checksum")
+        blob = self.blob_path(digest)
+        if os.path.isfile(blob):
+            os.remove(target)
+        else:
+            os.replace(target, blob)
+        self._record_url(url, digest)
+        return blob, digest
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _load_shared_cache():
+    root = os.environ.get("MODEL_DOWNLOADER_SHARED_CACHE")
+    if not root:
+        return None
+    try:
+        cache = SharedCache(root, stale_after=float(os.environ.get("MODEL_DOWNLOADER_LOCK_TIMEOUT", "60")))
+    except OSError as e:
+        print(f"无法使用共享缓存目录 {root}: {str(e)}")
+        return None
+    print(f"使用共享下载缓存: {root}")
+    return cache
+
+
+# 设置 MODEL_DOWNLOADER_SHARED_CACHE 为多个节点共享的目录时启用
+shared_cache = _load_shared_cache()
@@ -2,8 +2,49 @@
 import { app } from "../../scripts/app.js";
 import { api } from "../../scripts/api.js";
 
-// 监听下载状态更新
-api.addEventListener("model_download_status", function(status) {
+// 各下载任务的最新状态，按job_id索引
+const downloadJobs = new Map();
+
+// 格式化字节数
+function formatSize(bytes) {
+    const units = ["B", "KiB", "MiB", "GiB"];
+    let size = bytes;
+    let unit = 0;
+    while (size >= 1024 && unit < units.length - 1) {
+        size /= 1024;
+        unit++;
+    }
+    return unit === 0 ? `${size}B` : `${size.toFixed(1)}${units[unit]}`;
+}
+
+// 格式化剩余秒数
+function formatEta(seconds) {
+    if (seconds === null || seconds === undefined) return "计算中...";
+    const h = Math.floor(seconds / 3600);
+    const m = Math.floor((seconds % 3600) / 60);
+    const s = seconds % 60;
+    if (h) return `${h}h${m}m${s}s`;
+    if (m) return `${m}m${s}s`;
+    return `${s}s`;
+}
+
+// 格式化单个任务的状态信息
+function formatJobStatus(status) {
+    let statusMessage = `任务: ${status.job_id} (${status.state})\n`;
+    statusMessage += `状态: ${status.status}\n`;
+    if (status.is_downloading) {
+        const progress = status.total_bytes ? Math.floor(status.completed_bytes * 100 / status.total_bytes) : status.progress;
+        statusMessage += `进度: ${progress}% (${formatSize(status.completed_bytes)}/${formatSize(status.total_bytes)})\n`;
+        statusMessage += `速度: ${formatSize(status.speed_bps)}/s\n`;
+        statusMessage += `预计剩余时间: ${formatEta(status.eta_seconds)}\n`;
+    }
+    statusMessage += `URL: ${status.url}\n`;
+    statusMessage += `保存路径: ${status.save_path}`;
+    return statusMessage;
+}
+
+// 刷新对话框中的任务状态
+function renderJobs() {
     const dialog = document.getElementById("model-downloader-dialog");
     if (!dialog) return;
     
@@ -13,22 +54,32 @@ api.addEventListener("model_download_status", function(status) {
     // 显示状态区域
     statusGroup.style.display = "block";
     
-    // 更新状态信息
-    let statusMessage = `状态: ${status.message}\n`;
-    if (status.is_downloading) {
-        statusMessage += `进度: ${status.progress}%\n`;
-        statusMessage += `速度: ${status.speed}\n`;
-        statusMessage += `预计剩余时间: ${status.eta}\n`;
-    }
-    statusMessage += `URL: ${status.url}\n`;
-    statusMessage += `保存路径: ${status.save_path}`;
-    
-    statusText.textContent = statusMessage;
+    // 更新所有任务的状态信息
+    statusText.textContent = Array.from(downloadJobs.values()).map(formatJobStatus).join("\n\n");
+}
+
+// 监听任务状态变化（开始、暂停、完成、失败等），消息包含完整状态
+api.addEventListener("model_download_status", function(status) {
+    downloadJobs.set(status.job_id, status);
+    renderJobs();
     
     // 更新ComfyUI节点输出显示
     updateNodeOutputs(status);
 });
 
+// 监听节流合并后的进度增量，只包含字节数、速度和剩余时间
+api.addEventListener("model_download_progress", function(data) {
+    for (const delta of data.jobs) {
+        const status = downloadJobs.get(delta.job_id);
+        if (!status) continue;
+        status.completed_bytes = delta.bytes;
+        status.total_bytes = delta.total;
+        status.speed_bps = delta.speed;
+        status.eta_seconds = delta.eta;
+    }
+    renderJobs();
+});
+
 // 更新ComfyUI节点状态
 function updateNodeOutputs(status) {
     // 查找所有ModelDownloader节点
@@ -240,7 +291,7 @@ app.registerExtension({
             // 线程数选择
             const threadsGroup = document.createElement("div");
             const threadsLabel = document.createElement("label");
-            threadsLabel.textContent = "下载线程数:";
+            threadsLabel.textContent = "下载线程数 (0 为自动调整):";
             threadsLabel.style.cssText = `
                 display: block;
                 margin-bottom: 5px;
@@ -248,9 +299,9 @@ app.registerExtension({
             `;
             const threadsInput = document.createElement("input");
             threadsInput.type = "number";
-            threadsInput.min = "1";
+            threadsInput.min = "0";
             threadsInput.max = "32";
-            threadsInput.value = "16";
+            threadsInput.value = "0";
             threadsInput.style.cssText = `
                 width: 100%;
                 padding: 8px;
@@ -360,7 +411,8 @@ app.registerExtension({
                 const customPath = customPathInput.value.trim();
                 const subfolder = subfolderInput.value.trim();
                 const useMirror = mirrorCheckbox.checked ? "yes" : "no";
-                const threads = parseInt(threadsInput.value) || 16;
+                const parsedThreads = parseInt(threadsInput.value);
+                const threads = isNaN(parsedThreads) ? 0 : parsedThreads;
 
                 if (modelDir === "custom" && !customPath) {
                     alert("选择自定义路径时，必须提供有效的路径");
@@ -393,8 +445,9 @@ app.registerExtension({
                         throw new Error(errorData.error || '下载请求失败');
                     }
 
-                    // 下载已开始，状态更新将通过WebSocket事件接收
-                    console.log('下载请求已发送');
+                    // 下载已加入队列，状态更新将通过WebSocket事件接收
+                    const data = await response.json();
+                    console.log('下载请求已发送，任务ID:', data.job_id);
                 } catch (error) {
                     statusText.textContent = `错误: ${error.message}`;
                     console.error("下载出错:", error);